@@ -0,0 +1,63 @@
+"""
+cosme_app.v2.py は Streamlit のスクリプトで、import すると画面の描画まで走る。
+テストでは関数・クラス・定数の定義だけを読み込んだモジュールを app フィクスチャとして渡す
+"""
+import ast
+import pathlib
+import types
+
+import pytest
+
+APP_PATH = pathlib.Path(__file__).with_name("cosme_app.v2.py")
+# この行より下で、呼び出しを含む代入（シートやCSVの読み込み）は実行部分なので読み込まない
+RUN_SECTION = "# --- 3. 実際の実行プロセス ---"
+
+
+def load_app_definitions():
+    source = APP_PATH.read_text(encoding="utf-8")
+    run_line = source[:source.index(RUN_SECTION)].count("\n") + 1
+    keep = []
+    for node in ast.parse(source).body:
+        if isinstance(node, (ast.Import, ast.ImportFrom, ast.FunctionDef, ast.ClassDef)):
+            keep.append(node)
+        elif isinstance(node, ast.Assign):
+            has_call = any(isinstance(n, ast.Call) for n in ast.walk(node.value))
+            if node.lineno < run_line or not has_call:
+                keep.append(node)
+    module = types.ModuleType("cosme_app")
+    module.__file__ = str(APP_PATH)
+    exec(compile(ast.Module(body=keep, type_ignores=[]), str(APP_PATH), "exec"), module.__dict__)
+    return module
+
+
+@pytest.fixture(scope="session")
+def app():
+    return load_app_definitions()
+
+
+@pytest.fixture
+def fake_sheet_session(tmp_path):
+    """fake_sheets.py をバックエンドにした、SheetSession と同じ使い方ができる入れ物"""
+    import fake_sheets
+
+    class FakeSheetSession:
+        def __init__(self, path):
+            self.client = fake_sheets.FakeClient(path)
+            self.revisions = {}
+            self.mirror = None
+
+        def seed(self, sheets):
+            fake_sheets.FakeClient.seed(self.client.path, sheets)
+
+        def spreadsheet(self):
+            return self.client.open("Cosme Data")
+
+        def worksheet(self, title):
+            return self.spreadsheet().worksheet(title)
+
+        def bump_revision(self, title, mirror_stale=True):
+            self.revisions[title] = self.revisions.get(title, 0) + 1
+            if mirror_stale and self.mirror is not None:
+                self.mirror.mark_dirty(title)
+
+    return FakeSheetSession(str(tmp_path / "fake_sheets.json"))
@@ -1,17 +1,66 @@
+import time
+_CORE_IMPORT_T0 = time.perf_counter()
 import streamlit as st
 import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
-import qrcode
+import numpy as np
 from io import BytesIO
 import urllib.parse
-import google.generativeai as genai
+import importlib
+import importlib.util
+import sys
 import gspread
 from google.oauth2.service_account import Credentials
+from google.auth.transport.requests import Request as GoogleAuthRequest
 import datetime
-import time
+import threading
+import contextlib
+import collections
+import re
+import unicodedata
+import os
+import json
+import sqlite3
+import hashlib
+import math
+import bisect
+import random
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from streamlit_option_menu import option_menu
 import requests
+import base64
+# plotly / qrcode / google.generativeai / PIL は各メニューで lazy_import() する
+
+# 再実行ごとの「スクリプト開始〜最初の描画」計測用
+APP_T0 = time.perf_counter()
+_CORE_IMPORT_MS = (APP_T0 - _CORE_IMPORT_T0) * 1000
+
+# メニュー専用の重い依存モジュール（STARTUP_MODE="eager" の時だけ起動時に読み込む）
+MENU_MODULES = {
+    "📲 アンケートQR生成": ["qrcode"],
+    "✨ AIポップ作成": ["google.generativeai", "PIL.Image", "plotly.graph_objects"],
+    "📈 アンケート分析": ["plotly.graph_objects", "plotly.express"],
+}
+
+@st.cache_resource
+def get_import_profile():
+    """モジュールごとの初回読み込み時間（ms）。プロセスの起動後に1回だけ記録される"""
+    return {}
+
+def lazy_import(name):
+    """必要になった時に初めてモジュールを読み込み、その読み込み時間を記録する"""
+    if name in sys.modules:
+        return sys.modules[name]
+    t0 = time.perf_counter()
+    module = importlib.import_module(name)
+    get_import_profile()[name] = (time.perf_counter() - t0) * 1000
+    return module
+
+get_import_profile().setdefault("（起動時の共通モジュール）", _CORE_IMPORT_MS)
+if st.secrets.get("STARTUP_MODE", "lazy") == "eager":
+    for _names in MENU_MODULES.values():
+        for _name in _names:
+            lazy_import(_name)
 
 # --- パスワード認証機能 ---
 def check_password():
@@ -59,37 +108,1563 @@ if "login_celebrated" not in st.session_state:
 # --- 1. 基本設定 ---
 st.set_page_config(page_title="CosmeInsight Pro v5", layout="wide")
 
-if "GEMINI_API_KEY" in st.secrets:
-    genai.configure(api_key=st.secrets["GEMINI_API_KEY"])
+GEMINI_DEFAULT_MODEL = "models/gemini-1.5-flash"
+GEMINI_DISCOVERY_TTL = 3600  # 使えるモデル一覧を取り直す間隔（秒）
+
+class GeminiModelRegistry:
+    """使えるGeminiモデル名をキャッシュし、期限が切れたら裏で取り直す"""
+
+    def __init__(self, api_key):
+        self._api_key = api_key
+        self._lock = threading.Lock()
+        self._model_name = None
+        self._model = None
+        self._model_built_for = None
+        self._fetched_at = 0.0
+        self._refreshing = False
+        self.last_error = None
+
+    def _discover(self):
+        genai = lazy_import("google.generativeai")
+        genai.configure(api_key=self._api_key)
+        try:
+            # 使えるモデルをリストアップして、flashが含まれるものを探す
+            available_models = [m.name for m in genai.list_models() if 'generateContent' in m.supported_generation_methods]
+            # 'gemini-1.5-flash' があればそれを、なければリストの最初を使う
+            target_model = GEMINI_DEFAULT_MODEL if GEMINI_DEFAULT_MODEL in available_models else available_models[0]
+            self.last_error = None
+        except Exception as e:
+            self.last_error = e
+            target_model = self._model_name or GEMINI_DEFAULT_MODEL # 失敗したらデフォルト
+        with self._lock:
+            self._model_name = target_model
+            self._fetched_at = time.time()
+            self._refreshing = False
+
+    def model_name(self):
+        if self._model_name is None:
+            # 初回だけはその場で取得する（Geminiを使うページを開いた時）
+            self._discover()
+        elif time.time() - self._fetched_at > GEMINI_DISCOVERY_TTL:
+            with self._lock:
+                start = not self._refreshing
+                self._refreshing = True
+            if start:
+                # 期限切れでも今の値で描画を続け、一覧の取り直しは裏で行う
+                threading.Thread(target=self._discover, daemon=True).start()
+        return self._model_name
+
+    def model(self):
+        name = self.model_name()
+        with self._lock:
+            if self._model is None or self._model_built_for != name:
+                self._model = lazy_import("google.generativeai").GenerativeModel(name)
+                self._model_built_for = name
+            return self._model
+
+@st.cache_resource
+def get_gemini_registry(api_key):
+    return GeminiModelRegistry(api_key)
+
+def get_gemini_model():
+    """Geminiを使うページで初めてモデルを用意する（APIキーがなければNone）"""
+    if st.secrets.get("GEMINI_STUB", False):
+        return StubPopModel()
+    if "GEMINI_API_KEY" not in st.secrets:
+        return None
+    registry = get_gemini_registry(st.secrets["GEMINI_API_KEY"])
+    model = registry.model()
+    if registry.last_error:
+        st.error(f"モデルリスト取得エラー: {registry.last_error}")
+    return model
+
+SPREADSHEET_NAME = "Cosme Data"
+# アンケートの差分保存などに使うローカルの作業フォルダ
+LOCAL_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
+
+# --- Sheets API の呼び出し予算（1分あたりの上限を全セッションで分け合う） ---
+SHEETS_REQUESTS_PER_MINUTE = 60  # サービスアカウント1つあたりの読み込み・書き込みそれぞれの上限
+SHEET_LATENCY_BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000)
+_sheet_call_local = threading.local()
+
+def set_sheet_call_label(label):
+    """このスレッドでこの後に呼ぶ Sheets API を、どのメニューの呼び出しとして数えるか"""
+    _sheet_call_local.label = label
+
+def current_sheet_call_context():
+    """(集計用のラベル, 優先度)。画面を描くスレッドは "interactive"、裏の処理は "background" """
+    return getattr(_sheet_call_local, "label", "（その他）"), getattr(_sheet_call_local, "priority", "interactive")
+
+@contextlib.contextmanager
+def sheet_call_context(label, priority):
+    prev = current_sheet_call_context()
+    _sheet_call_local.label, _sheet_call_local.priority = label, priority
     try:
-        # 使えるモデルをリストアップして、flashが含まれるものを探す
-        available_models = [m.name for m in genai.list_models() if 'generateContent' in m.supported_generation_methods]
-        # 'gemini-1.5-flash' があればそれを、なければリストの最初を使う
-        target_model = 'models/gemini-1.5-flash' if 'models/gemini-1.5-flash' in available_models else available_models[0]
-        model = genai.GenerativeModel(target_model)
-        # st.write(f"DEBUG: 選択されたモデル: {target_model}") # 動作確認用
-    except Exception as e:
-        st.error(f"モデルリスト取得エラー: {e}")
-        model = genai.GenerativeModel('gemini-1.5-flash') # 失敗したらデフォルト
-else:
-    model = None
+        yield
+    finally:
+        _sheet_call_local.label, _sheet_call_local.priority = prev
+
+# 再実行の最初はメニューが決まっていないので、メニュー表示までの呼び出しはこのラベルで数える
+set_sheet_call_label("（メニュー表示前）")
+
+class SheetRequestBudget:
+    """
+    読み込み・書き込みそれぞれのトークンバケット（1分で per_minute 回分が貯まる）。
+    裏の処理は残りが background_reserve を切ると待ち、画面の読み込みが待っている間も先を譲る
+    """
+
+    def __init__(self, per_minute=SHEETS_REQUESTS_PER_MINUTE, background_reserve=0.2):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.reserve = self.capacity * background_reserve
+        self._tokens = {"読み込み": self.capacity, "書き込み": self.capacity}
+        self._updated = time.monotonic()
+        self._cond = threading.Condition()
+        self._interactive_waiting = {"読み込み": 0, "書き込み": 0}
+        self._recent = collections.deque()  # (時刻, 種類)。直近1分の消費量を出すため
+        self.stats = {"calls": 0, "throttled": 0, "wait_ms": 0.0, "rate_limited": 0, "errors": 0}
+        self.calls_by_label = collections.Counter()  # (ラベル, 種類) → 回数
+        self.histograms = {k: [0] * (len(SHEET_LATENCY_BUCKETS_MS) + 1) for k in self._tokens}
+
+    def _refill(self):
+        now = time.monotonic()
+        for kind in self._tokens:
+            self._tokens[kind] = min(self.capacity, self._tokens[kind] + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, kind, priority="interactive"):
+        """トークンを1つ取るまで待ち、待った秒数を返す"""
+        interactive = priority == "interactive"
+        floor = 1.0 if interactive else 1.0 + self.reserve
+        t0 = time.monotonic()
+        with self._cond:
+            if interactive:
+                self._interactive_waiting[kind] += 1
+            try:
+                while True:
+                    self._refill()
+                    if self._tokens[kind] >= floor and (interactive or not self._interactive_waiting[kind]):
+                        self._tokens[kind] -= 1
+                        break
+                    self._cond.wait(max((floor - self._tokens[kind]) / self.rate, 0.05))
+            finally:
+                if interactive:
+                    self._interactive_waiting[kind] -= 1
+                    self._cond.notify_all()
+            waited = time.monotonic() - t0
+            if waited > 0.001:
+                self.stats["throttled"] += 1
+                self.stats["wait_ms"] += waited * 1000
+        return waited
+
+    def penalize(self, kind):
+        """429 が返ったら、残っているはずのトークンを捨てて全員を少し待たせる"""
+        with self._cond:
+            self._refill()
+            self._tokens[kind] = min(self._tokens[kind], 0.0)
+            self.stats["rate_limited"] += 1
+
+    def record(self, label, kind, ms, ok):
+        with self._cond:
+            now = time.monotonic()
+            self._recent.append((now, kind))
+            while self._recent and now - self._recent[0][0] > 60:
+                self._recent.popleft()
+            self.stats["calls"] += 1
+            self.stats["errors"] += 0 if ok else 1
+            self.calls_by_label[(label, kind)] += 1
+            self.histograms[kind][bisect.bisect_left(SHEET_LATENCY_BUCKETS_MS, ms)] += 1
+
+    def used_last_minute(self):
+        with self._cond:
+            now = time.monotonic()
+            return collections.Counter(kind for t, kind in self._recent if now - t <= 60)
+
+    def calls_frame(self):
+        """メニューごとの呼び出し回数（多い順）"""
+        with self._cond:
+            items = list(self.calls_by_label.items())
+        if not items:
+            return pd.DataFrame(columns=["メニュー", "読み込み", "書き込み", "合計"])
+        frame = pd.DataFrame([(label, kind, n) for (label, kind), n in items], columns=["メニュー", "種類", "回数"])
+        table = frame.pivot_table(index="メニュー", columns="種類", values="回数", aggfunc="sum", fill_value=0)
+        table = table.reindex(columns=["読み込み", "書き込み"], fill_value=0)
+        table["合計"] = table.sum(axis=1)
+        return table.sort_values("合計", ascending=False).rename_axis(columns=None).reset_index()
+
+    def histogram_frame(self):
+        """所要時間の分布（行: 時間の区間、列: 読み込み・書き込み）"""
+        edges = ("0",) + tuple(str(b) for b in SHEET_LATENCY_BUCKETS_MS)
+        labels = [f"{lo}–{hi} ms" for lo, hi in zip(edges, edges[1:])] + [f"{SHEET_LATENCY_BUCKETS_MS[-1]} ms〜"]
+        with self._cond:
+            return pd.DataFrame({kind: counts[:] for kind, counts in self.histograms.items()}, index=labels)
+
+class BudgetedHTTPClient(gspread.http_client.HTTPClient):
+    """gspread の全リクエストを SheetRequestBudget に通し、所要時間とメニューごとの回数を記録する"""
+
+    budget = None  # SheetSession がクライアントを作る時に差し込む
+    max_retries = 2  # 画面の呼び出しだけ、429 の時にその場で待って取り直す
+
+    def request(self, method, endpoint, *args, **kwargs):
+        label, priority = current_sheet_call_context()
+        kind = "読み込み" if method.lower() == "get" else "書き込み"
+        attempt = 0
+        while True:
+            self.budget.acquire(kind, priority)
+            t0 = time.perf_counter()
+            ok = False
+            try:
+                response = super().request(method, endpoint, *args, **kwargs)
+                ok = True
+                return response
+            except gspread.exceptions.APIError as e:
+                if e.code != 429:
+                    raise
+                self.budget.penalize(kind)
+                if priority != "interactive" or attempt >= self.max_retries:
+                    raise
+            finally:
+                self.budget.record(label, kind, (time.perf_counter() - t0) * 1000, ok)
+            time.sleep(min(2 ** attempt, 8) * (0.5 + random.random()))
+            attempt += 1
+
+class SheetSession:
+    """認証済みクライアント・スプレッドシート・ワークシートをプロセス全体で使い回す入れ物"""
+
+    def __init__(self, requests_per_minute=SHEETS_REQUESTS_PER_MINUTE):
+        self._lock = threading.RLock()
+        self.budget = SheetRequestBudget(requests_per_minute)
+        self._credentials = None
+        self._client = None
+        self._spreadsheet = None
+        self._worksheets = {}
+        self.stats = {"hits": 0, "misses": 0, "token_refreshes": 0}
+        # シートごとの世代番号（このアプリが書き込むたびに進める）
+        self.revisions = {}
+        self.mirror = None  # get_sheet_mirror() が差し込む
+
+    def _count(self, hit):
+        self.stats["hits" if hit else "misses"] += 1
+
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                self._count(False)
+                if st.secrets.get("SHEETS_BACKEND", "google") == "fake":
+                    # 動作確認用：ローカルのJSONファイルをスプレッドシートの代わりにする（fake_sheets.py）
+                    fake_sheets = lazy_import("fake_sheets")
+                    self._client = fake_sheets.FakeClient(
+                        st.secrets.get("FAKE_SHEETS_PATH", os.path.join(LOCAL_CACHE_DIR, "fake_sheets.json")),
+                        latency_ms=float(st.secrets.get("FAKE_SHEETS_LATENCY_MS", 0)),
+                        offline=bool(st.secrets.get("FAKE_SHEETS_OFFLINE", False)),
+                        # 本物のクライアントと同じ予算に通し、接続診断に回数・所要時間が出るようにする
+                        budget=self.budget,
+                        call_context=current_sheet_call_context,
+                    )
+                    return self._client
+                s_acc = st.secrets["gcp_service_account"]
+                self._credentials = Credentials.from_service_account_info(
+                    s_acc,
+                    # ここに "https://www.googleapis.com/auth/drive" が入っていればOKです！
+                    scopes=["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
+                )
+                self._client = gspread.authorize(self._credentials, http_client=BudgetedHTTPClient)
+                self._client.http_client.budget = self.budget
+            else:
+                self._count(True)
+                # トークンの期限が切れていたら、再認証せずにその場で更新する
+                if self._credentials is not None and self._credentials.token is not None and self._credentials.expired:
+                    self._credentials.refresh(GoogleAuthRequest())
+                    self.stats["token_refreshes"] += 1
+            return self._client
+
+    def spreadsheet(self):
+        with self._lock:
+            if self._spreadsheet is None:
+                self._spreadsheet = self.client().open(SPREADSHEET_NAME)
+                self._count(False)
+            else:
+                self.client()  # トークン更新のチェックだけ行う
+                self._count(True)
+            return self._spreadsheet
+
+    def worksheet(self, title):
+        with self._lock:
+            if title not in self._worksheets:
+                self._worksheets[title] = self.spreadsheet().worksheet(title)
+                self._count(False)
+            else:
+                self._count(True)
+            return self._worksheets[title]
+
+    def add_worksheet(self, title, rows, cols):
+        with self._lock:
+            self._worksheets[title] = self.spreadsheet().add_worksheet(title=title, rows=rows, cols=cols)
+            return self._worksheets[title]
+
+    def bump_revision(self, title, mirror_stale=True):
+        """書き込んだシートのキャッシュを無効化する（ローカルのミラーも取り直してもらう）"""
+        with self._lock:
+            self.revisions[title] = self.revisions.get(title, 0) + 1
+        if mirror_stale and self.mirror is not None:
+            self.mirror.mark_dirty(title)
+
+    def reset(self):
+        """接続エラー時などに、キャッシュしたハンドルをすべて捨てる"""
+        with self._lock:
+            self._credentials = None
+            self._client = None
+            self._spreadsheet = None
+            self._worksheets = {}
+
+@st.cache_resource
+def get_sheet_session():
+    return SheetSession(int(st.secrets.get("SHEETS_REQUESTS_PER_MINUTE", SHEETS_REQUESTS_PER_MINUTE)))
 
-# ここです！
 def get_gspread_client():
-    s_acc = st.secrets["gcp_service_account"]
-    credentials = Credentials.from_service_account_info(
-        s_acc,
-        # ここに "https://www.googleapis.com/auth/drive" が入っていればOKです！
-        scopes=["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
-    )
-    return gspread.authorize(credentials)
+    return get_sheet_session().client()
+
+def get_worksheet(title):
+    """「Cosme Data」内のワークシートをキャッシュ付きで取得する"""
+    return get_sheet_session().worksheet(title)
+
+# --- シートのローカルミラー（画面はSQLiteから読み、シートとの同期は裏で行う） ---
+MIRROR_DB_PATH = os.path.join(LOCAL_CACHE_DIR, "sheet_mirror.sqlite")
+MIRROR_SYNC_INTERVAL = 60  # スプレッドシートの更新日時を確かめる間隔（秒）
+MIRROR_READ_WAIT = 2.0  # 書き込み後の同期を画面が待つ最大秒数（過ぎたら前回の内容で描く）
+
+class SheetsOfflineError(Exception):
+    """スプレッドシートに接続できず、読み取り専用で動いている間の書き込み"""
+
+class SheetMirror:
+    """
+    読んだことのあるシートを行ごとにSQLiteへ写しておき、画面からの読み込みはすべてここから返す。
+    裏のスレッドがスプレッドシートの更新日時を見て、変わった時だけ全シートを1回の batchGet で取り直し、
+    内容が変わった行だけを書き換える（変わったシートは revision を進めてキャッシュを無効化する）。
+    接続できない間は最後に同期した内容を返し続ける
+    """
+
+    def __init__(self, path, session, interval=MIRROR_SYNC_INTERVAL, read_wait=MIRROR_READ_WAIT):
+        self.path = path
+        self.session = session
+        self.interval = interval
+        self.read_wait = read_wait
+        self.offline_since = None
+        self.stats = {"syncs": 0, "checks": 0, "rows_written": 0, "last_sync_ms": None, "last_error": ""}
+        self._lock = threading.Lock()  # SQLite への書き込みと同期を1本にする
+        self._cond = threading.Condition()
+        self._dirty = {}  # このアプリが書き込んだので取り直すシート → 書き込みの通し番号
+        self._marks = 0
+        self.unsynced = set()  # 接続できず、まだ一度も写せていないシート（つながったら裏で同期する）
+        self._wake = threading.Event()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS mirror_rows (sheet TEXT, row_no INTEGER, cells TEXT, PRIMARY KEY (sheet, row_no))")
+            conn.execute("CREATE TABLE IF NOT EXISTS mirror_sheets (sheet TEXT PRIMARY KEY, present INTEGER, n_rows INTEGER, synced_at REAL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS mirror_meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._thread = threading.Thread(target=self._run, name="sheet-mirror", daemon=True)
+        self._thread.start()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    @property
+    def offline(self):
+        return self.offline_since is not None
+
+    def sheets(self):
+        """ミラーしているシートの {シート名: (シートがあるか, 行数, 同期した時刻)}"""
+        with self._connect() as conn:
+            return {r[0]: r[1:] for r in conn.execute("SELECT sheet, present, n_rows, synced_at FROM mirror_sheets")}
+
+    def _sync_first(self, title):
+        """
+        まだミラーしていないシートをその場で同期する。接続できなければ unsynced に残して False
+        （オフラインで起動した時も、画面は空のシートとして動き続けられるように）
+        """
+        try:
+            self.sync([title])
+        except Exception as e:
+            if not is_retryable_write_error(e):
+                raise
+            with self._cond:
+                self.unsynced.add(title)
+            return False
+        return True
 
-from googleapiclient.http import MediaIoBaseUpload
-import io
-from googleapiclient.discovery import build
+    def _ensure_fresh(self, title):
+        """
+        初めて読むシートはその場で同期し、書き込み直後のシートは裏の同期を read_wait 秒まで待つ。
+        接続できず一度も写せていなければ False
+        """
+        if title not in self.sheets():
+            return self._sync_first(title)
+        with self._cond:
+            if title in self._dirty and not self.offline:
+                self._cond.wait_for(lambda: title not in self._dirty, timeout=self.read_wait)
+        return True
 
-import requests
-import base64
+    def has_sheet(self, title):
+        """シートがあるか（まだミラーしていないシートはその場で同期して確かめる。確かめられなければ False）"""
+        if not self._ensure_fresh(title):
+            return False
+        return bool(self.sheets()[title][0])
+
+    def last_synced(self):
+        """いずれかのシートを最後に同期した時刻（一度も同期していなければ None）"""
+        with self._connect() as conn:
+            return conn.execute("SELECT MAX(synced_at) FROM mirror_sheets WHERE present = 1").fetchone()[0]
+
+    def mark_dirty(self, title):
+        with self._cond:
+            self._marks += 1
+            self._dirty[title] = self._marks
+        self._wake.set()
+
+    def records(self, title):
+        """
+        get_all_records と同じ形のレコードを返す。初めて読むシートはその場で同期し、
+        書き込み直後のシートは裏の同期を read_wait 秒まで待つ（接続できない時は前回の内容）
+        """
+        if not self._ensure_fresh(title):
+            return []
+        with self._connect() as conn:
+            rows = [json.loads(r[0]) for r in conn.execute(
+                "SELECT cells FROM mirror_rows WHERE sheet = ? ORDER BY row_no", (title,)
+            )]
+        if len(rows) < 2:
+            return []
+        keys = rows[0]
+        return [dict(zip(keys, gspread.utils.numericise_all(row))) for row in rows[1:]]
+
+    def _apply(self, conn, title, values):
+        """1枚分の値（values=None はシートがない）を書き込み、内容が変わったかを返す"""
+        old = dict(conn.execute("SELECT row_no, cells FROM mirror_rows WHERE sheet = ?", (title,)).fetchall())
+        prev = conn.execute("SELECT present FROM mirror_sheets WHERE sheet = ?", (title,)).fetchone()
+        rows = gspread.utils.fill_gaps(values) if values else []
+        changed = [
+            (title, i, cells) for i, cells in
+            ((i, json.dumps(row, ensure_ascii=False)) for i, row in enumerate(rows, start=1))
+            if old.get(i) != cells
+        ]
+        conn.executemany("INSERT OR REPLACE INTO mirror_rows (sheet, row_no, cells) VALUES (?, ?, ?)", changed)
+        removed = conn.execute("DELETE FROM mirror_rows WHERE sheet = ? AND row_no > ?", (title, len(rows))).rowcount
+        conn.execute(
+            "INSERT OR REPLACE INTO mirror_sheets (sheet, present, n_rows, synced_at) VALUES (?, ?, ?, ?)",
+            (title, int(values is not None), len(rows), time.time())
+        )
+        self.stats["rows_written"] += len(changed) + removed
+        return bool(changed or removed) or prev is None or prev[0] != int(values is not None)
+
+    def sync(self, titles, check_modified=False):
+        """
+        titles のシートを1回の batchGet で取り直す。check_modified=True なら、
+        スプレッドシートの更新日時が前回と同じ時は何も読まない。戻り値は内容が変わったシート
+        """
+        with self._lock:
+            t0 = time.perf_counter()
+            # 読み始める前の書き込みだけを「取り直した」扱いにする（読んでいる最中の書き込みは次の同期で拾う）
+            with self._cond:
+                marks = {t: self._dirty.get(t) for t in titles}
+            try:
+                spreadsheet = self.session.spreadsheet()
+                modified = None
+                if check_modified:
+                    self.stats["checks"] += 1
+                    modified = spreadsheet.get_lastUpdateTime()
+                    with self._connect() as conn:
+                        row = conn.execute("SELECT value FROM mirror_meta WHERE key = 'modified'").fetchone()
+                    if row is not None and row[0] == modified:
+                        self._synced(titles, t0, marks)
+                        return []
+                existing = {ws.title for ws in spreadsheet.worksheets()}
+                present = [t for t in titles if t in existing]
+                value_ranges = []
+                if present:
+                    ranges = [gspread.utils.absolute_range_name(t) for t in present]
+                    value_ranges = spreadsheet.values_batch_get(ranges).get("valueRanges", [])
+            except Exception as e:
+                self.stats["last_error"] = str(e)
+                if is_retryable_write_error(e) and self.offline_since is None:
+                    self.offline_since = time.time()
+                raise
+            fetched = dict(zip(present, (vr.get("values", []) for vr in value_ranges)))
+            with self._connect() as conn:
+                changed = [t for t in titles if self._apply(conn, t, fetched.get(t))]
+                if modified is not None:
+                    conn.execute("INSERT OR REPLACE INTO mirror_meta (key, value) VALUES ('modified', ?)", (modified,))
+            for title in changed:
+                # ここで進めた revision でミラーを汚れ扱いにはしない（取り直したばかりなので）
+                self.session.bump_revision(title, mirror_stale=False)
+            self._synced(titles, t0, marks)
+            return changed
+
+    def _synced(self, titles, t0, marks):
+        self.offline_since = None
+        self.stats["syncs"] += 1
+        self.stats["last_sync_ms"] = (time.perf_counter() - t0) * 1000
+        with self._cond:
+            for title in titles:
+                if title in self._dirty and self._dirty[title] == marks.get(title):
+                    del self._dirty[title]
+            self.unsynced.difference_update(titles)
+            self._cond.notify_all()
+
+    def _run(self):
+        next_check = 0.0  # 起動直後に1回確かめる
+        while True:
+            self._wake.wait(timeout=max(0.0, next_check - time.time()))
+            self._wake.clear()
+            with self._cond:
+                dirty = sorted(set(self._dirty) | self.unsynced)
+            due = time.time() >= next_check
+            if not dirty and not due:
+                continue
+            try:
+                with sheet_call_context("ミラー同期", "background"):
+                    if dirty:
+                        # このアプリが書き込んだシートと、オフラインで写せなかったシートは、更新日時を見ずにそのシートだけ読む
+                        self.sync(dirty)
+                    titles = sorted(self.sheets())
+                    if due and titles:
+                        self.sync(titles, check_modified=True)
+            except Exception:
+                # 接続できない間は間隔を空けて試し続ける（画面は前回の内容で動く）
+                with self._cond:
+                    self._cond.notify_all()
+                time.sleep(min(self.interval, 10))
+            if due:
+                next_check = time.time() + self.interval
+
+@st.cache_resource
+def get_sheet_mirror():
+    session = get_sheet_session()
+    mirror = SheetMirror(MIRROR_DB_PATH, session, float(st.secrets.get("MIRROR_SYNC_INTERVAL", MIRROR_SYNC_INTERVAL)))
+    session.mirror = mirror
+    return mirror
+
+@st.cache_data(ttl=600, show_spinner=False)
+def _fetch_sheet_df(title, revision):
+    """シート全体をDataFrameで取得する（ローカルのミラーから読み、revisionが変わるまでは読み直さない。シートがなければ空）"""
+    data = pd.DataFrame(get_sheet_mirror().records(title))
+    # 取得ごとの目印（TTL切れで取り直した時も、派生インデックスが差分を取り込めるように）
+    data.attrs["fetched_at"] = time.time()
+    return data
+
+def load_karte_df():
+    """カルテシートをキャッシュ付きで読み込む"""
+    return _fetch_sheet_df("カルテ", get_sheet_session().revisions.get("カルテ", 0))
+
+# --- カルテの保存（商品名 → 行番号の索引を持ち、1商品を1回の書き込みで保存する） ---
+KARTE_ID_COL = "商品ID"
+KARTE_HEADER = ["新規", "更新", "作成者", "ジャンル", "アイテムタイプ", "商品名", "全成分", "公式情報", "ポップ案", "メモ", "画像URL", KARTE_ID_COL]
+# 既存の行を更新する時に書き換えない列（ポップ案はAIポップ作成から、新規と商品IDは最初の登録時だけ書く）
+KARTE_KEEP_ON_UPDATE = {"新規", "ポップ案", KARTE_ID_COL}
+
+# 同名の商品が複数行ある時は最初の行を使う（編集画面の表示・索引・保存・画像表示のすべてで同じ行）
+KARTE_DUPLICATE_ROW = "first"
+
+def karte_primary_rows(karte_df):
+    """商品名ごとに1行だけ残したカルテ（同名の行は KARTE_DUPLICATE_ROW の行。index は元のまま）"""
+    if "商品名" not in karte_df.columns:
+        return karte_df.iloc[0:0]
+    named = karte_df[karte_df["商品名"].astype("string").fillna("") != ""]
+    return named.drop_duplicates(subset="商品名", keep=KARTE_DUPLICATE_ROW)
+
+class KarteConflictError(Exception):
+    """保存しようとした商品が、編集を始めた後に他の人に更新されていた"""
+
+    def __init__(self, name, current_updated=None):
+        if current_updated is None:
+            super().__init__(f"「{name}」の行の位置が変わっています。画面を更新してから保存し直してください")
+        else:
+            super().__init__(f"「{name}」は編集中に更新されています（最終更新: {current_updated}）")
+        self.name = name
+        self.current_updated = current_updated
+
+class KarteIndexStaleError(KeyError):
+    """索引にない商品への書き込み。索引を捨ててシートから作り直し、書き込みは再試行する"""
+
+def new_product_id():
+    return "P" + uuid.uuid4().hex[:10]
+
+class KarteRepository:
+    """
+    カルテシートの 商品名 → 行番号・商品ID・更新日時 の索引。
+    索引はキャッシュ済みのカルテから作り、保存のたびにシートを読み直さない
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.headers = []
+        self.row_of = {}
+        self.id_of = {}
+        self.updated_of = {}
+        self.names = []  # シートの2行目以降の商品名（行の順）
+        self.synced_with = None
+
+    def sync(self, karte_df):
+        """カルテのDataFrame（get_all_records の結果。行 i はシートの i+2 行目）から索引を作り直す"""
+        token = karte_df.attrs.get("fetched_at")
+        with self._lock:
+            if token is not None and token == self.synced_with:
+                return
+            self.headers = list(karte_df.columns)
+            self.row_of, self.id_of, self.updated_of = {}, {}, {}
+            frame = karte_df.reset_index(drop=True)
+            primary = karte_primary_rows(frame)
+            for i, row in zip(primary.index, primary.to_dict("records")):
+                name = row["商品名"]
+                self.row_of[name] = i + 2
+                self.updated_of[name] = str(row.get("更新", ""))
+                if row.get(KARTE_ID_COL):
+                    self.id_of[name] = str(row[KARTE_ID_COL])
+            self.names = list(karte_df["商品名"]) if "商品名" in karte_df.columns else [""] * len(karte_df)
+            self.synced_with = token
+
+    def sync_from_sheet(self, sheet):
+        """見出し行と 商品名・更新・商品ID 列だけをシートから読んで索引を作る（キャッシュ済みのカルテがない時用）"""
+        with self._lock:
+            headers = sheet.row_values(1)
+            cols = [c for c in ("商品名", "更新", KARTE_ID_COL) if c in headers]
+            ranges = []
+            for c in cols:
+                letter = re.sub(r"\d+", "", gspread.utils.rowcol_to_a1(1, headers.index(c) + 1))
+                ranges.append(f"{letter}2:{letter}")
+            columns = [[row[0] if row else "" for row in values] for values in sheet.batch_get(ranges)] if ranges else []
+            n_rows = max((len(v) for v in columns), default=0)
+            frame = pd.DataFrame("", index=range(n_rows), columns=headers)
+            for c, values in zip(cols, columns):
+                frame[c] = values + [""] * (n_rows - len(values))
+            frame.attrs["fetched_at"] = f"sheet:{time.time()}"
+            self.sync(frame)
+
+    def invalidate(self):
+        with self._lock:
+            self.synced_with = None
+
+    def _ensure_headers(self, sheet):
+        if not self.headers:
+            self.headers = sheet.row_values(1) or list(KARTE_HEADER)
+
+    def ensure_id_column(self, sheet):
+        """商品ID列がなければ末尾に追加し、既存の全行にIDを振る（1回のbatch_update）"""
+        with self._lock:
+            self._ensure_headers(sheet)
+            if KARTE_ID_COL in self.headers:
+                return
+            col = len(self.headers) + 1
+            if sheet.col_count < col:
+                sheet.add_cols(col - sheet.col_count)
+            for name in self.row_of:
+                self.id_of.setdefault(name, new_product_id())
+            # 同名の行には同じIDを振る
+            ids = [[self.id_of.get(name, "")] for name in self.names]
+            updates = [{"range": gspread.utils.rowcol_to_a1(1, col), "values": [[KARTE_ID_COL]]}]
+            if ids:
+                updates.append({
+                    "range": f"{gspread.utils.rowcol_to_a1(2, col)}:{gspread.utils.rowcol_to_a1(len(ids) + 1, col)}",
+                    "values": ids,
+                })
+            sheet.batch_update(updates)
+            self.headers.append(KARTE_ID_COL)
+
+    def _column_ranges(self, row, record, skip):
+        """record の列をシートの列順に並べ、連続する列ごとに1つの範囲にまとめる"""
+        cols = [(self.headers.index(c) + 1, record[c]) for c in self.headers if c in record and c not in skip]
+        updates, start, values = [], None, []
+        for col, value in cols:
+            if start is not None and col == start + len(values):
+                values.append(value)
+                continue
+            if values:
+                updates.append((start, values))
+            start, values = col, [value]
+        if values:
+            updates.append((start, values))
+        return [
+            {"range": f"{gspread.utils.rowcol_to_a1(row, c)}:{gspread.utils.rowcol_to_a1(row, c + len(v) - 1)}", "values": [v]}
+            for c, v in updates
+        ]
+
+    def _check_conflict(self, sheet, name, row, expected_updated):
+        """シート上の行がまだ同じ商品で、更新日時が編集開始時のままかを確かめる（2セルだけ読む）"""
+        name_a1 = gspread.utils.rowcol_to_a1(row, self.headers.index("商品名") + 1)
+        ranges = [name_a1]
+        if "更新" in self.headers and expected_updated is not None:
+            ranges.append(gspread.utils.rowcol_to_a1(row, self.headers.index("更新") + 1))
+        cells = [vr[0][0] if vr and vr[0] else "" for vr in sheet.batch_get(ranges)]
+        if cells[0] != name:
+            # 行の削除・並べ替えで位置がずれた。索引を作り直してもらう
+            self.invalidate()
+            raise KarteConflictError(name)
+        if len(cells) > 1 and cells[1] != str(expected_updated):
+            raise KarteConflictError(name, cells[1])
+
+    def upsert(self, sheet, record, expected_updated=None, force=False):
+        """
+        record（列名 → 値）を保存する。既存の商品は1回のbatch_update、新しい商品は1回のappend_row。
+        expected_updated（編集開始時の「更新」）とシートの値が違えば KarteConflictError（force=True なら上書き）。
+        戻り値は "updated" か "created"
+        """
+        name = record["商品名"]
+        with self._lock:
+            self.ensure_id_column(sheet)
+            row = self.row_of.get(name)
+            if row is None:
+                record = {**record, KARTE_ID_COL: self.id_of.get(name) or new_product_id()}
+                res = sheet.append_row([record.get(h, "") for h in self.headers])
+                updated_range = (res or {}).get("updates", {}).get("updatedRange", "")
+                m = re.search(r"![A-Z]+(\d+)", updated_range)
+                row = int(m.group(1)) if m else len(self.names) + 2
+                self.names += [""] * (row - 2 - len(self.names)) + [name]
+                self.row_of[name] = row
+                self.id_of[name] = record[KARTE_ID_COL]
+                self.updated_of[name] = str(record.get("更新", ""))
+                return "created"
+            if not force:
+                self._check_conflict(sheet, name, row, expected_updated)
+            sheet.batch_update(self._column_ranges(row, record, KARTE_KEEP_ON_UPDATE))
+            self.updated_of[name] = str(record.get("更新", ""))
+            return "updated"
+
+    def bulk_upsert(self, sheet, records, chunk_size=500):
+        """
+        一括インポート用。既存の商品は範囲をまとめて batch_update、新しい商品は append_rows で、
+        どちらも chunk_size 件ずつ1リクエストにする（競合チェックはしない＝取込ファイルの内容で上書き）。
+        戻り値は {"updated", "created", "requests"}
+        """
+        with self._lock:
+            self.ensure_id_column(sheet)
+            updates, updated, new_rows = [], 0, []
+            for record in records:
+                row = self.row_of.get(record["商品名"])
+                if row is None:
+                    new_rows.append({**record, KARTE_ID_COL: self.id_of.get(record["商品名"]) or new_product_id()})
+                else:
+                    updates.append(self._column_ranges(row, record, KARTE_KEEP_ON_UPDATE))
+                    updated += 1
+            requests = 0
+            for i in range(0, len(updates), chunk_size):
+                sheet.batch_update([r for ranges in updates[i:i + chunk_size] for r in ranges])
+                requests += 1
+            for i in range(0, len(new_rows), chunk_size):
+                chunk = new_rows[i:i + chunk_size]
+                res = sheet.append_rows([[r.get(h, "") for h in self.headers] for r in chunk])
+                requests += 1
+                m = re.search(r"![A-Z]+(\d+)", (res or {}).get("updates", {}).get("updatedRange", ""))
+                start = int(m.group(1)) if m else len(self.names) + 2
+                self.names += [""] * (start - 2 - len(self.names))
+                for offset, r in enumerate(chunk):
+                    self.names.append(r["商品名"])
+                    self.row_of[r["商品名"]] = start + offset
+                    self.id_of[r["商品名"]] = r[KARTE_ID_COL]
+            for record in records:
+                self.updated_of[record["商品名"]] = str(record.get("更新", ""))
+            return {"updated": updated, "created": len(new_rows), "requests": requests}
+
+    def update_fields(self, sheet, name, fields):
+        """登録済みの商品の一部の列だけを1回のbatch_updateで書く（ポップ案の保存など）"""
+        with self._lock:
+            self._ensure_headers(sheet)
+            if not self._rows_match(sheet, [name]):
+                self.sync_from_sheet(sheet)
+            row = self.row_of.get(name)
+            if row is None:
+                self.invalidate()
+                raise KarteIndexStaleError(name)
+            missing = [c for c in fields if c not in self.headers]
+            if missing:
+                raise ValueError(f"「{'」「'.join(missing)}」列が見つかりません。")
+            sheet.batch_update(self._column_ranges(row, fields, ()))
+
+    def _rows_match(self, sheet, names):
+        """names がすべて索引にあり、索引の行にまだその商品名があるか（商品名のセルだけを1回で読む）"""
+        if any(name not in self.row_of for name in names):
+            return False
+        if "商品名" not in self.headers or not names:
+            return True
+        col = self.headers.index("商品名") + 1
+        cells = sheet.batch_get([gspread.utils.rowcol_to_a1(self.row_of[name], col) for name in names])
+        return all((vr[0][0] if vr and vr[0] else "") == name for name, vr in zip(names, cells))
+
+    def update_fields_many(self, sheet, fields_by_name):
+        """
+        複数の商品の一部の列を1回のbatch_updateで書く（ポップ案の一括保存など）。行は書く時に索引から引き、
+        索引にない商品があればシートから索引を作り直して引き直す。戻り値は {"updated", "missing"}
+        """
+        with self._lock:
+            self._ensure_headers(sheet)
+            missing_cols = sorted({c for fields in fields_by_name.values() for c in fields if c not in self.headers})
+            if missing_cols:
+                raise ValueError(f"「{'」「'.join(missing_cols)}」列が見つかりません。")
+            if not self._rows_match(sheet, list(fields_by_name)):
+                self.sync_from_sheet(sheet)
+            updates = [
+                r for name, fields in fields_by_name.items() if name in self.row_of
+                for r in self._column_ranges(self.row_of[name], fields, ())
+            ]
+            if updates:
+                sheet.batch_update(updates)
+            return {
+                "updated": sum(name in self.row_of for name in fields_by_name),
+                "missing": [name for name in fields_by_name if name not in self.row_of],
+            }
+
+# 一括インポートで受け付ける列（商品名・ジャンル以外は任意。ファイルにない列は既存の値を残す）
+KARTE_IMPORT_COLS = ["ジャンル", "アイテムタイプ", "商品名", "全成分", "公式情報", "画像URL", "メモ", "作成者"]
+KARTE_IMPORT_CHUNK = 500
+
+def read_karte_import(data, filename):
+    """CSV・JSONL（1行1商品）・JSON（商品の配列）のバイト列をDataFrameにする（値はすべて文字列）"""
+    name = filename.lower()
+    if name.endswith((".jsonl", ".ndjson")):
+        frame = pd.read_json(BytesIO(data), lines=True, dtype=False)
+    elif name.endswith(".json"):
+        frame = pd.read_json(BytesIO(data), orient="records", dtype=False)
+    else:
+        frame = pd.read_csv(BytesIO(data), dtype=str, keep_default_na=False, encoding="utf-8-sig")
+    frame.columns = [str(c).strip() for c in frame.columns]
+    return frame.fillna("").astype(str).apply(lambda col: col.str.strip())
+
+def validate_karte_import(frame, column_config):
+    """
+    取込データを商品構成（COLUMN_CONFIG）のジャンル・アイテムタイプと照らし合わせる。
+    戻り値は (取り込める行のDataFrame, [(ファイルの行番号, 理由), ...], 重複で捨てた件数)。
+    同じ商品名が複数ある場合は最後の行を使う
+    """
+    errors = []
+    missing = [c for c in ("商品名", "ジャンル") if c not in frame.columns]
+    if missing:
+        return frame.iloc[0:0], [(0, f"「{c}」列がありません") for c in missing], 0
+    frame = frame[[c for c in KARTE_IMPORT_COLS if c in frame.columns]]
+    valid = pd.Series(True, index=frame.index)
+    for i, rec in zip(frame.index, frame.to_dict("records")):
+        genres = [g.strip() for g in rec.get("ジャンル", "").split("/") if g.strip()]
+        types = [t.strip() for t in rec.get("アイテムタイプ", "").split("/") if t.strip()]
+        unknown = [g for g in genres if g not in column_config]
+        allowed = {t for g in genres if g in column_config for t in column_config[g]["types"]}
+        bad_types = [t for t in types if genres and t not in allowed]
+        reason = None
+        if not rec["商品名"]:
+            reason = "商品名が空です"
+        elif not genres:
+            reason = "ジャンルが空です"
+        elif unknown:
+            reason = f"未登録のジャンル: {'、'.join(unknown)}"
+        elif bad_types:
+            reason = f"ジャンルにないアイテムタイプ: {'、'.join(bad_types)}"
+        if reason:
+            errors.append((i + 2, reason))  # ヘッダーの次の行を2行目とする
+            valid[i] = False
+    accepted = frame[valid]
+    deduped = accepted.drop_duplicates(subset="商品名", keep="last")
+    return deduped, errors, len(accepted) - len(deduped)
+
+def export_karte(karte_df, fmt="csv", chunk_rows=1000):
+    """カルテを CSV（Excelで開けるBOM付きUTF-8、chunk_rows 行ずつ書き出す）か Parquet のバイト列にする"""
+    buf = BytesIO()
+    if fmt == "parquet":
+        karte_df.astype(str).to_parquet(buf, index=False)
+        return buf.getvalue()
+    buf.write("\ufeff".encode("utf-8"))
+    for start in range(0, max(len(karte_df), 1), chunk_rows):
+        buf.write(karte_df.iloc[start:start + chunk_rows].to_csv(index=False, header=(start == 0)).encode("utf-8"))
+    return buf.getvalue()
+
+def parquet_available():
+    return importlib.util.find_spec("pyarrow") is not None
+
+@st.cache_resource
+def get_karte_repository():
+    return KarteRepository()
+
+def karte_repository_for(karte_df):
+    """カルテのDataFrameに追従した索引を返す"""
+    repo = get_karte_repository()
+    repo.sync(karte_df)
+    return repo
+
+# --- シートへの書き込み待ち行列（バックグラウンドで反映し、失敗は指数バックオフで再試行） ---
+WRITE_QUEUE_DB_PATH = os.path.join(LOCAL_CACHE_DIR, "write_queue.sqlite")
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+def is_retryable_write_error(e):
+    """クォータ超過（429）・サーバーエラー（5xx）・通信エラー・索引の作り直し待ちなら再試行する"""
+    if isinstance(e, KarteIndexStaleError):
+        return True
+    if isinstance(e, gspread.exceptions.APIError):
+        return getattr(e, "code", None) in RETRYABLE_STATUS
+    return isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+class SheetWriteQueue:
+    """
+    シートへの書き込みをSQLiteに積み、バックグラウンドのワーカーがシートごとに古い順に反映する。
+    同じシートの末尾にある同じ種類の書き込み（batch_update・append_rows・同じ商品の列更新など）は1回にまとめる。
+    書き込み待ちはファイルに残るので、アプリを再起動しても失われない
+    """
+
+    def __init__(self, path, session, handlers, base_delay=2.0, max_delay=300.0, max_attempts=8):
+        self.path = path
+        self.session = session
+        self.handlers = handlers
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.stats = {"flushed": 0, "retries": 0, "last_flush_ms": None, "last_error": ""}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._waiters = {}  # 書き込みID → 完了を待っている画面の {"event", "result", "error"}
+        self._inflight = None
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS pending_writes ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, sheet TEXT, kind TEXT, coalesce_key TEXT, payload TEXT, "
+                "status TEXT DEFAULT 'pending', attempts INTEGER DEFAULT 0, next_at REAL DEFAULT 0, "
+                "last_error TEXT DEFAULT '', created REAL, origin TEXT DEFAULT '')"
+            )
+            # origin 列がない古い待ち行列ファイルにも列を足す
+            if "origin" not in {row[1] for row in conn.execute("PRAGMA table_info(pending_writes)")}:
+                conn.execute("ALTER TABLE pending_writes ADD COLUMN origin TEXT DEFAULT ''")
+        self._thread = threading.Thread(target=self._run, name="sheet-write-queue", daemon=True)
+        self._thread.start()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    @staticmethod
+    def coalesce_key(kind, payload):
+        if kind in ("batch_update", "append_rows", "replace_all"):
+            return kind
+        if kind == "karte_fields":
+            return f"{kind}:{payload['name']}"
+        if kind == "karte_fields_many":
+            return kind
+        return None
+
+    @staticmethod
+    def merge(kind, old, new):
+        """同じシートに続けて積まれた書き込みを1つにまとめる（後から積まれた値を優先）"""
+        if kind == "batch_update":
+            merged = {u["range"]: u for u in old["updates"] + new["updates"]}
+            return {"updates": list(merged.values())}
+        if kind == "append_rows":
+            return {"rows": old["rows"] + new["rows"]}
+        if kind == "karte_fields":
+            return {"name": new["name"], "fields": {**old["fields"], **new["fields"]}}
+        if kind == "karte_fields_many":
+            merged = {name: dict(fields) for name, fields in old["fields_by_name"].items()}
+            for name, fields in new["fields_by_name"].items():
+                merged[name] = {**merged.get(name, {}), **fields}
+            return {"fields_by_name": merged}
+        return new  # replace_all は最後の内容だけを書けばよい
+
+    def submit(self, sheet, kind, payload, wait=False):
+        """書き込みを積んで書き込みIDを返す。wait=True なら wait() で完了を待てるようにしておく"""
+        key = self.coalesce_key(kind, payload)
+        with self._lock, self._connect() as conn:
+            tail = conn.execute(
+                "SELECT id, coalesce_key, payload FROM pending_writes WHERE sheet = ? AND status = 'pending' ORDER BY id DESC LIMIT 1",
+                (sheet,)
+            ).fetchone()
+            if key is not None and tail is not None and tail[1] == key and tail[0] != self._inflight:
+                op_id = tail[0]
+                merged = self.merge(kind, json.loads(tail[2]), payload)
+                conn.execute("UPDATE pending_writes SET payload = ? WHERE id = ?", (json.dumps(merged, ensure_ascii=False), op_id))
+            else:
+                op_id = conn.execute(
+                    "INSERT INTO pending_writes (sheet, kind, coalesce_key, payload, created, origin) VALUES (?, ?, ?, ?, ?, ?)",
+                    (sheet, kind, key, json.dumps(payload, ensure_ascii=False), time.time(), current_sheet_call_context()[0])
+                ).lastrowid
+            if wait:
+                self._waiters.setdefault(op_id, {"event": threading.Event(), "result": None, "error": None})
+        self._wake.set()
+        return op_id
+
+    def wait(self, op_id, timeout):
+        """
+        書き込みの完了を最大 timeout 秒待つ。戻り値は (完了したか, ハンドラの戻り値)。
+        再試行しても直らないエラー（競合など）はそのまま送出する
+        """
+        waiter = self._waiters.get(op_id)
+        if waiter is None:
+            return False, None
+        waiter["event"].wait(timeout)
+        with self._lock:
+            # 待つのをやめた書き込みは、失敗したら行列に「失敗」として残す
+            self._waiters.pop(op_id, None)
+        if not waiter["event"].is_set():
+            return False, None
+        if waiter["error"] is not None:
+            raise waiter["error"]
+        return True, waiter["result"]
+
+    def _next_op(self, conn):
+        """各シートで一番古い書き込みのうち、再試行の時刻を過ぎたもの（シートごとの順序を守る）"""
+        return conn.execute(
+            "SELECT id, sheet, kind, payload, attempts, origin FROM pending_writes p WHERE status = 'pending' AND next_at <= ? "
+            "AND id = (SELECT MIN(id) FROM pending_writes q WHERE q.sheet = p.sheet AND q.status = 'pending') "
+            "ORDER BY id LIMIT 1",
+            (time.time(),)
+        ).fetchone()
+
+    def _run(self):
+        while True:
+            self._wake.wait(timeout=1.0)
+            self._wake.clear()
+            try:
+                while self._flush_one():
+                    pass
+            except Exception as e:
+                # ワーカー自体は止めない（SQLiteのロック待ちなど）
+                self.stats["last_error"] = str(e)
+
+    def _flush_one(self):
+        with self._lock, self._connect() as conn:
+            op = self._next_op(conn)
+            if op is None:
+                return False
+            self._inflight = op[0]
+            # 画面で反映を待っている書き込みは、画面の読み込みと同じ優先度で API を使う
+            priority = "interactive" if op[0] in self._waiters else "background"
+        op_id, sheet, kind, payload, attempts, origin = op
+        t0 = time.perf_counter()
+        result, error = None, None
+        try:
+            with sheet_call_context(origin or "書き込み待ち行列", priority):
+                result = self.handlers[kind](self.session.worksheet(sheet), json.loads(payload))
+        except Exception as e:
+            error = e
+        with self._lock, self._connect() as conn:
+            self._inflight = None
+            waiter = self._waiters.get(op_id)
+            if error is None:
+                conn.execute("DELETE FROM pending_writes WHERE id = ?", (op_id,))
+                self.session.bump_revision(sheet)
+                self.stats["flushed"] += 1
+                self.stats["last_flush_ms"] = (time.perf_counter() - t0) * 1000
+            elif is_retryable_write_error(error) and attempts + 1 < self.max_attempts:
+                delay = min(self.base_delay * 2 ** attempts, self.max_delay) * (0.5 + random.random())
+                conn.execute(
+                    "UPDATE pending_writes SET attempts = ?, next_at = ?, last_error = ? WHERE id = ?",
+                    (attempts + 1, time.time() + delay, str(error), op_id)
+                )
+                self.stats["retries"] += 1
+                self.stats["last_error"] = str(error)
+                return True
+            elif waiter is not None:
+                # 画面で待っている書き込みの失敗（競合など）は、画面側で扱うので行列には残さない
+                conn.execute("DELETE FROM pending_writes WHERE id = ?", (op_id,))
+            else:
+                conn.execute("UPDATE pending_writes SET status = 'failed', last_error = ? WHERE id = ?", (str(error), op_id))
+                self.stats["last_error"] = str(error)
+            if waiter is not None:
+                waiter["result"], waiter["error"] = result, error
+                waiter["event"].set()
+        return True
+
+    def depth(self):
+        """(書き込み待ちの件数, 失敗して止まっている件数)"""
+        with self._connect() as conn:
+            rows = dict(conn.execute("SELECT status, COUNT(*) FROM pending_writes GROUP BY status").fetchall())
+        return rows.get("pending", 0), rows.get("failed", 0)
+
+    def failed(self):
+        with self._connect() as conn:
+            return pd.read_sql("SELECT id, sheet, kind, attempts, last_error, created FROM pending_writes WHERE status = 'failed'", conn)
+
+    def retry_failed(self):
+        with self._lock, self._connect() as conn:
+            conn.execute("UPDATE pending_writes SET status = 'pending', attempts = 0, next_at = 0 WHERE status = 'failed'")
+        self._wake.set()
+
+    def discard_failed(self):
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM pending_writes WHERE status = 'failed'")
+
+def _delete_row_with_value(sheet, payload):
+    cell = sheet.find(payload["value"], in_column=payload.get("column"))
+    if cell:
+        sheet.delete_rows(cell.row)
+
+def _replace_all(sheet, payload):
+    sheet.clear()
+    sheet.update(range_name="A1", values=payload["values"])
+
+def sheet_write_handlers(repo):
+    """書き込みの種類 → (シート, payload) を受け取って書くハンドラ"""
+
+    def karte(write):
+        def run(sheet, p):
+            # 再起動直後は画面より先にワーカーが動くので、索引がなければシートから作る
+            if repo.synced_with is None:
+                repo.sync_from_sheet(sheet)
+            return write(sheet, p)
+        return run
+
+    return {
+        "batch_update": lambda sheet, p: sheet.batch_update(p["updates"]),
+        "append_rows": lambda sheet, p: sheet.append_rows(p["rows"]),
+        "delete_value": _delete_row_with_value,
+        "replace_all": _replace_all,
+        "karte_upsert": karte(lambda sheet, p: repo.upsert(sheet, p["record"], p.get("expected_updated"), p.get("force", False))),
+        "karte_bulk": karte(lambda sheet, p: repo.bulk_upsert(sheet, p["records"], p.get("chunk_size", 500))),
+        "karte_fields": karte(lambda sheet, p: repo.update_fields(sheet, p["name"], p["fields"])),
+        "karte_fields_many": karte(lambda sheet, p: repo.update_fields_many(sheet, p["fields_by_name"])),
+    }
+
+@st.cache_resource
+def get_write_queue():
+    return SheetWriteQueue(WRITE_QUEUE_DB_PATH, get_sheet_session(), sheet_write_handlers(get_karte_repository()))
+
+def check_sheets_writable():
+    """スプレッドシートに接続できず読み取り専用で動いている間は SheetsOfflineError"""
+    mirror = get_sheet_mirror()
+    if mirror.offline:
+        last = mirror.last_synced()
+        since = datetime.datetime.fromtimestamp(last).strftime("%H:%M") if last else "未同期"
+        raise SheetsOfflineError(f"スプレッドシートに接続できないため、読み取り専用で動いています（最終同期 {since}）")
+
+def ensure_sheet(title, initial_values, rows, cols):
+    """シートがなければ作り、見出しなどの最初の内容を書き込み待ち行列から書く"""
+    if get_sheet_mirror().has_sheet(title):
+        return
+    check_sheets_writable()
+    session = get_sheet_session()
+    session.add_worksheet(title, rows=rows, cols=cols)
+    # 最初の内容の書き込みが遅れても、次の再実行でシートを作り直そうとしないようミラーに知らせる
+    session.bump_revision(title)
+    queue_sheet_write(title, "replace_all", {"values": initial_values}, timeout=15)
+
+def queue_sheet_write(sheet, kind, payload, timeout=None):
+    """
+    書き込みを行列に積む。timeout を指定するとその秒数まで反映を待ち、(反映済みか, 結果) を返す。
+    反映されたシートのキャッシュはワーカーが無効化する。接続できない間は SheetsOfflineError
+    """
+    check_sheets_writable()
+    queue = get_write_queue()
+    op_id = queue.submit(sheet, kind, payload, wait=timeout is not None)
+    if timeout is None:
+        return False, None
+    return queue.wait(op_id, timeout)
+
+# --- 全成分の転置インデックス（成分 → 商品名） ---
+# 「1,3-ブチレングリコール」のような数字に挟まれたカンマでは区切らない
+INGREDIENT_SEPARATORS = re.compile(r"[・、/／\n\r\t]+|[,，](?![0-9０-９])|(?<![0-9０-９])[,，]")
+# カタカナに挟まれた（または末尾の）横棒・ハイフン類は長音「ー」にそろえる。
+# 「セラミド-NP」のように英数字が続くハイフンは区切りなのでそのまま残す
+_KANA_DASH = re.compile(r"(?<=[\u30A1-\u30FA])[-‐‑‒–—―−](?=[\u30A1-\u30FA]|$)")
+_VU_VARIANTS = {"ヴァ": "バ", "ヴィ": "ビ", "ヴェ": "ベ", "ヴォ": "ボ", "ヴ": "ブ"}
+
+INGREDIENT_SYNONYM_SHEET = "ingredient_synonyms"
+INGREDIENT_SYNONYM_HEADER = ["正規名", "別名"]
+# 同義語シートを新しく作る時の初期データ
+DEFAULT_INGREDIENT_SYNONYMS = [
+    ["セラミド", "セラミドNP"], ["セラミド", "セラミドAP"], ["セラミド", "セラミドEOP"], ["セラミド", "セラミドNG"],
+    ["セラミド", "セラミド2"], ["セラミド", "セラミド3"], ["セラミド", "ヒト型セラミド"],
+    ["コラーゲン", "水溶性コラーゲン"], ["コラーゲン", "加水分解コラーゲン"],
+    ["ヒアルロン酸", "ヒアルロン酸Na"], ["ヒアルロン酸", "ヒアルロン酸ナトリウム"], ["ヒアルロン酸", "加水分解ヒアルロン酸"],
+    ["ビタミンC誘導体", "アスコルビルグルコシド"], ["ビタミンC誘導体", "リン酸アスコルビルMg"],
+    ["BG", "1,3-ブチレングリコール"],
+]
+
+def normalize_ingredient(token):
+    """全角・半角、ひらがな・カタカナ、長音・ヴの表記揺れをそろえた成分名にする"""
+    text = re.sub(r"\s+", "", unicodedata.normalize("NFKC", str(token))).lower()
+    # ひらがな → カタカナ
+    text = "".join(chr(ord(c) + 0x60) if "\u3041" <= c <= "\u3096" else c for c in text)
+    text = _KANA_DASH.sub("ー", text)
+    for src, dst in _VU_VARIANTS.items():
+        text = text.replace(src, dst)
+    return text
+
+def tokenize_ingredients(text):
+    """全成分の文字列を「・」「、」「,」などで区切り、正規化した成分名のリストにする"""
+    if text is None or (isinstance(text, float) and pd.isna(text)):
+        return []
+    tokens = (normalize_ingredient(t) for t in INGREDIENT_SEPARATORS.split(str(text)))
+    return [t for t in tokens if t and t != "nan"]
+
+class IngredientNormalizer:
+    """正規化した成分名を、同義語シートに従って正規名にそろえる"""
+
+    def __init__(self, synonym_pairs=()):
+        self.aliases = {}
+        for canonical, alias in synonym_pairs:
+            canonical_n, alias_n = normalize_ingredient(canonical), normalize_ingredient(alias)
+            if canonical_n and alias_n:
+                self.aliases[alias_n] = canonical_n
+        self.key = tuple(sorted(self.aliases.items()))
+
+    def canonical(self, normalized_token):
+        return self.aliases.get(normalized_token, normalized_token)
+
+    def tokens(self, text):
+        return [self.canonical(t) for t in tokenize_ingredients(text)]
+
+class IngredientIndex:
+    """カルテの全成分から作る転置インデックス（正規名 → 商品名）。商品の追加・更新は差分だけ反映する"""
+
+    def __init__(self, normalizer=None):
+        self.normalizer = normalizer or IngredientNormalizer()
+        self.postings = collections.defaultdict(set)  # 正規名 → 商品名の集合
+        self.product_tokens = {}  # 商品名 → 正規名の集合
+        self.raw = {}  # 商品名 → 索引した時の全成分（変更の検出用）
+        self.synced_with = None
+        self.version = 0  # 中身が変わるたびに進める（派生テーブルの作り直し判定用）
+        # プロセス全体で共有するので、別セッションの同期と検索が混ざらないようにする
+        self.lock = threading.RLock()
+
+    def upsert(self, product, ingredients_text):
+        with self.lock:
+            self.remove(product)
+            tokens = set(self.normalizer.tokens(ingredients_text))
+            if tokens:
+                self.product_tokens[product] = tokens
+                for t in tokens:
+                    self.postings[t].add(product)
+            self.raw[product] = ingredients_text
+            self.version += 1
+
+    def remove(self, product):
+        with self.lock:
+            for t in self.product_tokens.pop(product, ()):
+                self.postings[t].discard(product)
+                if not self.postings[t]:
+                    del self.postings[t]
+            self.raw.pop(product, None)
+            self.version += 1
+
+    def sync(self, karte_df):
+        """カルテの内容と突き合わせ、全成分が変わった商品だけ索引し直す"""
+        token = karte_df.attrs.get("fetched_at")
+        with self.lock:
+            if token is not None and token == self.synced_with:
+                return
+            latest = {}
+            if {"商品名", "全成分"} <= set(karte_df.columns):
+                for name, text in zip(karte_df["商品名"], karte_df["全成分"]):
+                    if name:
+                        # 同名の行が複数ある場合は、すべての行の成分をまとめて索引する
+                        latest[name] = f"{latest[name]}・{text}" if name in latest else text
+            for name in set(self.raw) - set(latest):
+                self.remove(name)
+            for name, text in latest.items():
+                if self.raw.get(name) != text:
+                    self.upsert(name, text)
+            self.synced_with = token
+
+    def lookup(self, term):
+        """成分名（別名でも可）を含む商品名の集合。「・」等で区切られた複数成分はすべてを含む商品"""
+        result = None
+        with self.lock:
+            for t in self.normalizer.tokens(term):
+                hit = self.postings.get(t, set())
+                result = set(hit) if result is None else result & hit
+        return result or set()
+
+    def query(self, all_of=(), none_of=()):
+        """all_of の成分をすべて含み、none_of の成分を1つも含まない商品名の集合"""
+        with self.lock:
+            result = set(self.product_tokens) if not all_of else None
+            for term in all_of:
+                result = self.lookup(term) if result is None else result & self.lookup(term)
+            for term in none_of:
+                result -= self.lookup(term)
+        return result
+
+def load_ingredient_synonyms():
+    """同義語シートを [(正規名, 別名), ...] で返す（シートがなければ空）"""
+    data = _fetch_sheet_df(INGREDIENT_SYNONYM_SHEET, get_sheet_session().revisions.get(INGREDIENT_SYNONYM_SHEET, 0))
+    if not set(INGREDIENT_SYNONYM_HEADER) <= set(data.columns):
+        return []
+    return [(c, a) for c, a in zip(data["正規名"], data["別名"]) if str(c).strip() and str(a).strip()]
+
+@st.cache_resource
+def _ingredient_index_holder():
+    return {"index": IngredientIndex(), "lock": threading.Lock()}
+
+def ingredient_index_for(karte_df):
+    """カルテのDataFrameに追従した成分インデックスを返す（同義語が変わった時だけ全体を作り直す）"""
+    holder = _ingredient_index_holder()
+    normalizer = IngredientNormalizer(load_ingredient_synonyms())
+    with holder["lock"]:
+        if holder["index"].normalizer.key != normalizer.key:
+            holder["index"] = IngredientIndex(normalizer)
+        index = holder["index"]
+    index.sync(karte_df)
+    return index
+
+def load_master_df():
+    """成分・悩みマスタ（ingredient_master）をキャッシュ付きで読み込む"""
+    return _fetch_sheet_df("ingredient_master", get_sheet_session().revisions.get("ingredient_master", 0))
+
+# --- 全文検索（感想・カルテの自由記述を文字 bigram で索引する） ---
+KARTE_SEARCH_FIELDS = ["公式情報", "メモ", "ポップ案"]
+SURVEY_SEARCH_FIELD = "感想"
+
+def normalize_search_text(text):
+    """全角・半角と大文字・小文字をそろえる（検索語と本文の両方に使う）"""
+    return unicodedata.normalize("NFKC", str(text)).lower()
+
+def highlight_terms(text, query):
+    """本文中の検索語をマーカー表示にしたMarkdownを返す"""
+    text = str(text)
+    terms = sorted({t for t in normalize_search_text(query).split() if t}, key=len, reverse=True)
+    if not terms:
+        return text
+    pattern = re.compile("|".join(re.escape(t) for t in terms), re.IGNORECASE)
+    return pattern.sub(lambda m: f":orange-background[{m.group(0)}]", unicodedata.normalize("NFKC", text))
+
+def search_snippet(text, query, width=40):
+    """最初のヒットの前後 width 文字だけを切り出してハイライトする"""
+    text = unicodedata.normalize("NFKC", str(text))
+    norm = text.lower()
+    hits = [norm.find(t) for t in normalize_search_text(query).split() if t in norm]
+    if not hits:
+        return ""
+    start = max(0, min(hits) - width)
+    end = min(len(text), min(hits) + width * 2)
+    return ("…" if start else "") + highlight_terms(text[start:end], query) + ("…" if end < len(text) else "")
+
+class TextSearchIndex:
+    """
+    感想とカルテの自由記述から作る、文字 bigram の全文検索インデックス（分かち書き不要）。
+    文書は (ソース, キー) で持ち、データの世代が変わった時は本文が変わった文書だけ索引し直す
+    """
+
+    NGRAM = 2
+
+    def __init__(self):
+        self.postings = collections.defaultdict(lambda: collections.defaultdict(set))  # ソース → bigram → 内部IDの集合
+        self.ids = {}  # (ソース, キー) → 内部ID
+        self.docs = {}  # 内部ID → {"doc_id": (ソース, キー), "fields": 列名 → 本文, "grams": bigram の集合}
+        self.norms = {}  # 内部ID → 正規化した本文
+        self.doc_counts = collections.Counter()  # ソース → 文書数
+        self.synced_with = {}  # ソース → 索引した時のデータの世代
+        self.lock = threading.Lock()
+        self._next_id = 0
+
+    @classmethod
+    def grams(cls, norm):
+        if len(norm) < cls.NGRAM:
+            return {norm} if norm else set()
+        return {norm[i:i + cls.NGRAM] for i in range(len(norm) - cls.NGRAM + 1)}
+
+    def upsert(self, source, key, fields):
+        old = self.ids.get((source, key))
+        if old is not None and self.docs[old]["fields"] == fields:
+            return
+        self.remove(source, key)
+        norm = normalize_search_text("\n".join(v for v in fields.values() if v))
+        grams = self.grams(norm)
+        if not grams:
+            return
+        doc = self._next_id
+        self._next_id += 1
+        postings = self.postings[source]
+        for g in grams:
+            postings[g].add(doc)
+        self.ids[(source, key)] = doc
+        self.doc_counts[source] += 1
+        self.docs[doc] = {"doc_id": (source, key), "fields": fields, "grams": grams}
+        self.norms[doc] = norm
+
+    def remove(self, source, key):
+        doc = self.ids.pop((source, key), None)
+        if doc is None:
+            return
+        postings = self.postings[source]
+        for g in self.docs.pop(doc)["grams"]:
+            postings[g].discard(doc)
+            if not postings[g]:
+                del postings[g]
+        del self.norms[doc]
+        self.doc_counts[source] -= 1
+
+    def fields(self, doc_id):
+        """(ソース, キー) の文書の本文（列名 → 本文）"""
+        doc = self.ids.get(doc_id)
+        return self.docs[doc]["fields"] if doc is not None else {}
+
+    def sync(self, source, token, records):
+        """records（(キー, {列名: 本文}) の並び）と突き合わせ、増えた・変わった・消えた文書だけ反映する"""
+        with self.lock:
+            if token is not None and self.synced_with.get(source) == token:
+                return
+            seen = set()
+            for key, fields in records:
+                self.upsert(source, key, fields)
+                seen.add(key)
+            for src, key in [d for d in self.ids if d[0] == source and d[1] not in seen]:
+                self.remove(src, key)
+            self.synced_with[source] = token
+
+    def _candidates(self, postings, term):
+        """term の bigram をすべて含む文書（1文字の検索語は、その文字を含む bigram から集める）"""
+        if len(term) < self.NGRAM:
+            return set().union(*(docs for g, docs in postings.items() if term in g))
+        grams = sorted(self.grams(term), key=lambda g: len(postings.get(g, ())))
+        result = set(postings.get(grams[0], ()))
+        for g in grams[1:]:
+            result &= postings.get(g, set())
+            if not result:
+                break
+        if len(term) > self.NGRAM:
+            # bigram の一致だけでは語順が保証されないので、本文で確かめる
+            result = {d for d in result if term in self.norms[d]}
+        return result
+
+    def search(self, query, source=None, limit=50):
+        """
+        空白区切りの語をすべて含む文書を [((ソース, キー), スコア), ...] で返す（スコアの高い順）。
+        スコアは語ごとの出現回数 × 珍しさ（log(1 + 文書数 / ヒット数)）の合計
+        """
+        terms = list(dict.fromkeys(t for t in normalize_search_text(query).split() if t))
+        if not terms:
+            return []
+        with self.lock:
+            sources = [source] if source is not None else list(self.postings)
+            hits = []
+            for src in sources:
+                postings = self.postings.get(src, {})
+                n_docs = max(self.doc_counts[src], 1)
+                matched, weights = None, {}
+                for t in terms:
+                    cands = self._candidates(postings, t)
+                    weights[t] = math.log(1 + n_docs / max(len(cands), 1))
+                    matched = cands if matched is None else matched & cands
+                    if not matched:
+                        break
+                if not matched:
+                    continue
+                ids = np.fromiter(matched, dtype=np.int64, count=len(matched))
+                scores = np.zeros(len(ids))
+                for t, w in weights.items():
+                    scores += w * np.fromiter((self.norms[d].count(t) for d in ids.tolist()), dtype=float, count=len(ids))
+                lengths = np.fromiter((len(self.norms[d]) for d in ids.tolist()), dtype=float, count=len(ids))
+                # スコアの高い順、同点なら短い本文を先に
+                order = np.lexsort((lengths, -scores))
+                if limit:
+                    order = order[:limit]
+                hits.extend((self.docs[int(ids[k])]["doc_id"], float(scores[k])) for k in order)
+        if source is None:
+            hits.sort(key=lambda x: -x[1])
+        return hits[:limit] if limit else hits
+
+@st.cache_resource
+def _text_index_holder():
+    return {"index": TextSearchIndex()}
+
+def text_index_for(survey_df=None, survey_version=None, karte_df=None):
+    """渡されたデータ（アンケート・カルテ）に追従した全文検索インデックスを返す"""
+    index = _text_index_holder()["index"]
+    if survey_df is not None and SURVEY_SEARCH_FIELD in survey_df.columns:
+        texts = survey_df[SURVEY_SEARCH_FIELD]
+        texts = texts[texts.notna()].astype(str)
+        index.sync(SURVEY_SEARCH_FIELD, survey_version, (
+            (key, {SURVEY_SEARCH_FIELD: text}) for key, text in texts.items() if text.strip()
+        ))
+    if karte_df is not None and "商品名" in karte_df.columns:
+        fields = [c for c in KARTE_SEARCH_FIELDS if c in karte_df.columns]
+        latest = {}
+        for rec in karte_df[["商品名"] + fields].to_dict("records"):
+            name = rec.pop("商品名")
+            if not name:
+                continue
+            rec = {c: str(v) for c, v in rec.items() if v is not None and str(v).strip()}
+            # 同名の行が複数ある場合は、すべての行の本文をまとめて索引する
+            if name in latest:
+                rec = {c: "\n".join(filter(None, [latest[name].get(c), rec.get(c)])) for c in fields}
+                rec = {c: v for c, v in rec.items() if v}
+            latest[name] = rec
+        index.sync("カルテ", karte_df.attrs.get("fetched_at"), latest.items())
+    return index
+
+# --- おすすめ商品エンジン（悩み → 推奨成分 → 商品 の対応表を使ったベクトル演算） ---
+TROUBLE_COLS = ["肌悩み", "肌のお悩み（※複数選択可）"]
+RECOMMEND_COVERAGE_WEIGHT = 0.7  # 悩みのカバー率の重み（残りはアンケート満足度）
+RECOMMEND_COLUMNS = ["商品名", "きっかけ", "推奨成分", "アドバイス", "カバー数", "カバー率", "満足度", "推奨スコア"]
+MULTI_ANSWER_SEP = r",|、"  # 複数選択の回答の区切り
+
+def split_multi_answer(value):
+    """複数選択の回答（「乾燥, 毛穴」など）を1つずつに分ける"""
+    if value is None or (isinstance(value, float) and pd.isna(value)):
+        return []
+    return [v.strip() for v in re.split(MULTI_ANSWER_SEP, str(value)) if v.strip()]
+
+@st.cache_resource
+def _trouble_table_holder():
+    return {"key": None, "table": None, "lock": threading.Lock()}
+
+def trouble_product_table(master_df, index):
+    """悩みキーワード・推奨成分・アドバイス・商品名 の対応表（マスタか成分インデックスが変わった時だけ作り直す）"""
+    holder = _trouble_table_holder()
+    with holder["lock"]:
+        key = (master_df.attrs.get("fetched_at"), id(index), index.version)
+        if holder["key"] == key and holder["table"] is not None:
+            return holder["table"]
+        rows = []
+        if {"キーワード", "推奨成分"} <= set(master_df.columns):
+            phrases = master_df["理由・ポップ用フレーズ"] if "理由・ポップ用フレーズ" in master_df.columns else [""] * len(master_df)
+            for kw, ing, phrase in zip(master_df["キーワード"], master_df["推奨成分"], phrases):
+                kw, ing = str(kw).strip(), str(ing).strip()
+                if kw and ing and ing != "nan":
+                    rows.extend((kw, ing, phrase, product) for product in index.lookup(ing))
+        table = pd.DataFrame(rows, columns=["悩み", "推奨成分", "アドバイス", "商品名"]).drop_duplicates(subset=["悩み", "商品名"])
+        holder.update(key=key, table=table)
+        return table
+
+def segment_trouble_counts(target_df):
+    """ターゲット層の悩みを1つずつに分けて数える（多い順）"""
+    trouble_col = next((c for c in TROUBLE_COLS if c in target_df.columns), None)
+    if trouble_col is None:
+        return None
+    # 回答の組み合わせは種類が少ないので、先に組み合わせごとに数えてから分解する
+    combos = target_df[trouble_col].dropna().astype(str).value_counts()
+    troubles = combos.index.to_series().str.split(MULTI_ANSWER_SEP)
+    exploded = pd.DataFrame({"悩み": troubles, "件数": combos.values}).explode("悩み")
+    exploded["悩み"] = exploded["悩み"].str.strip()
+    exploded = exploded[exploded["悩み"] != ""]
+    return exploded.groupby("悩み")["件数"].sum().sort_values(ascending=False).rename("count")
+
+def recommend_products(target_df, trouble_table, score_cols=(), top_n=3):
+    """
+    ターゲット層に合う商品を順位づけして返す。
+    推奨スコア = 層の悩み（件数で重みづけ）をどれだけカバーするか ＋ その層でのアンケート満足度
+    """
+    counts = segment_trouble_counts(target_df)
+    if counts is None or counts.empty or trouble_table.empty:
+        return pd.DataFrame(columns=RECOMMEND_COLUMNS)
+
+    joined = trouble_table.merge(counts.rename("悩み件数"), left_on="悩み", right_index=True)
+    if joined.empty:
+        return pd.DataFrame(columns=RECOMMEND_COLUMNS)
+    # 商品ごとに、最も件数の多い悩みを「きっかけ」として残す
+    joined = joined.sort_values("悩み件数", ascending=False)
+    ranked = joined.groupby("商品名", sort=False).agg(
+        きっかけ=("悩み", "first"),
+        推奨成分=("推奨成分", "first"),
+        アドバイス=("アドバイス", "first"),
+        カバー数=("悩み", "nunique"),
+        カバー件数=("悩み件数", "sum"),
+    )
+    ranked["カバー率"] = ranked["カバー件数"] / counts.sum()
+
+    valid_scores = [c for c in score_cols if c in target_df.columns]
+    if valid_scores and "商品名" in target_df.columns:
+        satisfaction = target_df.groupby("商品名", observed=True)[valid_scores].mean().mean(axis=1)
+        ranked["満足度"] = satisfaction.reindex(ranked.index)
+    else:
+        ranked["満足度"] = float("nan")
+    # アンケート回答がない商品は満足度を中間（2.5点）として扱う
+    ranked["推奨スコア"] = (
+        RECOMMEND_COVERAGE_WEIGHT * ranked["カバー率"]
+        + (1 - RECOMMEND_COVERAGE_WEIGHT) * ranked["満足度"].fillna(2.5) / 5.0
+    )
+    ranked = ranked.sort_values(["推奨スコア", "カバー数"], ascending=False).head(top_n)
+    return ranked.reset_index()
 
 def upload_to_imgbb(uploaded_file):
     """ImgBBに画像をアップロードして直リンクを返す"""
@@ -118,6 +1693,115 @@ def upload_to_imgbb(uploaded_file):
         st.error(f"エラーが発生しました: {e}")
         return None
 
+class ImageCache:
+    """画像URLごとに元画像と縮小版をディスクに保存するキャッシュ（合計サイズの上限つき）"""
+
+    def __init__(self, root, max_bytes=200 * 1024 * 1024):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        os.makedirs(root, exist_ok=True)
+        # 書き込みのたびに足し引きする合計サイズ（上限を超えた時だけディレクトリを数え直す）
+        self._total = sum(size for _, size, _ in self._entries())
+
+    def _path(self, url, suffix):
+        return os.path.join(self.root, hashlib.sha256(url.encode("utf-8")).hexdigest() + suffix)
+
+    def _read(self, path):
+        if not os.path.exists(path):
+            return None
+        os.utime(path)  # 最終利用時刻を更新（削除順の判定に使う）
+        with open(path, "rb") as f:
+            return f.read()
+
+    def _write(self, path, data):
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        try:
+            replaced = os.path.getsize(path)
+        except FileNotFoundError:
+            replaced = 0
+        os.replace(tmp, path)
+        with self._lock:
+            self._total += len(data) - replaced
+            over = self._total > self.max_bytes
+        if over:
+            self._evict()
+
+    def get_bytes(self, url):
+        """元画像のバイト列（初回だけダウンロードする）"""
+        path = self._path(url, ".orig")
+        data = self._read(path)
+        if data is not None:
+            self.stats["hits"] += 1
+            return data
+        self.stats["misses"] += 1
+        res = requests.get(url, timeout=10)
+        res.raise_for_status()
+        self._write(path, res.content)
+        return res.content
+
+    def get_thumbnail(self, url, max_px=600):
+        """長辺を max_px 以下に縮小したJPEG（元画像と同様にディスクに保存する）"""
+        path = self._path(url, f".{max_px}.jpg")
+        data = self._read(path)
+        if data is not None:
+            self.stats["hits"] += 1
+            return data
+        Image = lazy_import("PIL.Image")
+        img = Image.open(BytesIO(self.get_bytes(url)))
+        img.thumbnail((max_px, max_px))
+        buf = BytesIO()
+        img.convert("RGB").save(buf, format="JPEG", quality=85)
+        self._write(path, buf.getvalue())
+        return buf.getvalue()
+
+    def _entries(self):
+        """キャッシュ内のファイルの (最終利用時刻, サイズ, パス)"""
+        entries = []
+        for name in os.listdir(self.root):
+            full = os.path.join(self.root, name)
+            try:
+                st_ = os.stat(full)
+            except FileNotFoundError:
+                continue
+            entries.append((st_.st_mtime, st_.st_size, full))
+        return entries
+
+    def _evict(self):
+        """合計サイズが上限を超えたら、最後に使われたのが古いファイルから消す"""
+        with self._lock:
+            entries = self._entries()
+            total = sum(size for _, size, _ in entries)
+            for _, size, full in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(full)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                self.stats["evictions"] += 1
+            self._total = total
+
+@st.cache_resource
+def get_image_cache():
+    return ImageCache(
+        os.path.join(LOCAL_CACHE_DIR, "images"),
+        max_bytes=int(st.secrets.get("IMAGE_CACHE_MAX_MB", 200)) * 1024 * 1024,
+    )
+
+def product_image(url, max_px=600):
+    """商品画像をローカルの縮小版キャッシュから返す（取得できなければURLのまま返してst.imageに任せる）"""
+    if not url or not str(url).startswith("http"):
+        return url
+    try:
+        return get_image_cache().get_thumbnail(str(url), max_px)
+    except Exception:
+        return url
+
 # --- 1. 定数・カラーパレットの定義 (最初に書く！) ---
 COL_GENRE = "ジャンル"
 COL_AGE = "年齢"
@@ -133,10 +1817,9 @@ COLOR_PALETTES = {
 
 # --- 2. 関数の定義 (読み込み処理の準備) ---
 
-def load_config_from_sheet(spreadsheet):
-    """商品構成シートから設定を読み込む"""
-    sheet = spreadsheet.worksheet("商品構成")
-    data = sheet.get_all_records()
+def load_config_from_sheet():
+    """商品構成シートから設定を読み込む（ローカルのミラー経由）"""
+    data = get_sheet_mirror().records("商品構成")
     new_config = {}
     
     for row in data:
@@ -152,91 +1835,1035 @@ def load_config_from_sheet(spreadsheet):
         new_config[genre]["types"].append(row["アイテムタイプ"])
     return new_config
 
+SURVEY_CSV_URL = "https://docs.google.com/spreadsheets/d/e/2PACX-1vT5HpURwDWt6S0KkQbiS8ugZksNm8yTokNeKE4X-oBHmLMubOvOKIsuU4q6_onLta2cd0brCBQc-cHA/pub?gid=1578087772&single=true&output=csv"
+SURVEY_TIMESTAMP_COL = "タイムスタンプ"
+SURVEY_DB_PATH = os.path.join(LOCAL_CACHE_DIR, "survey.sqlite")
+
+def normalize_survey_columns(data):
+    """アンケートの列名を短い名前にリネームし、枝番で分かれた同名列を1本にまとめる"""
+    # 列名の前後の空白を削除
+    data.columns = [str(c).strip() for c in data.columns]
+    
+    # 長い質問文を短いIDに変換するマップ
+    COL_MAP = {
+        "今回ご使用の商品のジャンルを選択してください。": "ジャンル",
+        "スキンケア商品を選択した方はアイテムタイプを選択してください。": "アイテムタイプ",
+        "ヘアケア商品を選択した方はアイテムタイプを選択してください。": "アイテムタイプ",
+        "コスメ商品（ベースメイク）を選択した方はアイテムタイプを選択してください。": "アイテムタイプ",
+        "コスメ商品（ポイントメイク）を選択した方はアイテムタイプを選択してください。": "アイテムタイプ",
+        "今回ご使用の商品名を入力してください。": "商品名",
+        "ご感想やご不満点がございましたら、ご自由にご入力ください。": "感想",
+        "今回の商品は購入されましたか？": "購入状況",
+        "最近、ご自身が置かれている環境で気になることはありますか？": "環境変化",
+        "ライフスタイルでストレス・睡眠・食生活など、気になることはありますか？": "ライフスタイル",
+        "肌のお悩み（※複数選択可）": "肌悩み"
+    }
+
+    # 枝番（.1, .2など）を処理してリネームを適用
+    new_cols = []
+    for col in data.columns:
+        base_name = col.split('.')[0].strip()
+        new_cols.append(COL_MAP.get(base_name, col))
+    
+    data.columns = new_cols
+     # --- ここで強制お掃除 ---
+    for c in ["商品名", "肌悩み", "アイテムタイプ", "感想"]:
+        if c in data.columns and isinstance(data[c], pd.DataFrame):
+            data[c] = data[c].bfill(axis=1).iloc[:, 0]
+    data = data.loc[:, ~data.columns.duplicated()].copy()
+    # ----------------------
+    return data
+
+@st.cache_resource
+def get_ingest_stats():
+    """直近のアンケート取込の結果（取込方式・追加行数・所要時間）"""
+    return {"mode": "-", "new_rows": 0, "total_rows": 0, "latency_ms": 0.0}
+
+def survey_response_keys(raw):
+    """
+    生CSVの各行を表すキー（全列の値のハッシュ ＋ 同じ内容の行の通し番号）。
+    回答が編集・削除されると、保存済みのキーが生CSVから消える
+    """
+    if raw.empty:
+        return pd.Series([], dtype="string")
+    digests = pd.util.hash_pandas_object(raw.astype(str), index=False).astype(str)
+    occurrence = digests.groupby(digests).cumcount().astype(str)
+    return (digests + ":" + occurrence).reset_index(drop=True)
+
+def ingest_survey_incremental(csv_bytes):
+    """
+    正規化済みの回答をSQLiteに保存しておき、まだ保存していない回答の行だけを正規化して追記する。
+    保存済みの回答が削除・編集されていたら全件を取り込み直す。
+    戻り値は (全回答のDataFrame, 取込方式, 追加行数)
+    """
+    digest = hashlib.sha256(csv_bytes).hexdigest()
+    os.makedirs(LOCAL_CACHE_DIR, exist_ok=True)
+    with sqlite3.connect(SURVEY_DB_PATH) as conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        meta = dict(conn.execute("SELECT key, value FROM meta").fetchall())
+        tables = {name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+        has_store = {"responses", "response_keys"} <= tables
+
+        # CSVの中身が前回と同じなら、パースも正規化もせず保存済みの結果を返す
+        if has_store and meta.get("csv_digest") == digest:
+            data = pd.read_sql("SELECT * FROM responses", conn)
+            data.attrs["csv_digest"] = digest
+            return data, "変更なし", 0
+
+        raw = pd.read_csv(BytesIO(csv_bytes))
+        raw_header = json.dumps([str(c) for c in raw.columns], ensure_ascii=False)
+        keys = survey_response_keys(raw)
+        can_append = has_store and meta.get("raw_header") == raw_header
+        mode = "全件取込"
+
+        if can_append:
+            stored_keys = pd.read_sql("SELECT key FROM response_keys", conn)["key"]
+            # 行数が減った・保存済みの行が見つからない = 回答の削除か編集なので、差分では追えない
+            if len(keys) < len(stored_keys) or not stored_keys.isin(keys).all():
+                can_append, mode = False, "全件取込（回答の削除・編集を反映）"
+
+        if can_append:
+            # タイムスタンプではなく行のキーで比べるので、前回の最終行と同じ時刻の回答も取りこぼさない
+            is_new = ~keys.isin(stored_keys).to_numpy()
+            stored = pd.read_sql("SELECT * FROM responses", conn)
+            if not is_new.any():
+                data, mode, delta = stored, "差分なし", 0
+            else:
+                new_rows = normalize_survey_columns(raw[is_new].copy())
+                new_rows.to_sql("responses", conn, if_exists="append", index=False)
+                keys[is_new].to_frame("key").to_sql("response_keys", conn, if_exists="append", index=False)
+                data = pd.concat([stored, new_rows], ignore_index=True)
+                mode, delta = "差分取込", len(new_rows)
+        else:
+            # 初回・質問項目が変わった時・回答が削除や編集された時は全件を正規化して保存し直す
+            data = normalize_survey_columns(raw)
+            data.to_sql("responses", conn, if_exists="replace", index=False)
+            keys.to_frame("key").to_sql("response_keys", conn, if_exists="replace", index=False)
+            delta = len(data)
+
+        meta.update({"csv_digest": digest, "raw_header": raw_header})
+        conn.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", list(meta.items()))
+    data.attrs["csv_digest"] = digest
+    return data, mode, delta
+
+def load_stored_survey():
+    """差分取込で保存してある回答（まだ一度も取り込んでいなければ None）"""
+    if not os.path.exists(SURVEY_DB_PATH):
+        return None
+    try:
+        with sqlite3.connect(SURVEY_DB_PATH) as conn:
+            return pd.read_sql("SELECT * FROM responses", conn)
+    except (sqlite3.Error, pd.errors.DatabaseError):
+        return None
+
 @st.cache_data(ttl=300)
 def load_data():
-    """アンケート結果を読み込み、列名を短い名前にリネームする"""
-    url = "https://docs.google.com/spreadsheets/d/e/2PACX-1vT5HpURwDWt6S0KkQbiS8ugZksNm8yTokNeKE4X-oBHmLMubOvOKIsuU4q6_onLta2cd0brCBQc-cHA/pub?gid=1578087772&single=true&output=csv"
+    """アンケート結果を読み込み、列名を短い名前にリネームする（差分取込に対応）"""
+    stats = get_ingest_stats()
+    t0 = time.perf_counter()
     try:
-        data = pd.read_csv(url)
-        # 列名の前後の空白を削除
-        data.columns = [str(c).strip() for c in data.columns]
-        
-        # 長い質問文を短いIDに変換するマップ
-        COL_MAP = {
-            "今回ご使用の商品のジャンルを選択してください。": "ジャンル",
-            "スキンケア商品を選択した方はアイテムタイプを選択してください。": "アイテムタイプ",
-            "ヘアケア商品を選択した方はアイテムタイプを選択してください。": "アイテムタイプ",
-            "コスメ商品（ベースメイク）を選択した方はアイテムタイプを選択してください。": "アイテムタイプ",
-            "コスメ商品（ポイントメイク）を選択した方はアイテムタイプを選択してください。": "アイテムタイプ",
-            "今回ご使用の商品名を入力してください。": "商品名",
-            "ご感想やご不満点がございましたら、ご自由にご入力ください。": "感想",
-            "今回の商品は購入されましたか？": "購入状況",
-            "最近、ご自身が置かれている環境で気になることはありますか？": "環境変化",
-            "ライフスタイルでストレス・睡眠・食生活など、気になることはありますか？": "ライフスタイル",
-            "肌のお悩み（※複数選択可）": "肌悩み"
-        }
-
-        # 枝番（.1, .2など）を処理してリネームを適用
-        new_cols = []
-        for col in data.columns:
-            base_name = col.split('.')[0].strip()
-            new_cols.append(COL_MAP.get(base_name, col))
-        
-        data.columns = new_cols
-         # --- ここで強制お掃除 ---
-        for c in ["商品名", "肌悩み", "アイテムタイプ", "感想"]:
-            if c in data.columns and isinstance(data[c], pd.DataFrame):
-                data[c] = data[c].bfill(axis=1).iloc[:, 0]
-        data = data.loc[:, ~data.columns.duplicated()].copy()
-        # ----------------------
+        csv_bytes = requests.get(SURVEY_CSV_URL, timeout=30).content
+        try:
+            data, mode, delta = ingest_survey_incremental(csv_bytes)
+        except (sqlite3.Error, ValueError, OSError) as e:
+            # ローカル保存に失敗しても、従来どおり全件を読み込んで続行する
+            data = normalize_survey_columns(pd.read_csv(BytesIO(csv_bytes)))
+            mode, delta = f"全件取込（差分保存に失敗: {e}）", len(data)
+        stats.update({
+            "mode": mode,
+            "new_rows": delta,
+            "total_rows": len(data),
+            "latency_ms": (time.perf_counter() - t0) * 1000,
+        })
         return data
     except Exception as e:
-        st.error(f"データ読み込みエラー: {e}")
-        return None
+        stored = load_stored_survey()
+        if stored is None:
+            st.error(f"データ読み込みエラー: {e}")
+            return None
+        # 公開CSVに届かない間は、前回までに取り込んだ回答で読み取り専用の分析を続ける
+        st.warning(f"📴 アンケートの公開CSVに接続できないため、保存済みの回答 {len(stored)} 件を表示しています（{e}）")
+        stats.update({
+            "mode": "オフライン（保存済みの回答）",
+            "new_rows": 0,
+            "total_rows": len(stored),
+            "latency_ms": (time.perf_counter() - t0) * 1000,
+        })
+        return stored
+
+SURVEY_CATEGORY_COLS = [COL_GENRE, COL_AGE, "年代", COL_GENDER]
+
+@st.cache_resource
+def get_pipeline_stats():
+    """分析用DataFrameを作り直した回数と所要時間"""
+    return {"runs": 0, "last_ms": 0.0, "version": "-"}
+
+def survey_data_version(data):
+    """回答件数・列数・最新タイムスタンプから、アンケートデータの世代を表す文字列を作る"""
+    if data is None:
+        return ""
+    if data.attrs.get("csv_digest"):
+        # 件数の変わらない回答の編集も見分けられるよう、取り込んだCSVのハッシュを優先する
+        return f"{len(data)}:{len(data.columns)}:{data.attrs['csv_digest']}"
+    last_ts = ""
+    if SURVEY_TIMESTAMP_COL in data.columns and len(data):
+        last_ts = str(data[SURVEY_TIMESTAMP_COL].iloc[-1])
+    return f"{len(data)}:{len(data.columns)}:{last_ts}"
+
+@st.cache_data(show_spinner=False, max_entries=3)
+def build_survey_frame(_raw, version, score_cols):
+    """
+    サイドバーと全メニューで共有する、型付きの分析用DataFrameを作る。
+    ジャンル・年齢・性別はカテゴリ型、評価項目は数値型、商品名は前後の空白を除いた1列にそろえる。
+    """
+    stats = get_pipeline_stats()
+    t0 = time.perf_counter()
+
+    data = _raw.copy()
+    for c in SURVEY_CATEGORY_COLS:
+        if c in data.columns:
+            data[c] = data[c].astype("category")
+    for c in score_cols:
+        if c in data.columns:
+            data[c] = pd.to_numeric(data[c], errors="coerce")
+    if "商品名" in data.columns:
+        items = data["商品名"]
+        items = items.where(items.isna(), items.astype(str).str.strip())
+        data["商品名"] = items.where(items != "")
+
+    stats["runs"] += 1
+    stats["last_ms"] = (time.perf_counter() - t0) * 1000
+    stats["version"] = version
+    return data
+
+class ScoreCube:
+    """
+    (ジャンル, 商品名, 年代, 性別, 肌悩み) の組み合わせごとに、各評価項目の件数・合計・二乗和を持つ集計キューブ。
+    平均と分散は、絞り込んだセルの合計から計算するので回答を読み直さない。
+    肌悩みは回答どおりの組み合わせ文字列のまま持つ（1人を複数の悩みに数えないため）
+    """
+
+    UNANSWERED = "（未回答）"
+
+    def __init__(self, frame, score_cols):
+        t0 = time.perf_counter()
+        self.age_col = "年代" if "年代" in frame.columns else COL_AGE
+        self.dims = [c for c in [COL_GENRE, "商品名", self.age_col, COL_GENDER, "肌悩み"] if c in frame.columns]
+        self.scores = [c for c in score_cols if c in frame.columns]
+        keys = frame[self.dims].astype(object).fillna(self.UNANSWERED)
+        values = frame[self.scores].astype(float)
+        parts = {"回答数": pd.Series(1, index=frame.index)}
+        for c in self.scores:
+            parts[("n", c)] = values[c].notna().astype(int)
+            parts[("sum", c)] = values[c].fillna(0.0)
+            parts[("sq", c)] = values[c].fillna(0.0) ** 2
+        measures = pd.DataFrame(parts)
+        self.cells = pd.concat([keys, measures], axis=1).groupby(self.dims, sort=False).sum()
+        self.build_ms = (time.perf_counter() - t0) * 1000
+
+    def _select(self, filters):
+        cells = self.cells
+        for dim, cond in (filters or {}).items():
+            if dim not in self.dims or cond is None:
+                continue
+            level = cells.index.get_level_values(dim)
+            if callable(cond):
+                # 値の種類ごとに1回だけ判定する（肌悩みの部分一致など）
+                uniques = pd.Index(level.unique())
+                keep = uniques[[bool(cond(v)) for v in uniques]]
+                cells = cells[level.isin(keep)]
+            elif isinstance(cond, (list, tuple, set)):
+                if cond:
+                    cells = cells[level.isin(list(cond))]
+            else:
+                cells = cells[level == cond]
+        return cells
+
+    def count(self, filters=None):
+        """絞り込み後の回答数"""
+        return int(self._select(filters)["回答数"].sum())
+
+    def stats(self, by="商品名", filters=None, scores=None):
+        """
+        by ごとの各評価項目の平均・分散・件数（列は (\"mean\"|\"var\"|\"n\", 項目)）。
+        分散は pandas の var() と同じ不偏分散（ddof=1）で、回答が1件以下なら NaN
+        """
+        scores = [c for c in (scores or self.scores) if c in self.scores]
+        cells = self._select(filters)
+        if cells.empty or not scores:
+            return pd.DataFrame()
+        if by:
+            grouped = cells.groupby(level=by, sort=False).sum()
+            grouped = grouped[grouped.index != self.UNANSWERED]
+        else:
+            grouped = cells.sum().to_frame().T
+        out = {}
+        for c in scores:
+            n = grouped[("n", c)].replace(0, float("nan"))
+            mean = grouped[("sum", c)] / n
+            out[("mean", c)] = mean
+            # 母分散（二乗和の平均 − 平均の二乗）に n/(n-1) を掛けて不偏分散にする
+            out[("var", c)] = ((grouped[("sq", c)] / n - mean ** 2).clip(lower=0) * n / (n - 1)).where(n > 1)
+            out[("n", c)] = grouped[("n", c)]
+        result = pd.DataFrame(out)
+        result["回答数"] = grouped["回答数"]
+        return result
+
+    def means(self, by="商品名", filters=None, scores=None):
+        """by ごとの各評価項目の平均（列は評価項目名）"""
+        stats = self.stats(by, filters, scores)
+        return stats["mean"] if not stats.empty else pd.DataFrame()
+
+@st.cache_resource(max_entries=2, show_spinner=False)
+def get_score_cube(version, _frame, score_cols):
+    """アンケートの世代ごとに1回だけ集計キューブを作る"""
+    return ScoreCube(_frame, score_cols)
+
+LIFESTYLE_NONE_ANSWERS = {"なし", "特になし", "特にない", "ない"}
+
+class SurveyFilterIndex:
+    """
+    サイドバーの絞り込み用のビットマップ索引。
+    列ごとに値をカテゴリコードにし、値ごとの該当行を np.packbits したビット列で持つ。
+    複数選択の列（環境変化・肌悩み）は回答を1つずつに分けた値ごとに持つので、
+    どんな条件の組み合わせもビット列のAND/ORだけで求まり、DataFrameを作り直さない
+    """
+
+    COLUMNS = [COL_GENRE, "アイテムタイプ", COL_AGE, "年代", COL_GENDER, "環境変化", "肌悩み"]
+    MULTI_COLUMNS = {"環境変化", "肌悩み"}
+    LIFE_COL = "ライフスタイル"
+    LIFE_LEVELS = range(6)
+
+    def __init__(self, frame):
+        t0 = time.perf_counter()
+        self.n_rows = len(frame)
+        self.bitmaps = {}
+        for col in self.COLUMNS:
+            if col not in frame.columns:
+                continue
+            codes, uniques = pd.factorize(frame[col])
+            uniques = list(uniques)
+            if col in self.MULTI_COLUMNS:
+                # 回答の組み合わせごとの行を、含まれる選択肢ごとにまとめる
+                combo_codes = collections.defaultdict(list)
+                for code, combo in enumerate(uniques):
+                    for value in split_multi_answer(combo):
+                        combo_codes[value].append(code)
+                self.bitmaps[col] = {v: np.packbits(np.isin(codes, c)) for v, c in combo_codes.items()}
+            else:
+                self.bitmaps[col] = {v: np.packbits(codes == code) for code, v in enumerate(uniques)}
+        self.life_bitmaps = {}
+        if self.LIFE_COL in frame.columns:
+            levels = self.lifestyle_levels(frame[self.LIFE_COL])
+            self.life_bitmaps = {k: np.packbits(levels >= k) for k in self.LIFE_LEVELS}
+        self.all_rows = np.packbits(np.ones(self.n_rows, dtype=bool))
+        self.build_ms = (time.perf_counter() - t0) * 1000
+
+    @classmethod
+    def lifestyle_levels(cls, series):
+        """ライフスタイルの負荷レベル（数値の回答はそのまま、選択式は気になる項目の数、最大5）"""
+        numeric = pd.to_numeric(series, errors="coerce")
+        if numeric.notna().any():
+            return numeric.fillna(0).clip(0, 5).to_numpy()
+        combos, uniques = pd.factorize(series)
+        counts = np.array(
+            [len([v for v in split_multi_answer(u) if v not in LIFESTYLE_NONE_ANSWERS]) for u in uniques] + [0]
+        )
+        # 未回答（コード -1）は末尾の 0 を指す
+        return np.minimum(counts[combos], 5)
+
+    def _any_of(self, col, values):
+        """列 col が values のどれかに当たる行のビット列（列が無ければ None ＝ 絞り込まない）"""
+        bitmaps = self.bitmaps.get(col)
+        if bitmaps is None:
+            return None
+        bits = np.zeros_like(self.all_rows)
+        for v in values:
+            if v in bitmaps:
+                bits |= bitmaps[v]
+        return bits
+
+    def active_filters(self, filters):
+        """
+        filters（{列名: 値 or 値のリスト}）のうち、実際に行を絞り込む条件だけを {列名: 値のリスト} で返す。
+        空リスト・None の列と、選択肢をすべて選んだ列は絞り込まない
+        """
+        active = {}
+        for col, values in (filters or {}).items():
+            if col is None or values is None:
+                continue
+            if not isinstance(values, (list, tuple, set)):
+                values = [values]
+            if not values or (col in self.bitmaps and set(self.bitmaps[col]) <= set(values)):
+                continue
+            active[col] = list(values)
+        return active
+
+    def mask(self, filters=None, life_min=0):
+        """filters の条件に当たる行のビット列（列の中は OR、列どうしは AND）"""
+        bits = self.all_rows.copy()
+        for col, values in self.active_filters(filters).items():
+            col_bits = self._any_of(col, values)
+            if col_bits is not None:
+                bits &= col_bits
+        if life_min and self.life_bitmaps:
+            bits &= self.life_bitmaps[min(int(life_min), max(self.LIFE_LEVELS))]
+        return bits
+
+    def positions(self, bits):
+        """ビット列に当たる行の位置（iloc 用）"""
+        return np.flatnonzero(np.unpackbits(bits, count=self.n_rows))
+
+    def count(self, bits):
+        return int(np.unpackbits(bits, count=self.n_rows).sum())
+
+    def options(self, col, within=None):
+        """within のビット列の中に1行でも現れる col の値（並べ替え済み）"""
+        bitmaps = self.bitmaps.get(col, {})
+        if within is None:
+            return sorted(bitmaps, key=str)
+        return sorted((v for v, b in bitmaps.items() if (b & within).any()), key=str)
+
+@st.cache_resource(max_entries=2, show_spinner=False)
+def get_filter_index(version, _frame):
+    """アンケートの世代ごとに1回だけ絞り込み用のビットマップ索引を作る"""
+    return SurveyFilterIndex(_frame)
+
+@st.cache_resource(max_entries=4, show_spinner=False)
+def get_adhoc_score_cube(version, rows_digest, _frame, score_cols):
+    """キューブの軸にない条件（アイテムタイプ・環境・ライフスタイル）で絞った行だけの集計キューブ"""
+    return ScoreCube(_frame, score_cols)
+
+class SurveyQuery:
+    """
+    サイドバーの選択から作る遅延評価の絞り込みプラン。
+    条件を積むだけで、行の位置は最初に使われた時に1回だけビットマップ索引から求める。
+    各メニューは select() で必要な列だけを取り出す
+    """
+
+    def __init__(self, frame, index, version, clauses, life_min=0):
+        self.frame = frame
+        self.index = index
+        self.version = version
+        self.clauses = [index.active_filters(c) for c in clauses]
+        self.clauses = [c for c in self.clauses if c]
+        self.life_min = life_min
+        self.filter_ms = 0.0
+        self._bits = None
+        self._positions = None
+
+    def where(self, filters):
+        """条件を1つ足した新しいプラン（元のプランの行位置は使い回す）"""
+        query = SurveyQuery(self.frame, self.index, self.version, self.clauses + [filters], self.life_min)
+        if self._bits is not None:
+            query._base_bits = self._bits
+        return query
+
+    @property
+    def bits(self):
+        if self._bits is None:
+            t0 = time.perf_counter()
+            base = getattr(self, "_base_bits", None)
+            clauses = self.clauses[-1:] if base is not None else self.clauses
+            bits = base.copy() if base is not None else self.index.mask(life_min=self.life_min)
+            for clause in clauses:
+                bits &= self.index.mask(clause)
+            self._bits = bits
+            self.filter_ms = (time.perf_counter() - t0) * 1000
+        return self._bits
+
+    @property
+    def positions(self):
+        if self._positions is None:
+            self._positions = self.index.positions(self.bits)
+        return self._positions
+
+    @property
+    def count(self):
+        return len(self.positions)
+
+    @property
+    def empty(self):
+        return self.count == 0
+
+    @property
+    def columns(self):
+        return self.frame.columns
+
+    def select(self, columns):
+        """条件に当たる行の、指定した列だけのDataFrame（無い列は無視する）"""
+        cols = list(dict.fromkeys(c for c in columns if c in self.frame.columns))
+        return self.frame[cols].iloc[self.positions]
+
+    def unique(self, col):
+        """条件に当たる行に現れる col の値（並べ替え済み）"""
+        if col in self.index.bitmaps:
+            return self.index.options(col, within=self.bits)
+        if col not in self.frame.columns:
+            return []
+        return sorted(self.select([col])[col].dropna().unique(), key=str)
+
+    def cube(self, score_cols):
+        """
+        (集計キューブ, キューブに渡す条件) を返す。
+        条件がすべてキューブの軸に乗る時は共有のキューブを使い、
+        それ以外の条件がある時はこのプランの行だけでその場のキューブを作る
+        """
+        merged = {}
+        for clause in self.clauses:
+            for col, values in clause.items():
+                if col in merged:
+                    merged = None
+                    break
+                merged[col] = values
+            if merged is None:
+                break
+        shared = get_score_cube(self.version, self.frame, ALL_SCORE_COLS)
+        if merged is not None and not self.life_min and set(merged) <= set(shared.dims):
+            filters = dict(merged)
+            for col in set(filters) & self.index.MULTI_COLUMNS:
+                wanted = set(filters[col])
+                filters[col] = lambda combo, wanted=wanted: not wanted.isdisjoint(split_multi_answer(combo))
+            return shared, filters
+        digest = hashlib.sha1(self.bits.tobytes()).hexdigest()
+        rows = self.select(shared.dims + list(score_cols))
+        return get_adhoc_score_cube(self.version, digest, rows, list(score_cols)), {}
+
+FEEDBACK_PAGE_SIZES = [10, 20, 50]
+
+def feedback_view(voice_df, fb_col, item_col="商品名", ranked=None, items=(), order="新しい順"):
+    """
+    感想がある回答を商品で絞って並べる（描画は呼び出し側でページ分だけ）。
+    ranked は全文検索でヒットした行ラベル（関連度順）。order は「新しい順」「古い順」「関連度順」
+    """
+    if ranked is not None:
+        voice_df = voice_df.loc[[k for k in ranked if k in voice_df.index]]
+    text = voice_df[fb_col].astype("string")
+    keep = text.notna() & (text.str.strip() != "")
+    if items and item_col in voice_df.columns:
+        keep &= voice_df[item_col].isin(items)
+    view = voice_df[keep.fillna(False)]
+    if order == "関連度順" and ranked is not None:
+        return view
+    newest_first = order != "古い順"
+    if SURVEY_TIMESTAMP_COL in view.columns:
+        order = pd.to_datetime(view[SURVEY_TIMESTAMP_COL], errors="coerce")
+        view = view.iloc[order.reset_index(drop=True).sort_values(ascending=not newest_first, na_position="last", kind="stable").index]
+    elif newest_first:
+        view = view.iloc[::-1]
+    return view
 
 # --- 3. 実際の実行プロセス ---
 
-# クライアント・スプレッドシートの準備
-client = get_gspread_client()
-spreadsheet = client.open("Cosme Data")
-
-# 定義した関数を使ってデータを読み込む
-COLUMN_CONFIG = load_config_from_sheet(spreadsheet)
-df = load_data()
-# --- 【修正後】ここにお掃除コードを入れる ---
-if df is not None:
-    # 統合したい列名のリスト
-    cols_to_fix = ["商品名", "肌悩み", "アイテムタイプ", "感想"]
-
-    for col_name in cols_to_fix:
-        if col_name in df.columns:
-            target_cols = df[col_name]
-            # 同じ名前の列が複数（DataFrame）ある場合のみ処理
-            if isinstance(target_cols, pd.DataFrame):
-                # 横方向に見て空欄を埋め、1本にまとめる
-                df[col_name] = target_cols.bfill(axis=1).iloc[:, 0]
-    
-    # まとめた後、重複した古い列を削除して「1つだけ」残す
-    df = df.loc[:, ~df.columns.duplicated()].copy()
-# ----------------------------------------------
+# 定義した関数を使ってデータを読み込む（接続はget_sheet_session()が使い回す）
+COLUMN_CONFIG = load_config_from_sheet()
+ALL_SCORE_COLS = tuple(sorted({s for c in COLUMN_CONFIG.values() for s in c["scores"]}))
+
+# 列名の整理・同名列の統合は load_data() 内で1回だけ行い、
+# ここでは型付けした分析用DataFrameをデータの世代ごとに1回だけ作る
+raw_df = load_data()
+survey_version = survey_data_version(raw_df)
+df = build_survey_frame(raw_df, survey_version, ALL_SCORE_COLS) if raw_df is not None else None
+score_cube = get_score_cube(survey_version, df, ALL_SCORE_COLS) if df is not None else None
+filter_index = get_filter_index(survey_version, df) if df is not None else None
 
 # この後にメニュー選択 (if menu == ...) や分析コードが続く
 # ------------------------------------------------
     
     # --- 【新設】NGワード辞書の読み込み ---
-@st.cache_data(ttl=300)
 def load_ng_words():
+    """NGワード辞書を { "NGワード": "理由" } で返す（書き込みが反映されると読み直す）"""
     try:
-        client = get_gspread_client()
-        sh = client.open("Cosme Data") # ★ご自身のシート名に
-        sheet = sh.worksheet("NGワード辞書")
-        records = sheet.get_all_records()
-        # { "NGワード": "理由" } という辞書形式に変換
-        return {row['NGワード']: row['理由'] for row in records if row['NGワード']}
-    except:
+        data = _fetch_sheet_df("NGワード辞書", get_sheet_session().revisions.get("NGワード辞書", 0))
+        return {w: r for w, r in zip(data["NGワード"], data["理由"]) if w}
+    except Exception:
         return {}
 
-df = load_data()
+class NGWordScanner:
+    """NGワード辞書から作るAho–Corasick法のマッチャー（文章の長さに比例した時間で全NGワードを検出する）"""
+
+    def __init__(self, ng_items):
+        self.reasons = {}
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+        for word, reason in ng_items:
+            word = str(word).strip()
+            if not word:
+                continue
+            self.reasons[word] = reason
+            node = 0
+            for ch in word:
+                nxt = self._goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[node][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                node = nxt
+            self._out[node].append(word)
+
+        # 幅優先で失敗リンクを張る
+        queue = collections.deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self._goto[node].items():
+                queue.append(nxt)
+                f = self._fail[node]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                # 根の直下の失敗先は根
+                self._fail[nxt] = self._goto[f].get(ch, 0) if node else 0
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def scan(self, text):
+        """[(開始位置, 終了位置, NGワード, 理由), ...] を返す"""
+        hits = []
+        node = 0
+        for i, ch in enumerate(str(text or "")):
+            while node and ch not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(ch, 0)
+            for word in self._out[node]:
+                hits.append((i + 1 - len(word), i + 1, word, self.reasons[word]))
+        return hits
+
+    def highlight(self, text):
+        """NGワードを赤字にしたMarkdownを返す（重なった検出は左から長いものを優先）"""
+        text = str(text or "")
+        spans = sorted(self.scan(text), key=lambda h: (h[0], -(h[1] - h[0])))
+        out, pos = [], 0
+        for start, end, _, _ in spans:
+            if start < pos:
+                continue
+            out.append(text[pos:start])
+            out.append(f":red[**{text[start:end]}**]")
+            pos = end
+        out.append(text[pos:])
+        return "".join(out)
+
+@st.cache_resource(max_entries=4)
+def get_ng_scanner(ng_items):
+    """辞書の中身（タプル）ごとに1回だけマッチャーを作る"""
+    return NGWordScanner(ng_items)
+
+def ng_scanner_for(ng_dict):
+    return get_ng_scanner(tuple(sorted((str(w), str(r)) for w, r in ng_dict.items())))
+
+def render_ng_check(scanner, text, label):
+    """テキスト中のNGワードを理由つきで表示する。検出数を返す"""
+    hits = scanner.scan(text)
+    if not hits:
+        st.caption(f"✅ {label}：NGワードは見つかりませんでした")
+        return 0
+    st.warning(f"🚫 {label}：NGワードが {len(hits)} 件見つかりました")
+    st.markdown(scanner.highlight(text))
+    st.dataframe(
+        pd.DataFrame([(w, r) for _, _, w, r in hits], columns=["NGワード", "理由"]).value_counts().reset_index(name="件数"),
+        hide_index=True,
+        use_container_width=True
+    )
+    return len(hits)
+
+# --- AIポップ生成の共通部品（1商品ずつの生成と一括生成で共有） ---
+DEFAULT_POP_TONE = "親しみやすく、かつプロフェッショナルな雰囲気"
+
+def build_ng_rules_text(ng_dict):
+    """NGワード辞書をプロンプト用のテキストにする"""
+    if not ng_dict:
+        return "薬機法を遵守すること"
+    return "".join(f"・{word}（理由: {reason}）\n" for word, reason in ng_dict.items())
+
+def build_analysis_hint(item_stats, gender_target):
+    """評価の平均値から、AIに渡す分析結果の一文を作る"""
+    if item_stats is not None and not item_stats.dropna().empty:
+        return f"顧客分析（{gender_target}）: {item_stats.idxmax()}が特に評価されています。"
+    return f"{gender_target}向けに、商品の魅力を新規提案してください。"
+
+def build_pop_prompt(item_name, item_genre, item_type, human_hint, item_info, analysis_hint, ng_rules_text, with_image=False):
+    """POPコピー生成用のプロンプトを組み立てる"""
+    return f"""
+    あなたは化粧品販売のプロであり、売れっ子のPOPライターです。
+    {'添付画像からデザインの雰囲気を読み取り、' if with_image else ''}
+    提供された情報を元に、お客様の心に刺さる「【提案1】〜【提案3】」を作成してください。
+
+    【最重要】薬機法を遵守し、治療効果や「最高」等の誇大表現は避けてください。
+
+    商品名: {item_name}
+    カテゴリー: {item_genre} （{item_type}）
+    トーン: {human_hint}
+    特徴: {item_info}
+    分析結果: {analysis_hint}
+
+    【⚠️ 絶対に使用禁止のNGワード】
+    {ng_rules_text}
+
+    # 💎 必須の出力ルール:
+    1. 挨拶や「承知いたしました」等の前置きは一切書かないでください。
+    2. 以下の【形式】で3案出力してください。
+
+      【提案1】タイトル（20文字前後）
+      （1行空ける）
+      本文（100文字前後。改行を適宜挟み、読みやすく）
+
+    3. トーン＆マナー:
+       - 必ず【{human_hint}】という雰囲気を言葉選びに反映させてください。
+       - データが不足していても、プロの知識で「いい感じ」に魅力的な文章に仕上げてください。
+
+    4. 切り口の指定:
+       案1：ターゲットの悩みや願望に寄り添う（例：〇〇を求める方へ）
+       案2：肌のバランスや健やかさを強調
+       案3：毎日のケアが特別になる体験・感情を強調
+
+    それでは、案のみを出力してください。
+    """
+
+def product_score_stats(survey_df, item_name, gender_target, scores):
+    """アンケートから、指定商品（と性別）の評価項目ごとの平均を出す"""
+    if survey_df is None or "商品名" not in survey_df.columns:
+        return None
+    valid_scores = [c for c in scores if c in survey_df.columns]
+    target = survey_df[survey_df["商品名"] == item_name]
+    if gender_target != "全て" and COL_GENDER in target.columns:
+        target = target[target[COL_GENDER] == gender_target]
+    return target[valid_scores].mean() if valid_scores else None
+
+class _StubResponse:
+    def __init__(self, text):
+        self.text = text
+
+class StubPopModel:
+    """オフライン確認用のGemini代わり（secretsに GEMINI_STUB = true を設定すると使われる）"""
+
+    model_name = "stub"
+
+    def __init__(self, delay=0.2):
+        self.delay = delay
+
+    def generate_content(self, contents, stream=False):
+        prompt = contents[0] if isinstance(contents, list) else contents
+        if FEEDBACK_PROMPT_MARKER in prompt:
+            time.sleep(self.delay)
+            return _StubResponse(stub_feedback_insights(prompt))
+        name = next((line.split(":", 1)[1].strip() for line in prompt.splitlines() if line.strip().startswith("商品名:")), "この商品")
+        text = "\n\n".join(
+            f"【提案{i}】{name}のある毎日\n\n{name}で、いつものケアをもっと心地よく。（スタブ出力）" for i in range(1, 4)
+        )
+        if stream:
+            return self._stream(text)
+        time.sleep(self.delay)
+        return _StubResponse(text)
+
+    def _stream(self, text, chunk_size=12):
+        for i in range(0, len(text), chunk_size):
+            time.sleep(self.delay / 10)
+            yield _StubResponse(text[i:i + chunk_size])
+
+def stream_pop_copy(model, contents, ng_scanner, text_area, ng_area):
+    """
+    生成中のテキストを届いた分から表示し、途中のテキストでもNGワードをチェックする。
+    戻り値は (全文, 最初の文字が届くまでの秒数, 全体の秒数)
+    """
+    t0 = time.perf_counter()
+    first_text_sec = None
+    parts = []
+    for chunk in model.generate_content(contents, stream=True):
+        try:
+            piece = chunk.text
+        except ValueError:
+            continue  # 安全フィルタ等でテキストを持たないチャンク
+        if not piece:
+            continue
+        if first_text_sec is None:
+            first_text_sec = time.perf_counter() - t0
+        parts.append(piece)
+        partial = "".join(parts)
+        text_area.markdown(partial + " ▌")
+        hits = sorted({w for _, _, w, _ in ng_scanner.scan(partial)})
+        if hits:
+            ng_area.warning("🚫 NGワードを検出: " + "、".join(hits))
+    total_sec = time.perf_counter() - t0
+    return "".join(parts), (first_text_sec if first_text_sec is not None else total_sec), total_sec
+
+class RateLimiter:
+    """1分あたりのリクエスト数を超えないよう、呼び出しの間隔をあける（スレッドセーフ）"""
+
+    def __init__(self, per_minute):
+        self.interval = 60.0 / max(per_minute, 1)
+        self._lock = threading.Lock()
+        self._next_at = 0.0
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            wait_for = self._next_at - now
+            self._next_at = max(now, self._next_at) + self.interval
+        if wait_for > 0:
+            time.sleep(wait_for)
+
+class GenerationCache:
+    """プロンプト（と画像）のハッシュをキーに、Geminiの生成結果をSQLiteに保存するLRUキャッシュ"""
+
+    def __init__(self, path, max_entries=500, max_bytes=20 * 1024 * 1024):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS generations ("
+                "key TEXT PRIMARY KEY, text TEXT, size INTEGER, created REAL, last_access REAL)"
+            )
+
+    def _connect(self):
+        # スレッドごとに接続を作る（一括生成のワーカーからも呼ばれるため）
+        return sqlite3.connect(self.path, timeout=10)
+
+    @staticmethod
+    def make_key(model_name, prompt, image_bytes=None):
+        h = hashlib.sha256()
+        h.update(str(model_name).encode("utf-8"))
+        h.update(b"\0")
+        h.update(prompt.encode("utf-8"))
+        h.update(b"\0")
+        h.update(hashlib.sha256(image_bytes).digest() if image_bytes else b"")
+        return h.hexdigest()
+
+    def get(self, key):
+        with self._connect() as conn:
+            row = conn.execute("SELECT text FROM generations WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.stats["misses"] += 1
+                return None
+            conn.execute("UPDATE generations SET last_access = ? WHERE key = ?", (time.time(), key))
+        self.stats["hits"] += 1
+        return row[0]
+
+    def put(self, key, text):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO generations (key, text, size, created, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, text, len(text.encode("utf-8")), now, now)
+            )
+            self._evict(conn)
+
+    def _evict(self, conn):
+        """件数か合計サイズが上限を超えたら、最後に使われたのが古いものから消す"""
+        count, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM generations").fetchone()
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+        removed = 0
+        for key, size in conn.execute("SELECT key, size FROM generations ORDER BY last_access").fetchall():
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+            conn.execute("DELETE FROM generations WHERE key = ?", (key,))
+            count, total, removed = count - 1, total - size, removed + 1
+        self.stats["evictions"] += removed
+
+@st.cache_resource
+def get_generation_cache():
+    return GenerationCache(
+        os.path.join(LOCAL_CACHE_DIR, "gemini_cache.sqlite"),
+        max_entries=int(st.secrets.get("GEMINI_CACHE_MAX_ENTRIES", 500)),
+        max_bytes=int(st.secrets.get("GEMINI_CACHE_MAX_MB", 20)) * 1024 * 1024,
+    )
+
+def generate_pop_batch(model, jobs, max_workers=4, per_minute=15, cache=None, use_cache=True):
+    """
+    jobs（商品名 → プロンプト）をスレッドプールで並行生成する。
+    cache を渡すと生成結果を保存し、use_cache=True なら同じプロンプトはAPIを呼ばずに保存済みの結果を返す。
+    呼び出し側で進捗を表示できるよう、(商品名, 生成テキスト, エラー) を完了順に返すジェネレーター
+    """
+    limiter = RateLimiter(per_minute)
+    model_name = getattr(model, "model_name", "")
+
+    def run(name, prompt):
+        key = GenerationCache.make_key(model_name, prompt)
+        if cache is not None and use_cache:
+            cached = cache.get(key)
+            if cached is not None:
+                return cached
+        limiter.wait()
+        text = model.generate_content(prompt).text
+        if cache is not None:
+            cache.put(key, text)
+        return text
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(run, name, prompt): name for name, prompt in jobs.items()}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                yield name, future.result(), None
+            except Exception as e:
+                yield name, "", e
+
+# --- 感想の感情・話題の抽出（複数件をまとめてGeminiに渡し、回答ごとにSQLiteへ保存） ---
+FEEDBACK_PROMPT_MARKER = "【感想分析】"
+FEEDBACK_SENTIMENTS = {"positive": "ポジティブ", "neutral": "ふつう", "negative": "ネガティブ"}
+FEEDBACK_CHUNK_SIZE = 20
+FEEDBACK_MAX_TOPICS = 5
+_STUB_POSITIVE_WORDS = ["良い", "よい", "好き", "しっとり", "さっぱり", "リピ", "満足", "おすすめ"]
+_STUB_COMPLAINTS = {"べたつ": "べたつき", "ヒリヒリ": "刺激", "荒れ": "肌荒れ", "乾燥": "乾燥", "香り": "香り", "高い": "価格", "量": "容量"}
+
+def survey_response_ids(frame):
+    """タイムスタンプ・商品名・感想から、回答ごとに変わらないIDを作る（空欄は空文字として扱う）"""
+    parts = [frame[c].astype("string").fillna("") if c in frame.columns else pd.Series("", index=frame.index, dtype="string")
+             for c in [SURVEY_TIMESTAMP_COL, "商品名", SURVEY_SEARCH_FIELD]]
+    joined = parts[0].str.cat(parts[1:], sep="\x1f")
+    return joined.map(lambda v: hashlib.sha1(v.encode("utf-8")).hexdigest()[:16])
+
+def build_feedback_prompt(items, score_names):
+    """items（[(回答ID, 商品名, 感想), ...]）をまとめて1回で分析させるプロンプト"""
+    lines = [f"- id: {rid} | 商品: {product} | 感想: {str(text).replace(chr(10), ' ')}" for rid, product, text in items]
+    return f"""{FEEDBACK_PROMPT_MARKER}
+あなたは化粧品メーカーのアンケート分析担当です。以下の感想それぞれについて分析してください。
+
+# 出力形式
+JSON配列のみを出力してください（説明文やコードブロックは不要）。
+[{{"id": "回答のid", "sentiment": "positive|neutral|negative", "attributes": ["言及している評価項目"], "topics": ["不満点の話題（短い名詞）"]}}]
+
+# ルール
+- attributes は次の評価項目から選ぶ（該当なしは空配列）: {", ".join(score_names)}
+- topics は不満・改善要望だけを、最大{FEEDBACK_MAX_TOPICS}個まで（なければ空配列）
+
+# 感想
+{chr(10).join(lines)}
+"""
+
+def parse_feedback_insights(text, ids, score_names):
+    """モデルの出力（JSON配列）を {回答ID: {"sentiment", "attributes", "topics"}} にする。形式が崩れた回答は捨てる"""
+    start, end = text.find("["), text.rfind("]")
+    if start < 0 or end < start:
+        raise ValueError("分析結果のJSONが見つかりません。")
+    records = json.loads(text[start:end + 1])
+    wanted, allowed = set(ids), set(score_names)
+    results = {}
+    for rec in records if isinstance(records, list) else []:
+        if not isinstance(rec, dict) or str(rec.get("id")) not in wanted:
+            continue
+        sentiment = str(rec.get("sentiment", "neutral")).lower()
+        results[str(rec["id"])] = {
+            "sentiment": sentiment if sentiment in FEEDBACK_SENTIMENTS else "neutral",
+            "attributes": [a for a in dict.fromkeys(rec.get("attributes") or []) if a in allowed],
+            "topics": [str(t).strip() for t in (rec.get("topics") or []) if str(t).strip()][:FEEDBACK_MAX_TOPICS],
+        }
+    return results
+
+def stub_feedback_insights(prompt):
+    """スタブ用：キーワードだけで感想を分類したJSONを返す"""
+    score_line = next((l for l in prompt.splitlines() if "評価項目から選ぶ" in l), "")
+    score_names = [s.strip() for s in score_line.split(":", 1)[-1].split(",") if s.strip()]
+    out = []
+    for line in prompt.splitlines():
+        m = re.match(r"- id: (\S+) \| 商品: .*? \| 感想: (.*)$", line)
+        if not m:
+            continue
+        rid, text = m.groups()
+        topics = [t for k, t in _STUB_COMPLAINTS.items() if k in text]
+        positive = any(w in text for w in _STUB_POSITIVE_WORDS)
+        out.append({
+            "id": rid,
+            "sentiment": "negative" if topics and not positive else ("positive" if positive else "neutral"),
+            "attributes": [s for s in score_names if s in text],
+            "topics": topics[:FEEDBACK_MAX_TOPICS],
+        })
+    return json.dumps(out, ensure_ascii=False)
+
+@st.cache_data(show_spinner=False, max_entries=2)
+def cached_survey_response_ids(version, _frame):
+    """アンケートの世代ごとに1回だけ回答IDを計算する"""
+    return survey_response_ids(_frame)
+
+class FeedbackInsightStore:
+    """回答IDごとの分析結果をSQLiteに保存する（同じ感想は二度と分析しない）"""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with sqlite3.connect(self.path) as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS feedback_insights ("
+                "response_id TEXT PRIMARY KEY, product TEXT, sentiment TEXT, attributes TEXT, topics TEXT, model TEXT, created REAL)"
+            )
+        self.revision = 0
+
+    def known_ids(self):
+        with sqlite3.connect(self.path) as conn:
+            return {r[0] for r in conn.execute("SELECT response_id FROM feedback_insights")}
+
+    def put_many(self, products, results, model_name):
+        """results（{回答ID: 分析結果}）を保存する。products は 回答ID → 商品名"""
+        now = time.time()
+        with sqlite3.connect(self.path) as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO feedback_insights VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(rid, products.get(rid, ""), r["sentiment"], json.dumps(r["attributes"], ensure_ascii=False),
+                  json.dumps(r["topics"], ensure_ascii=False), model_name, now) for rid, r in results.items()]
+            )
+        self.revision += 1
+
+    def frame(self):
+        """保存済みの分析結果（attributes・topics はリスト）"""
+        with sqlite3.connect(self.path) as conn:
+            data = pd.read_sql("SELECT response_id, product, sentiment, attributes, topics FROM feedback_insights", conn)
+        for c in ["attributes", "topics"]:
+            data[c] = data[c].map(json.loads)
+        return data
+
+@st.cache_resource
+def get_feedback_insight_store():
+    return FeedbackInsightStore(os.path.join(LOCAL_CACHE_DIR, "feedback_insights.sqlite"))
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def load_feedback_insights(revision):
+    """保存済みの分析結果を読む（保存が増えた時だけ読み直す）"""
+    return get_feedback_insight_store().frame()
+
+def analyze_feedback_batch(model, items, score_names, max_workers=2, per_minute=15, chunk_size=FEEDBACK_CHUNK_SIZE):
+    """
+    items（[(回答ID, 商品名, 感想), ...]）を chunk_size 件ずつのプロンプトにして並行で分析する。
+    (その塊の結果 {回答ID: 分析結果}, エラー) を完了順に返すジェネレーター（保存は呼び出し側で行う）
+    """
+    limiter = RateLimiter(per_minute)
+    chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+
+    def run(chunk):
+        limiter.wait()
+        text = model.generate_content(build_feedback_prompt(chunk, score_names)).text
+        return parse_feedback_insights(text, [rid for rid, _, _ in chunk], score_names)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(run, chunk): chunk for chunk in chunks}
+        for future in as_completed(futures):
+            try:
+                yield future.result(), None
+            except Exception as e:
+                yield {}, e
+
+def feedback_topic_counts(voice_ids, insights):
+    """
+    表示中の回答に対応する分析結果から、商品 × 不満の話題 の件数表、商品ごとの感情の内訳、
+    感想で触れられた評価項目 × 感情 の件数表を作る
+    """
+    joined = insights[insights["response_id"].isin(set(voice_ids))]
+    if joined.empty:
+        return pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
+    topics = joined[["product", "topics"]].explode("topics", ignore_index=True).dropna(subset=["topics"])
+    topic_table = pd.crosstab(topics["product"], topics["topics"]) if not topics.empty else pd.DataFrame()
+    if not topic_table.empty:
+        topic_table = topic_table[topic_table.sum().sort_values(ascending=False).index]
+    sentiment_table = pd.crosstab(joined["product"], joined["sentiment"].map(FEEDBACK_SENTIMENTS))
+    attrs = joined[["attributes", "sentiment"]].explode("attributes", ignore_index=True).dropna(subset=["attributes"])
+    attribute_table = (
+        pd.crosstab(attrs["attributes"], attrs["sentiment"].map(FEEDBACK_SENTIMENTS)) if not attrs.empty else pd.DataFrame()
+    )
+    if not attribute_table.empty:
+        attribute_table = attribute_table.loc[attribute_table.sum(axis=1).sort_values(ascending=False).index]
+    return topic_table, sentiment_table, attribute_table
 
 # サイドバー基本設定
 with st.sidebar:
@@ -268,6 +2895,8 @@ with st.sidebar:
             ""},
         }
     )
+    # ここから先の Sheets API 呼び出しは、選んだメニューの分として数える
+    set_sheet_call_label(menu)
 
     st.markdown("---")
 
@@ -284,15 +2913,13 @@ with st.sidebar:
                 theme_colors = COLOR_PALETTES[selected_theme]
                 genre = st.selectbox("ジャンル", list(COLUMN_CONFIG.keys()), key="main_g")
                 conf = COLUMN_CONFIG[genre]
-                # ここでジャンルを確定させてから次へ
-                sub_df = df[df[COL_GENRE] == genre].copy()
+                # ここでジャンルを確定させてから次へ（選択肢はジャンルのビット列から引く）
+                genre_bits = filter_index.mask({COL_GENRE: genre})
 
             with row1_col2:
                type_col_name = conf.get("type_col", "アイテムタイプ")
-               if type_col_name in sub_df.columns:
-                   target_data = sub_df[type_col_name]
-                   combined_series = target_data.stack() if isinstance(target_data, pd.DataFrame) else target_data
-                   types = sorted(combined_series.dropna().unique())
+               types = filter_index.options(type_col_name, within=genre_bits)
+               if types:
                    selected_types = st.multiselect("アイテムタイプ（複数可）", types)
                else:
                     selected_types = []
@@ -304,7 +2931,7 @@ with st.sidebar:
             row2_col1, row2_col2, row2_col3 = st.columns(3)
         
             with row2_col1:
-                ages = sorted(sub_df[COL_AGE].unique())
+                ages = filter_index.options(COL_AGE, within=genre_bits)
                 selected_ages = st.multiselect("年代", ages, default=ages)
         
             with row2_col2:
@@ -312,36 +2939,42 @@ with st.sidebar:
                 selected_genders = st.multiselect("性別", genders, default=genders)
             
             with row2_col3:
-                col_env = "最近、ご自身が置かれている環境で気になることはありますか？"
-                env_options = ["乾燥", "日差し・紫外線", "湿気によるべたつき・蒸れ", "摩擦"]
+                col_env = "環境変化"
+                env_options = filter_index.options(col_env, within=genre_bits) or ["乾燥", "日差し・紫外線", "湿気によるべたつき・蒸れ", "摩擦"]
                 selected_envs = st.multiselect("気になる環境", env_options)
 
             # 【3段目】ライフスタイル（スライダーは横幅を贅沢に使う）
             st.markdown("---")
-            col_life = "ライフスタイルでストレス・睡眠・食生活など、気になることはありますか？"
+            col_life = "ライフスタイル"
             life_threshold = st.select_slider(
                 "⚡ ライフスタイル負荷レベル（指定スコア以上の人を抽出）",
                 options=[0, 1, 2, 3, 4, 5],
                 value=0,
                 help="右に動かすほど、生活習慣に課題がある層に絞り込まれます"
         )
+
+        # 選択を条件として積むだけ（行の取り出しは各メニューで必要な列だけ）
+        survey_query = SurveyQuery(df, filter_index, survey_version, [{
+            COL_GENRE: genre,
+            type_col_name: selected_types,
+            COL_AGE: selected_ages,
+            COL_GENDER: selected_genders,
+            col_env: selected_envs,
+        }], life_min=life_threshold)
             
-    def display_recommendation_ranking(target_df, master_df, karte_df):
+    def display_recommendation_ranking(target_df, master_df, karte_df, score_cols=()):
         """
         ターゲット層の悩みからおすすめ商品を生成して表示する共通関数
         """
         st.divider()
         st.subheader("🏆 この層に最適な商品ランキング")
     
-        # 悩み列の特定
-        trouble_col = "肌のお悩み（※複数選択可）"
-        if trouble_col not in target_df.columns:
+        # 悩みの集計
+        trouble_counts = segment_trouble_counts(target_df)
+        if trouble_counts is None:
             st.error("悩みデータが見つかりません。")
             return
-
-        # 悩みの集計
-        all_troubles = target_df[trouble_col].str.split(',|、').explode().str.strip()
-        top_troubles = all_troubles.value_counts().head(3).index.tolist()
+        top_troubles = trouble_counts.head(3).index.tolist()
 
         if not top_troubles:
             st.warning("このターゲット層には集計可能な悩みデータがありません。")
@@ -349,42 +2982,126 @@ with st.sidebar:
 
         st.write(f"💡 主要な悩み: **{', '.join(top_troubles)}**")
     
-        recommendations = []
-        for trouble in top_troubles:
-            # マスタから成分取得
-            m_match = master_df[master_df["キーワード"] == trouble]
-            if not m_match.empty:
-                target_ing = m_match.iloc[0]["推奨成分"]
-                phrase = m_match.iloc[0]["理由・ポップ用フレーズ"]
-            
-                # カルテの「全成分」から検索
-                matches = karte_df[karte_df["全成分"].str.contains(target_ing, na=False, case=False)]
-                for _, p in matches.iterrows():
-                    recommendations.append({
-                        "商品名": p["商品名"],
-                        "きっかけ": trouble,
-                        "推奨成分": target_ing,
-                        "アドバイス": phrase,
-                        "画像": p.get("画像URL", "")
-                    })
-
-        if recommendations:
-            unique_recs = pd.DataFrame(recommendations).drop_duplicates(subset="商品名").head(3)
+        trouble_table = trouble_product_table(master_df, ingredient_index_for(karte_df))
+        unique_recs = recommend_products(target_df, trouble_table, score_cols, top_n=3)
+
+        if not unique_recs.empty:
+            images = karte_primary_rows(karte_df).set_index("商品名")["画像URL"] if "画像URL" in karte_df.columns else pd.Series(dtype=object)
             cols = st.columns(len(unique_recs))
-            for i, (_, rec) in enumerate(unique_recs.iterrows()):
+            for i, rec in enumerate(unique_recs.to_dict("records")):
                 with cols[i]:
-                    if rec["画像"]:
-                        st.image(rec["画像"], use_container_width=True)
+                    img = images.get(rec["商品名"], "")
+                    if img:
+                        st.image(product_image(img), use_container_width=True)
                     st.markdown(f"**第{i+1}位: {rec['商品名']}**")
-                    st.caption(f"🧬 {rec['きっかけ']}ケア / {rec['推奨成分']}")
+                    st.caption(f"🧬 {rec['きっかけ']}ケア / {rec['推奨成分']}（悩み{rec['カバー数']}つに対応）")
                     st.success(rec["アドバイス"])
         else:
             st.info("条件に合う成分を含む商品がまだ登録されていません。")
 
 
-    # --- フィルタ適用ロジック（以下は変更なし） ---
-    # ... (前回のフィルタ適用コードをそのまま使用) ...
-    st.info(f"🔍 現在の分析対象： **{len(sub_df)}** 名")
+    # --- フィルタ適用（ビットマップ索引で行位置だけ求める） ---
+    if df is not None:
+        st.info(f"🔍 現在の分析対象： **{survey_query.count}** 名（絞り込み {survey_query.filter_ms:.1f} ms）")
+
+    # --- スプレッドシートに接続できない間は、ミラーの内容を読み取り専用で表示する ---
+    sheet_mirror = get_sheet_mirror()
+    if sheet_mirror.offline:
+        last_synced = sheet_mirror.last_synced()
+        since = datetime.datetime.fromtimestamp(last_synced).strftime("%m/%d %H:%M") if last_synced else "未同期"
+        st.warning(f"📴 スプレッドシートに接続できません。{since} 時点のデータを読み取り専用で表示しています")
+        if sheet_mirror.unsynced:
+            st.warning(f"まだ一度も同期できていないシート（{'、'.join(sorted(sheet_mirror.unsynced))}）は空のまま表示しています")
+
+    # --- シートへの書き込み待ち行列 ---
+    write_queue = get_write_queue()
+    queue_pending, queue_failed = write_queue.depth()
+    if queue_failed:
+        st.warning(f"⚠️ シートへの書き込みに失敗したままの操作が {queue_failed} 件あります（接続診断から再送できます）")
+    elif queue_pending:
+        st.caption(f"⏳ シートへの書き込み待ち： {queue_pending} 件")
+
+    # --- 接続診断（再実行のたびに認証し直していないかの確認用） ---
+    first_paint_ms = (time.perf_counter() - APP_T0) * 1000
+    with st.expander("🛠️ 接続診断"):
+        st.caption(f"スクリプト開始〜サイドバー描画： {first_paint_ms:.0f} ms")
+        sheet_stats = get_sheet_session().stats
+        st.caption(
+            f"シート接続キャッシュ： ヒット {sheet_stats['hits']} 回 / ミス {sheet_stats['misses']} 回"
+            f" / トークン更新 {sheet_stats['token_refreshes']} 回"
+        )
+        ingest = get_ingest_stats()
+        st.caption(
+            f"アンケート取込（{ingest['mode']}）： +{ingest['new_rows']} 行 / 計 {ingest['total_rows']} 行"
+            f" / {ingest['latency_ms']:.0f} ms"
+        )
+        pipeline = get_pipeline_stats()
+        st.caption(
+            f"分析用データの整形： {pipeline['runs']} 回実行 / 直近 {pipeline['last_ms']:.0f} ms"
+            f"（世代 {pipeline['version']}）"
+        )
+        text_counts = _text_index_holder()["index"].doc_counts
+        st.caption("全文検索インデックス： " + (" / ".join(f"{k} {v} 件" for k, v in text_counts.items()) or "未作成"))
+        if filter_index is not None:
+            st.caption(f"絞り込み索引： {sum(len(b) for b in filter_index.bitmaps.values())} 件のビット列 / 作成 {filter_index.build_ms:.0f} ms")
+        if score_cube is not None:
+            st.caption(f"集計キューブ： {len(score_cube.cells)} セル / 作成 {score_cube.build_ms:.0f} ms")
+        q_stats = write_queue.stats
+        last_flush = "—" if q_stats["last_flush_ms"] is None else f"{q_stats['last_flush_ms']:.0f} ms"
+        st.caption(
+            f"書き込み待ち行列： 待ち {queue_pending} 件 / 失敗 {queue_failed} 件 / 反映済み {q_stats['flushed']} 件"
+            f" / 再試行 {q_stats['retries']} 回 / 直近の反映 {last_flush}"
+        )
+        if q_stats["last_error"]:
+            st.caption(f"直近のエラー： {q_stats['last_error']}")
+        if queue_failed:
+            st.dataframe(write_queue.failed(), hide_index=True, use_container_width=True)
+            col_retry, col_discard = st.columns(2)
+            if col_retry.button("🔁 失敗した書き込みを再送", key="queue_retry"):
+                write_queue.retry_failed()
+                st.rerun()
+            if col_discard.button("🗑️ 失敗した書き込みを破棄", key="queue_discard"):
+                write_queue.discard_failed()
+                st.rerun()
+        mirror_stats = sheet_mirror.stats
+        mirror_rows = sum(n for _, n, _ in sheet_mirror.sheets().values())
+        last_sync = "—" if mirror_stats["last_sync_ms"] is None else f"{mirror_stats['last_sync_ms']:.0f} ms"
+        st.caption(
+            f"ローカルミラー（{'接続なし・読み取り専用' if sheet_mirror.offline else '同期中'}）： {len(sheet_mirror.sheets())} シート / {mirror_rows} 行"
+            f" / 同期 {mirror_stats['syncs']} 回（更新確認 {mirror_stats['checks']} 回）・書き換え {mirror_stats['rows_written']} 行 / 直近 {last_sync}"
+        )
+        if mirror_stats["last_error"]:
+            st.caption(f"ミラー同期の直近のエラー： {mirror_stats['last_error']}")
+        budget = get_sheet_session().budget
+        used = budget.used_last_minute()
+        st.caption(
+            f"Sheets API（直近1分）： 読み込み {used['読み込み']} / {budget.capacity:.0f} 回"
+            f" ・ 書き込み {used['書き込み']} / {budget.capacity:.0f} 回"
+            f" / 計 {budget.stats['calls']} 回 ・ 順番待ち {budget.stats['throttled']} 回（{budget.stats['wait_ms'] / 1000:.1f} 秒）"
+            f" ・ 429 {budget.stats['rate_limited']} 回"
+        )
+        if budget.stats["calls"]:
+            st.dataframe(budget.calls_frame(), hide_index=True, use_container_width=True)
+            st.caption("所要時間の分布（回数）")
+            st.dataframe(budget.histogram_frame().T, use_container_width=True)
+        img_stats = get_image_cache().stats
+        st.caption(f"画像キャッシュ： ヒット {img_stats['hits']} 回 / ミス {img_stats['misses']} 回 / 削除 {img_stats['evictions']} 件")
+        gen_stats = get_generation_cache().stats
+        st.caption(f"AI生成キャッシュ： ヒット {gen_stats['hits']} 回 / ミス {gen_stats['misses']} 回 / 削除 {gen_stats['evictions']} 件")
+        import_profile = get_import_profile()
+        import_total = sum(import_profile.values())
+        budget_ms = float(st.secrets.get("STARTUP_BUDGET_MS", 3000))
+        st.caption(f"モジュール読み込み（{st.secrets.get('STARTUP_MODE', 'lazy')}）： 計 {import_total:.0f} ms / 目標 {budget_ms:.0f} ms")
+        if import_total > budget_ms:
+            st.warning("⚠️ 起動時の読み込みが目標時間を超えています")
+        st.dataframe(
+            pd.DataFrame(
+                sorted(import_profile.items(), key=lambda kv: -kv[1]),
+                columns=["モジュール", "読み込み時間(ms)"]
+            ).round(1),
+            hide_index=True,
+            use_container_width=True
+        )
 
     # --- 各メニュー機能 ---
 if menu == "📲 アンケートQR生成":
@@ -392,11 +3109,7 @@ if menu == "📲 アンケートQR生成":
         
         # --- データの読み込み ---
         try:
-            client = get_gspread_client()
-            sh = client.open("Cosme Data")
-            sheet_k = sh.worksheet("カルテ")
-            records = sheet_k.get_all_records()
-            df_karte = pd.DataFrame(records) if records else pd.DataFrame()
+            df_karte = load_karte_df()
         except Exception as e:
             st.error(f"データ読み込みエラー: {e}")
             df_karte = pd.DataFrame()
@@ -451,6 +3164,7 @@ if menu == "📲 アンケートQR生成":
                         short_url = requests.get(api_url, timeout=5).text
                         
                         # QRコード作成
+                        qrcode = lazy_import("qrcode")
                         qr = qrcode.QRCode(box_size=10, border=4)
                         qr.add_data(short_url)
                         qr.make(fit=True)
@@ -476,9 +3190,11 @@ if menu == "📲 アンケートQR生成":
             # ------------------------ 
 elif menu == "✨ AIポップ作成":
         st.header("✨ AIポップ案制作")
+        model = get_gemini_model()
 
         # 1. NGワード辞書の読み込みと編集機能（サイドバー）
         ng_dict = load_ng_words()
+        ng_scanner = ng_scanner_for(ng_dict)
         
         with st.sidebar.expander("🚫 NGワード辞書を編集"):
             new_word = st.text_input("追加する単語", placeholder="例：最高", key="add_ng_word")
@@ -487,19 +3203,14 @@ elif menu == "✨ AIポップ作成":
             if st.button("➕ 辞書に追加", key="btn_add_ng"):
                 if new_word and new_reason:
                     try:
-                        client = get_gspread_client()
-                        sh = client.open("Cosme Data")
-                        sheet_ng = sh.worksheet("NGワード辞書")
-            
                        # 現在の日時を取得
                         now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             
-                       # [NGワード, 理由, 更新日時] の順で追加
-                        sheet_ng.append_row([new_word, new_reason, now])
-            
-                        st.success(f"「{new_word}」を追加しました！")
-                        st.cache_data.clear() 
-                        st.rerun()
+                       # [NGワード, 理由, 更新日時] の順で追加（書き込み待ち行列から反映）
+                        done, _ = queue_sheet_write("NGワード辞書", "append_rows", {"rows": [[new_word, new_reason, now]]}, timeout=5)
+                        if done:
+                            st.rerun()
+                        st.info(f"「{new_word}」の追加を受け付けました。反映までしばらくお待ちください。")
                     except Exception as e: st.error(f"追加失敗: {e}")
 
             st.markdown("---")
@@ -509,39 +3220,24 @@ elif menu == "✨ AIポップ作成":
                 col_w.write(f"**{word}**")
                 if col_d.button("🗑️", key=f"del_ng_{word}"):
                     try:
-                        client = get_gspread_client()
-                        sh = client.open("Cosme Data")
-                        sheet_ng = sh.worksheet("NGワード辞書")
-                        cell = sheet_ng.find(word)
-                        if cell:
-                            sheet_ng.delete_rows(cell.row)
-                            st.success("削除完了")
-                            st.cache_data.clear()
+                        done, _ = queue_sheet_write("NGワード辞書", "delete_value", {"value": word, "column": 1}, timeout=5)
+                        if done:
                             st.rerun()
-                    except: st.error("削除失敗")
+                        st.info(f"「{word}」の削除を受け付けました。反映までしばらくお待ちください。")
+                    except Exception as e: st.error(f"削除失敗: {e}")
 
         # 2. 商品データの取得（真っ白回避）
         survey_items = set()
-        if not sub_df.empty and conf["item_col"] in sub_df.columns:
-            # --- 384行目付近の修正 ---
-            item_col_name = conf["item_col"]
-            target_item_data = sub_df[item_col_name]
-
-            if isinstance(target_item_data, pd.DataFrame):
-               # 複数列（商品名が5つなど）ある場合、すべてを1列にまとめてからユニーク値を取る
-               survey_items = set(target_item_data.stack().dropna().unique())
-            else:
-                # 1列だけの場合
-                survey_items = set(target_item_data.dropna().unique())
-                # -------------------------
+        if df is not None and conf["item_col"] in survey_query.columns:
+            # 商品名の列だけを取り出してユニーク値を取る
+            survey_items = set(survey_query.unique(conf["item_col"]))
 
         saved_records = []
         saved_items = set()
+        df_temp = pd.DataFrame()
         try:
-            client = get_gspread_client()
-            sh = client.open("Cosme Data")
-            sheet_k = sh.worksheet("カルテ")
-            saved_records = sheet_k.get_all_records()
+            df_temp = load_karte_df()
+            saved_records = df_temp.to_dict("records")
             saved_items = {row.get('商品名', '') for row in saved_records if row.get('商品名')}
         except: pass
         
@@ -552,19 +3248,12 @@ elif menu == "✨ AIポップ作成":
 
         selected_item = st.selectbox("制作する商品を選択", all_items, key="ai_pop_selectbox")
         
-        ## 1. まず変数の中身をリセット
-        saved_info = ""
-        current_row_idx = None
-
-        # 2. saved_records（スプレッドシートの中身）を1行ずつチェック
-        for i, row in enumerate(saved_records):
-            # 商品名が一致するかチェック
-            if str(row.get('商品名')) == str(selected_item):
-                saved_info = row.get('公式情報', '')
-                current_row_idx = i + 2  # 行番号を保存
-                break  # 見つかったらループ終了
-
-        # 3. もし見つからなかった、あるいは公式情報が空だった場合の処理
+        # 1. カルテの索引から選んだ商品の行を引く（保存先と同じ行）
+        karte_repo = karte_repository_for(df_temp)
+        saved_row = karte_repo.row_of.get(selected_item)
+        saved_info = df_temp.iloc[saved_row - 2].get('公式情報', '') if saved_row else ""
+
+        # 2. もし見つからなかった、あるいは公式情報が空だった場合の処理
         if not saved_info:
             saved_info = "（カルテに公式情報が登録されていません）"
 
@@ -581,22 +3270,21 @@ elif menu == "✨ AIポップ作成":
             
             # 選択中の商品の画像URLを取得
             # --- ここから差し替え ---
-            import pandas as pd
-            df_temp = pd.DataFrame(saved_records)
-            
             # 選択中の商品名に一致する行を探す
-            item_row = df_temp[df_temp["商品名"] == selected_item]
+            item_row = karte_primary_rows(df_temp)
+            item_row = item_row[item_row["商品名"] == selected_item] if "商品名" in item_row.columns else item_row
+            img_url = ""
 
             with img_preview_col:
                 if not item_row.empty:
                     # 「画像URL」列が存在するか確認
                     if "画像URL" in item_row.columns:
-                        # 一番新しいデータ（最後の行）のURLを取得
-                        img_url = item_row.iloc[-1]["画像URL"]
+                        # 保存先と同じ行（karte_primary_rows）のURLを取得
+                        img_url = item_row.iloc[0]["画像URL"]
                         
                         # URLがちゃんと入っているかチェック
                         if pd.notna(img_url) and str(img_url).startswith("http"):
-                            st.image(img_url, use_container_width=True)
+                            st.image(product_image(img_url), use_container_width=True)
                         else:
                             st.caption("🖼️ 画像はまだ登録されていません")
                     else:
@@ -611,7 +3299,11 @@ elif menu == "✨ AIポップ作成":
                 height=150, 
                 key=f"input_info_{selected_item}" # キーに商品名を含めることで、商品を変えた時に中身を強制更新する
             )
+            if ng_scanner.scan(input_info):
+                render_ng_check(ng_scanner, input_info, "引継ぎ情報")
             human_hint = st.text_input("AIへの追加指示", placeholder="例：30代向け、上品に", key="input_hint")
+            force_regenerate = st.checkbox("🔁 キャッシュを使わず再生成", key="force_regenerate_pop")
+            use_streaming = st.checkbox("⚡ 生成中の文章を順次表示する", value=True, key="stream_pop")
             run_generate = st.button("🚀 AIポップコピーを生成", key="btn_generate_ai_pop")
         with col2:
             st.subheader("📊 顧客の声（分析結果）")
@@ -624,37 +3316,19 @@ elif menu == "✨ AIポップ作成":
                 key="gender_filter_radio"
             )
 
-            # --- 2. データの絞り込みロジック ---
-            # 選択した商品で絞り込み
-            # --- 487行目の修正：商品詳細データの抽出 ---
-            item_col = conf["item_col"]
-            target_item_col = sub_df[item_col]
-
-            # 複数列（商品名）のどこかに、選択された商品名がある行を探す
-            if isinstance(target_item_col, pd.DataFrame):
-               # 横方向に見て、どれか1列でも一致すればTrueにする
-               mask = (target_item_col == selected_item).any(axis=1)
-            else:
-                # 1列しかな\い場合は普通に比較
-                mask = (target_item_col == selected_item)
-
-            item_all_data = sub_df[mask].copy()
-            # ----------------------------------------
-            
-            # 性別でさらに絞り込み
-            if gender_target != "全て":
-                # アンケートデータの列名が「性別」であることを前提としています
-                target_df = item_all_data[item_all_data["性別"] == gender_target]
-            else:
-                target_df = item_all_data
-
-            # スコアの平均を計算
-            item_stats = target_df[conf["scores"]].mean()
+            # --- 2. 集計キューブから、選択した商品（と性別）の平均を読む ---
+            item_stats = pd.Series(float("nan"), index=conf["scores"])
+            if df is not None:
+                item_query = survey_query.where({COL_GENDER: None if gender_target == "全て" else [gender_target]})
+                item_cube, item_filters = item_query.cube(conf["scores"])
+                item_means = item_cube.means(filters={**item_filters, "商品名": [selected_item]}, scores=conf["scores"])
+                if selected_item in item_means.index:
+                    item_stats = item_means.loc[selected_item].reindex(conf["scores"])
 
             # --- 3. グラフとヒントの表示 ---
             if not item_stats.dropna().empty:
                 st.info(f"【{gender_target}】評価トップ: {item_stats.idxmax()}")
-                import plotly.graph_objects as go
+                go = lazy_import("plotly.graph_objects")
 
                 # --- 修正ポイント：最後と最初をつなげる ---
                 # 値のリストの最後に、最初の値を付け加える
@@ -680,27 +3354,26 @@ elif menu == "✨ AIポップ作成":
                 )
                 st.plotly_chart(fig_spy, use_container_width=True)
                 
-                # AIへのヒントに性別情報を追加
-                analysis_hint = f"顧客分析（{gender_target}）: {item_stats.idxmax()}が特に評価されています。"
             else:
                 st.warning(f"⚠️ {gender_target}の回答データがありません")
-                analysis_hint = f"{gender_target}向けに、商品の魅力を新規提案してください。"
+            # AIへのヒントに性別情報を追加
+            analysis_hint = build_analysis_hint(item_stats, gender_target)
 
         # 4. 生成処理と薬機法チェック
         if run_generate:
             if model:
-                with st.spinner("AIが画像と情報を分析して生成中..."):
+                # ストリーミング時はスピナーでページを止めず、届いた文字から表示する
+                with (contextlib.nullcontext() if use_streaming else st.spinner("AIが画像と情報を分析して生成中...")):
                     try:
                         # --- 画像解析の準備 ---
                         image_data = None
-                        if img_url:
+                        image_bytes = None
+                        if pd.notna(img_url) and str(img_url).startswith("http"):
                             try:
-                                import requests
-                                from PIL import Image
-                                import io
-                                # img_urlから画像をダウンロード
-                                img_res = requests.get(img_url)
-                                image_data = Image.open(io.BytesIO(img_res.content))
+                                Image = lazy_import("PIL.Image")
+                                # 画像キャッシュから縮小版を取得（送信サイズと待ち時間を減らす）
+                                image_bytes = get_image_cache().get_thumbnail(str(img_url), 768)
+                                image_data = Image.open(BytesIO(image_bytes))
                             except:
                                 st.warning("画像の読み込みに失敗したため、テキストのみで生成します。")
                 
@@ -709,65 +3382,41 @@ elif menu == "✨ AIポップ作成":
 
                         # 1. ここに設置！追加指示が空の場合のデフォルト設定
                         if not human_hint:
-                            human_hint = "親しみやすく、かつプロフェッショナルな雰囲気"
+                            human_hint = DEFAULT_POP_TONE
 
                         # 2. saved_recordsから現在の商品の情報を特定（既存のコード）
                         current_item_data = next((row for row in saved_records if str(row.get('商品名')) == str(selected_item)), {})
                         item_genre = current_item_data.get('ジャンル', '不明')
                         item_type = current_item_data.get('アイテムタイプ', '不明')
 
-                        # 3. NGワードをテキスト化
-                        ng_rules_text = ""
-                        if ng_dict:
-                            for word, reason in ng_dict.items():
-                                ng_rules_text += f"・{word}（理由: {reason}）\n"
-                        else:
-                            ng_rules_text = "薬機法を遵守すること"
-
-                        # 4. プロンプトを作成（ここから差し替え）
-                        prompt = f"""
-                        あなたは化粧品販売のプロであり、売れっ子のPOPライターです。
-                        {'添付画像からデザインの雰囲気を読み取り、' if image_data else ''}
-                        提供された情報を元に、お客様の心に刺さる「【提案1】〜【提案3】」を作成してください。
-
-                        【最重要】薬機法を遵守し、治療効果や「最高」等の誇大表現は避けてください。
-
-                        商品名: {selected_item}
-                        カテゴリー: {item_genre} （{item_type}）
-                        トーン: {human_hint} # ← ここに反映されます
-                        特徴: {input_info}
-                        分析結果: {analysis_hint}
-
-                        【⚠️ 絶対に使用禁止のNGワード】
-                        {ng_rules_text}
-
-                        # 💎 必須の出力ルール:
-                        1. 挨拶や「承知いたしました」等の前置きは一切書かないでください。
-                        2. 以下の【形式】で3案出力してください。
-           
-                          【提案1】タイトル（20文字前後）
-                          （1行空ける）
-                          本文（100文字前後。改行を適宜挟み、読みやすく）
-
-                        3. トーン＆マナー:
-                           - 必ず【{human_hint}】という雰囲気を言葉選びに反映させてください。
-                           - データが不足していても、プロの知識で「いい感じ」に魅力的な文章に仕上げてください。
-
-                        4. 切り口の指定:
-                           案1：ターゲットの悩みや願望に寄り添う（例：〇〇を求める方へ）
-                           案2：肌のバランスや健やかさを強調
-                           案3：毎日のケアが特別になる体験・感情を強調
-
-                        それでは、案のみを出力してください。
-                        """
-
-                        # --- Geminiへのリクエスト (画像があればリスト形式で渡す) ---
-                        if image_data:
-                            res = model.generate_content([prompt, image_data])
+                        # 3. NGワードをテキスト化 → 4. プロンプトを作成
+                        prompt = build_pop_prompt(
+                            selected_item, item_genre, item_type, human_hint, input_info,
+                            analysis_hint, build_ng_rules_text(ng_dict), with_image=bool(image_data)
+                        )
+
+                        # --- 同じプロンプト・同じ画像なら保存済みの結果を使う ---
+                        gen_cache = get_generation_cache()
+                        cache_key = gen_cache.make_key(getattr(model, "model_name", ""), prompt, image_bytes if image_data else None)
+                        cached_copy = None if force_regenerate else gen_cache.get(cache_key)
+                        if cached_copy is not None:
+                            st.session_state["generated_copy"] = cached_copy
+                            st.caption("⚡ 以前の生成結果を表示しています（「キャッシュを使わず再生成」で作り直せます）")
                         else:
-                            res = model.generate_content(prompt)
+                            # --- Geminiへのリクエスト (画像があればリスト形式で渡す) ---
+                            contents = [prompt, image_data] if image_data else prompt
+                            if use_streaming:
+                                stream_area, ng_area = st.empty(), st.empty()
+                                generated, first_sec, total_sec = stream_pop_copy(model, contents, ng_scanner, stream_area, ng_area)
+                                stream_area.empty()
+                                st.caption(f"⏱️ 最初の文字まで {first_sec:.2f} 秒 / 生成完了まで {total_sec:.2f} 秒")
+                            else:
+                                t0 = time.perf_counter()
+                                generated = model.generate_content(contents).text
+                                st.caption(f"⏱️ 生成完了まで {time.perf_counter() - t0:.2f} 秒")
                             
-                        st.session_state["generated_copy"] = res.text
+                            st.session_state["generated_copy"] = generated
+                            gen_cache.put(cache_key, generated)
                     except Exception as e: 
                         st.error(f"生成エラー: {e}")
             else:
@@ -775,36 +3424,137 @@ elif menu == "✨ AIポップ作成":
                 
             st.success("🤖 AI提案のコピー")
             st.write(st.session_state["generated_copy"])
+            render_ng_check(ng_scanner, st.session_state["generated_copy"], "AI提案")
             
             st.subheader("📝 採用案をカルテに保存")
             final_choice = st.text_area("採用・編集後のテキスト", value=st.session_state["generated_copy"], height=100)
+            render_ng_check(ng_scanner, final_choice, "採用・編集後のテキスト")
             
             if st.button("💾 この内容をカルテに保存する", key="btn_save_karte"):
-                if current_row_idx:
+                if selected_item in karte_repo.row_of:
                     try:
-                        headers = sheet_k.row_values(1)
-                        if "ポップ案" in headers:
-                            col_idx = headers.index("ポップ案") + 1
-                            sheet_k.update_cell(current_row_idx, col_idx, final_choice)
+                        if "ポップ案" not in karte_repo.headers:
+                            raise ValueError("「ポップ案」列が見つかりません。")
+                        done, _ = queue_sheet_write("カルテ", "karte_fields", {"name": selected_item, "fields": {"ポップ案": final_choice}}, timeout=10)
+                        if done:
                             st.balloons()
                             st.success(f"「{selected_item}」のカルテに保存しました！")
-                        else: st.error("「ポップ案」列が見つかりません。")
+                        else:
+                            st.info("保存を受け付けました。反映までしばらくお待ちください。")
+                    except ValueError as e: st.error(str(e))
                     except Exception as e: st.error(f"保存失敗: {e}")
                 else: st.warning("先に「商品カルテ編集」からこの商品を登録してください。")
 
+        # 5. キャンペーン用の一括生成
+        st.markdown("---")
+        with st.expander("📦 ポップ案を一括生成（キャンペーン用）"):
+            b_col1, b_col2 = st.columns(2)
+            with b_col1:
+                batch_gens = st.multiselect("ジャンル", list(COLUMN_CONFIG.keys()), key="batch_pop_gen")
+            with b_col2:
+                batch_type_master = sorted({t for g in (batch_gens or COLUMN_CONFIG.keys()) for t in COLUMN_CONFIG[g]["types"]})
+                batch_types = st.multiselect("アイテムタイプ", batch_type_master, key="batch_pop_type")
+
+            batch_df = df_temp.copy()
+            if not batch_df.empty:
+                if batch_gens:
+                    batch_df = batch_df[batch_df["ジャンル"].astype(str).apply(lambda v: any(g in v for g in batch_gens))]
+                if batch_types:
+                    batch_df = batch_df[batch_df["アイテムタイプ"].astype(str).apply(lambda v: any(t in v for t in batch_types))]
+                batch_df = karte_primary_rows(batch_df)
+            st.write(f"対象商品: **{len(batch_df)}件**")
+
+            b_col3, b_col4, b_col5 = st.columns(3)
+            batch_gender = b_col3.selectbox("ターゲット層", ["全て", "女性", "男性", "回答しない／その他"], key="batch_pop_gender")
+            batch_workers = b_col4.slider("同時実行数", 1, 8, 4, key="batch_pop_workers")
+            batch_rpm = b_col5.number_input("1分あたりの上限", 1, 300, int(st.secrets.get("GEMINI_RPM", 15)), key="batch_pop_rpm")
+            batch_hint = st.text_input("AIへの追加指示（全商品共通）", placeholder="例：春のキャンペーン向けに華やかに", key="batch_pop_hint")
+            batch_regenerate = st.checkbox("🔁 キャッシュを使わず再生成", key="batch_pop_regenerate")
+
+            if st.button("🚀 一括生成を開始", key="btn_batch_pop", disabled=batch_df.empty):
+                if not model:
+                    st.error("APIキーが設定されていません。")
+                else:
+                    ng_rules_text = build_ng_rules_text(ng_dict)
+                    jobs = {}
+                    for _, p_row in batch_df.iterrows():
+                        p_name = str(p_row.get("商品名", ""))
+                        if not p_name:
+                            continue
+                        p_genre = str(p_row.get("ジャンル", ""))
+                        p_conf = next((COLUMN_CONFIG[g.strip()] for g in p_genre.split("/") if g.strip() in COLUMN_CONFIG), conf)
+                        p_stats = product_score_stats(df, p_name, batch_gender, p_conf["scores"])
+                        jobs[p_name] = build_pop_prompt(
+                            p_name, p_genre or "不明", p_row.get("アイテムタイプ", "不明"),
+                            batch_hint or DEFAULT_POP_TONE, p_row.get("公式情報", "") or "（カルテに公式情報が登録されていません）",
+                            build_analysis_hint(p_stats, batch_gender), ng_rules_text
+                        )
+
+                    progress = st.progress(0.0, text="生成中...")
+                    batch_results, batch_errors = {}, {}
+                    t0 = time.perf_counter()
+                    for done, (p_name, text, err) in enumerate(generate_pop_batch(model, jobs, batch_workers, batch_rpm, cache=get_generation_cache(), use_cache=not batch_regenerate), start=1):
+                        if err:
+                            batch_errors[p_name] = str(err)
+                        else:
+                            batch_results[p_name] = text
+                        progress.progress(done / len(jobs), text=f"生成中... {done}/{len(jobs)}")
+                    progress.empty()
+                    st.session_state["batch_pop_results"] = batch_results
+                    st.success(f"✅ {len(batch_results)}件 生成しました（{time.perf_counter() - t0:.1f} 秒）")
+                    if batch_errors:
+                        st.warning(f"⚠️ {len(batch_errors)}件 失敗しました")
+                        st.dataframe(pd.DataFrame(batch_errors.items(), columns=["商品名", "エラー"]), hide_index=True, use_container_width=True)
+
+            batch_results = st.session_state.get("batch_pop_results", {})
+            if batch_results:
+                batch_view = pd.DataFrame(batch_results.items(), columns=["商品名", "ポップ案"])
+                batch_view["NGワード"] = batch_view["ポップ案"].map(lambda t: "、".join(sorted({w for _, _, w, _ in ng_scanner.scan(t)})))
+                st.dataframe(batch_view, hide_index=True, use_container_width=True)
+                if st.button("💾 生成結果をまとめてカルテに保存", key="btn_batch_pop_save"):
+                    try:
+                        if "ポップ案" not in karte_repository_for(df_temp).headers:
+                            raise ValueError("「ポップ案」列が見つかりません。")
+                        # 行番号は書き込む時に引く（待っている間に行がずれても別の商品に書かない）
+                        fields_by_name = {name: {"ポップ案": text} for name, text in batch_results.items() if text}
+                        done, result = queue_sheet_write("カルテ", "karte_fields_many", {"fields_by_name": fields_by_name}, timeout=15)
+                        if done:
+                            st.session_state.pop("batch_pop_results", None)
+                            st.success(f"{result['updated']}件のポップ案を保存しました！")
+                            if result["missing"]:
+                                st.warning("カルテに見つからず保存しなかった商品： " + "、".join(result["missing"]))
+                        else:
+                            st.info("保存を受け付けました。反映までしばらくお待ちください。")
+                    except Exception as e: st.error(f"保存失敗: {e}")
+
+        # 6. 保存済みポップ案の一括チェック
+        with st.expander("🔎 保存済みポップ案をまとめてNGワードチェック"):
+            if "ポップ案" in df_temp.columns:
+                pop_hits = [
+                    (name, word, reason)
+                    for name, text in zip(df_temp["商品名"], df_temp["ポップ案"])
+                    for _, _, word, reason in ng_scanner.scan(text)
+                ]
+                if pop_hits:
+                    st.warning(f"🚫 {len({h[0] for h in pop_hits})}商品で NGワードが見つかりました")
+                    st.dataframe(
+                        pd.DataFrame(pop_hits, columns=["商品名", "NGワード", "理由"]).value_counts().reset_index(name="件数"),
+                        hide_index=True,
+                        use_container_width=True
+                    )
+                else:
+                    st.success(f"✅ {len(df_temp)}件のポップ案にNGワードはありません")
+            else:
+                st.info("カルテに「ポップ案」列がありません。")
+
 # --- 商品カルテ編集・新規作成セクション ---
 elif menu == "📋 商品カルテ編集":
     st.header("📋 商品カルテ：編集・管理")
 
     try:
-        client = get_gspread_client()
-        sh = client.open("Cosme Data")
-        sheet_karte = sh.worksheet("カルテ")
-        records = sheet_karte.get_all_records()
+        df_karte = load_karte_df()
             
-        if records:
-            df_karte = pd.DataFrame(records)
-        else:
+        if df_karte.empty:
             df_karte = pd.DataFrame(columns=[
                 "新規", "更新", "作成者", "ジャンル", "アイテムタイプ", 
                 "商品名", "全成分", "公式情報", "AIコピー/ポップ案", "メモ", "画像URL"
@@ -828,9 +3578,11 @@ elif menu == "📋 商品カルテ編集":
             item_list = [n for n in df_karte["商品名"].unique() if n]
             if item_list:
                 selected_name = st.selectbox("編集する商品を選択", item_list)
-                target_rows = df_karte[df_karte["商品名"] == selected_name]
+                # 保存先（KarteRepository の索引）と同じ行を表示・編集する
+                target_rows = karte_primary_rows(df_karte)
+                target_rows = target_rows[target_rows["商品名"] == selected_name]
                 if not target_rows.empty:
-                    latest_row = target_rows.iloc[-1]
+                    latest_row = target_rows.iloc[0]
                     target_item_name = selected_name
                     official_info_val = latest_row.get("公式情報", "")
                     memo_val = latest_row.get("メモ", "")
@@ -840,6 +3592,9 @@ elif menu == "📋 商品カルテ編集":
                     current_gen = str(latest_row.get("ジャンル", ""))
                     current_type = str(latest_row.get("アイテムタイプ", ""))
                     current_ingredients = latest_row.get("全成分", "")
+                    # 開いた時に表示した「更新」を保存時の競合チェックに使う（索引は全セッション共通なので使えない）
+                    if selected_name not in st.session_state.get("karte_edit_updated", {}):
+                        st.session_state["karte_edit_updated"] = {selected_name: str(latest_row.get("更新", ""))}
 
         st.markdown("---")
         st.markdown("### 📝 カルテ入力")
@@ -881,10 +3636,15 @@ elif menu == "📋 商品カルテ編集":
         st.subheader("📸 商品画像")
         delete_image = False
         if current_img_url:
-            st.image(current_img_url, caption="現在の画像", width=200)
+            st.image(product_image(current_img_url, 400), caption="現在の画像", width=200)
             delete_image = st.checkbox("🗑️ この画像を削除する")
         uploaded_file = st.file_uploader("新しい画像をアップロード", type=["jpg", "jpeg", "png"])
 
+        # 保存しようとした時に他の人の更新とぶつかった場合だけ、上書きの確認を出す
+        force_save = False
+        if st.session_state.get("karte_conflict") == edit_item_name:
+            force_save = st.checkbox("⚠️ 他の人の変更を上書きして保存する", key="karte_force_save")
+
         if st.button("💾 カルテ内容を保存・更新", key="save_karte_edit"):
             if not edit_item_name or not selected_gens or not selected_types:
                 st.error("商品名、ジャンル、アイテムタイプは必須です。")
@@ -900,23 +3660,89 @@ elif menu == "📋 商品カルテ編集":
                         new_image_url = res_url if res_url else current_img_url
                     else: new_image_url = current_img_url
 
-                    new_row = [
-                    str(final_base_date), now_str, edit_author, main_cat, sub_cat,
-                    edit_item_name, edit_ingredients, edit_official_info, "", edit_memo, new_image_url
-                ]
+                    record = {
+                        "新規": str(final_base_date), "更新": now_str, "作成者": edit_author,
+                        "ジャンル": main_cat, "アイテムタイプ": sub_cat, "商品名": edit_item_name,
+                        "全成分": edit_ingredients, "公式情報": edit_official_info, "ポップ案": "",
+                        "メモ": edit_memo, "画像URL": new_image_url,
+                    }
 
-                    all_records = sheet_karte.get_all_records()
-                    df_all = pd.DataFrame(all_records)
-
-                    if not df_all.empty and edit_item_name in df_all["商品名"].values:
-                        matching_rows = df_all[df_all["商品名"] == edit_item_name]
-                        row_index = matching_rows.index[0] + 2
-                        new_row[0] = str(matching_rows.iloc[0]["新規"])
-                        sheet_karte.update(range_name=f"A{row_index}:K{row_index}", values=[new_row])
-                        st.success(f"「{edit_item_name}」を更新しました！")
+                    # 行番号は索引から引き、シート全体は読み直さない（ポップ案・新規・商品IDは上書きしない）
+                    df_all = load_karte_df()
+                    karte_repository_for(df_all)
+                    try:
+                        done, result = queue_sheet_write("カルテ", "karte_upsert", {
+                            "record": record, "expected_updated": st.session_state.get("karte_edit_updated", {}).get(edit_item_name),
+                            "force": force_save,
+                        }, timeout=15)
+                    except KarteConflictError as e:
+                        st.session_state["karte_conflict"] = edit_item_name
+                        st.warning(f"⚠️ {e}。内容を確認し、上書きする場合はチェックを入れて再度保存してください。")
+                    except SheetsOfflineError as e:
+                        st.warning(f"📴 {e}")
                     else:
-                        sheet_karte.append_row(new_row)
-                        st.success(f"「{edit_item_name}」を新規登録しました！")
+                        st.session_state.pop("karte_conflict", None)
+                        # 続けて編集した時に、自分の保存を他の人の変更と見なさない
+                        st.session_state["karte_edit_updated"] = {edit_item_name: now_str}
+                        ingredient_index_for(df_all).upsert(edit_item_name, edit_ingredients)
+                        if not done:
+                            st.info(f"「{edit_item_name}」の保存を受け付けました。反映までしばらくお待ちください。")
+                        elif result == "updated":
+                            st.success(f"「{edit_item_name}」を更新しました！")
+                        else:
+                            st.success(f"「{edit_item_name}」を新規登録しました！")
+
+        # --- 一括インポート・エクスポート ---
+        st.markdown("---")
+        with st.expander("📦 カルテの一括インポート・エクスポート"):
+            st.caption("CSV / JSONL / JSON（列: " + "、".join(KARTE_IMPORT_COLS) + "）。同じ商品名は最後の行を使い、既存の商品は上書きします（ポップ案は変更しません）。")
+            import_file = st.file_uploader("取り込むファイル", type=["csv", "jsonl", "ndjson", "json"], key="karte_import_file")
+            if import_file is not None:
+                try:
+                    import_df = read_karte_import(import_file.getvalue(), import_file.name)
+                    accepted, import_errors, n_dupes = validate_karte_import(import_df, COLUMN_CONFIG)
+                except Exception as e:
+                    st.error(f"ファイルを読み込めません: {e}")
+                else:
+                    repo = karte_repository_for(load_karte_df())
+                    n_new = sum(1 for name in accepted["商品名"] if name not in repo.row_of)
+                    st.write(f"取込可能: **{len(accepted)}** 件（新規 {n_new} / 更新 {len(accepted) - n_new}）"
+                             f" / エラー {len(import_errors)} 件 / 重複 {n_dupes} 件")
+                    if import_errors:
+                        st.dataframe(pd.DataFrame(import_errors, columns=["行", "理由"]), hide_index=True, use_container_width=True)
+                    st.dataframe(accepted.head(20), hide_index=True, use_container_width=True)
+                    if len(accepted) and st.button(f"📥 {len(accepted)} 件を取り込む", key="karte_import_run"):
+                        now_str = (datetime.datetime.now() + datetime.timedelta(hours=9)).strftime("%Y-%m-%d %H:%M:%S")
+                        records = [
+                            {"新規": now_str, "更新": now_str, **({} if rec["商品名"] in repo.row_of else {"作成者": "一括インポート"}), **rec}
+                            for rec in accepted.to_dict("records")
+                        ]
+                        t0 = time.perf_counter()
+                        with st.spinner("取り込み中..."):
+                            done, result = queue_sheet_write("カルテ", "karte_bulk", {"records": records, "chunk_size": KARTE_IMPORT_CHUNK}, timeout=120)
+                        index = ingredient_index_for(load_karte_df())
+                        for rec in records:
+                            if "全成分" in rec:
+                                index.upsert(rec["商品名"], rec["全成分"])
+                        if done:
+                            st.success(
+                                f"新規 {result['created']} 件・更新 {result['updated']} 件を取り込みました"
+                                f"（{result['requests']} リクエスト / {time.perf_counter() - t0:.1f} 秒）"
+                            )
+                        else:
+                            st.info("取り込みを受け付けました。反映までしばらくお待ちください。")
+
+            st.markdown("**エクスポート**")
+            export_formats = ["CSV"] + (["Parquet"] if parquet_available() else [])
+            export_fmt = st.radio("形式", export_formats, horizontal=True, key="karte_export_fmt")
+            if not df_karte.empty:
+                st.download_button(
+                    f"📤 カルテを{export_fmt}で書き出す",
+                    data=export_karte(df_karte, export_fmt.lower()),
+                    file_name=f"karte_{datetime.date.today():%Y%m%d}.{export_fmt.lower()}",
+                    mime="text/csv" if export_fmt == "CSV" else "application/octet-stream",
+                    key="karte_export",
+                )
 
     except Exception as e:
         st.error(f"エラーが発生しました: {e}")
@@ -924,13 +3750,25 @@ elif menu == "📋 商品カルテ編集":
 elif menu == "📚 商品カルテ一覧":
         st.header("📋 商品カルテ・アーカイブ")
         try:
-            client = get_gspread_client()
-            sh = client.open("Cosme Data")
-            sheet_karte = sh.worksheet("カルテ")
-            records = sheet_karte.get_all_records()
-
-            if records:
-                df_karte = pd.DataFrame(records)
+            df_karte = load_karte_df()
+
+            if not df_karte.empty:
+
+                # --- 0. 🔎 全文検索（公式情報・メモ・ポップ案） ---
+                karte_query = st.text_input("🔎 カルテを全文検索（公式情報・メモ・ポップ案）", key="arch_search")
+                if karte_query.strip():
+                    search_t0 = time.perf_counter()
+                    text_index = text_index_for(karte_df=df_karte)
+                    karte_hits = text_index.search(karte_query, source="カルテ", limit=20)
+                    st.caption(f"{len(karte_hits)} 件ヒット / {(time.perf_counter() - search_t0) * 1000:.1f} ms")
+                    for doc_id, score in karte_hits:
+                        with st.container(border=True):
+                            st.markdown(f"**{doc_id[1]}**")
+                            for field, text in text_index.fields(doc_id).items():
+                                snippet = search_snippet(text, karte_query)
+                                if snippet:
+                                    st.markdown(f"{field}： {snippet}")
+                    st.divider()
 
                 # --- 1. 🔍 商品別・詳細アーカイブ ---
                 st.subheader("🔍 商品別・詳細アーカイブ")
@@ -974,7 +3812,7 @@ elif menu == "📚 商品カルテ一覧":
                     col_img, col_det = st.columns([1, 2])
                     with col_img:
                         if row.get("画像URL"):
-                            st.image(row["画像URL"], use_container_width=True)
+                            st.image(product_image(row["画像URL"]), use_container_width=True)
                         else:
                             st.info("No Image")
                     with col_det:
@@ -1019,18 +3857,10 @@ elif menu == "📚 商品カルテ一覧":
 elif menu == "🧪 成分マスタ編集":
     st.header("🧪 成分・悩みマスタ編集")
     try:
-        client = get_gspread_client()
-        sh = client.open("Cosme Data")
-        
-        try:
-            sheet_master = sh.worksheet("ingredient_master")
-        except:
-            sheet_master = sh.add_worksheet(title="ingredient_master", rows="100", cols="10")
-            header = ["分類", "キーワード", "推奨成分", "理由・ポップ用フレーズ", "更新日", "話題の成分フラグ"]
-            sheet_master.append_row(header)
+        header = ["分類", "キーワード", "推奨成分", "理由・ポップ用フレーズ", "更新日", "話題の成分フラグ"]
+        ensure_sheet("ingredient_master", [header], rows=100, cols=10)
 
-        records = sheet_master.get_all_records()
-        df_master = pd.DataFrame(records)
+        df_master = load_master_df().copy()
         
         # 必要な列がない場合の補完
         for col in ["分類", "キーワード", "推奨成分", "理由・ポップ用フレーズ", "話題の成分フラグ"]:
@@ -1091,23 +3921,43 @@ elif menu == "🧪 成分マスタ編集":
             for d in master_data_list:
                 payload.append([d[0], d[1], d[2], d[3], now_jst, d[4]])
             
-            sheet_master.clear()
-            sheet_master.update("A1", payload)
-            st.success("マスタを更新しました！")
-            st.balloons()
+            done, _ = queue_sheet_write("ingredient_master", "replace_all", {"values": payload}, timeout=15)
+            if done:
+                st.success("マスタを更新しました！")
+                st.balloons()
+            else:
+                st.info("保存を受け付けました。反映までしばらくお待ちください。")
+
+    # --- 成分名の同義語（表記揺れ・別名 → 正規名） ---
+    st.divider()
+    st.subheader("🔤 成分名の同義語")
+    st.caption("全成分の「別名」は「正規名」として扱われ、おすすめ商品や成分検索で同じ成分として照合されます。")
+    try:
+        ensure_sheet(INGREDIENT_SYNONYM_SHEET, [INGREDIENT_SYNONYM_HEADER] + DEFAULT_INGREDIENT_SYNONYMS, rows=200, cols=2)
+        syn_df = pd.DataFrame(load_ingredient_synonyms(), columns=INGREDIENT_SYNONYM_HEADER)
+        edited_syn = st.data_editor(syn_df, num_rows="dynamic", use_container_width=True, hide_index=True, key="syn_editor")
+        if st.button("✅ 同義語を保存する", key="btn_save_synonyms"):
+            rows = [
+                [str(c).strip(), str(a).strip()]
+                for c, a in zip(edited_syn["正規名"], edited_syn["別名"])
+                if pd.notna(c) and pd.notna(a) and str(c).strip() and str(a).strip()
+            ]
+            done, _ = queue_sheet_write(INGREDIENT_SYNONYM_SHEET, "replace_all", {"values": [INGREDIENT_SYNONYM_HEADER] + rows}, timeout=15)
+            if done:
+                st.success(f"同義語を {len(rows)} 件保存しました！")
+            else:
+                st.info("保存を受け付けました。反映までしばらくお待ちください。")
+    except Exception as e:
+        st.error(f"同義語の読み込み・保存エラー: {e}")
 
 elif menu == "📚 成分マスタ一覧":
         st.header("🧪 登録済み成分・悩みマスタ")
         try:
-            client = get_gspread_client()
-            sh = client.open("Cosme Data")
-            
             # --- 1. データの同期 ---
             with st.spinner("データを同期中..."):
-                sheet_master = sh.worksheet("ingredient_master")
-                df_master = pd.DataFrame(sheet_master.get_all_records())
-                sheet_k = sh.worksheet("カルテ")
-                df_karte = pd.DataFrame(sheet_k.get_all_records())
+                df_master = load_master_df()
+                df_karte = load_karte_df()
+                ingredient_index = ingredient_index_for(df_karte)
 
             if not df_master.empty:
                 # --- 2. トレンド成分表示 (話題の成分フラグがTRUEのもの) ---
@@ -1149,11 +3999,8 @@ elif menu == "📚 成分マスタ一覧":
                                         
                                         # --- 現役商品（成分あり）の抽出 ---
                                         # 指定成分を含み、かつ全成分が空でない商品を「現役」とする
-                                        matched_active = df_karte[
-                                            (df_karte["全成分"].astype(str).str.contains(target_ing, na=False)) &
-                                            (df_karte["全成分"].astype(str).str.strip() != "") &
-                                            (df_karte["全成分"].astype(str).str.lower() != "nan")
-                                        ]
+                                        # （インデックスには全成分が空でない商品だけが入っている）
+                                        matched_active = df_karte[df_karte["商品名"].isin(ingredient_index.lookup(target_ing))]
                                         
                                         if not matched_active.empty:
                                             st.write(f"🔍 **{target_ing}** 配合の現役商品から絞り込む")
@@ -1223,7 +4070,23 @@ elif menu == "📚 成分マスタ一覧":
                 else:
                     st.error("該当商品なし（カルテに成分情報が登録されている商品が1件もありません）")
 
-                # --- 5. 全マスタデータ確認（デバッグ用・一番下に配置） ---
+                # --- 5. 成分の組み合わせ検索 ---
+                st.divider()
+                st.subheader("🧬 成分の組み合わせで商品を探す")
+                vocab = sorted(ingredient_index.postings)
+                c_inc, c_exc = st.columns(2)
+                with c_inc:
+                    include_ings = st.multiselect("含む成分（すべて）", vocab, key="ing_query_include")
+                with c_exc:
+                    exclude_ings = st.multiselect("含まない成分", vocab, key="ing_query_exclude")
+                if include_ings or exclude_ings:
+                    hit_names = sorted(ingredient_index.query(include_ings, exclude_ings))
+                    if hit_names:
+                        st.success(f"該当商品 ({len(hit_names)}件): " + "、".join(hit_names))
+                    else:
+                        st.error("該当商品なし（条件に合う商品が見つかりません）")
+
+                # --- 6. 全マスタデータ確認（デバッグ用・一番下に配置） ---
                 st.divider()
                 with st.expander("🛠️ 全マスタデータを表形式で確認"):
                     st.dataframe(df_master, use_container_width=True, hide_index=True)
@@ -1237,16 +4100,18 @@ elif menu == "📚 成分マスタ一覧":
 elif menu == "📈 アンケート分析":
     st.header("📊 アンケートデータ詳細分析")
 
-    if sub_df.empty:
+    if df is None or survey_query.empty:
         st.warning("⚠️ 現在の絞り込み条件に一致するデータがありません。")
     else:
         # --- 1. 変数の定義（まず最初にすべて準備する） ---
-        age_col = "年代" if "年代" in sub_df.columns else None
-        gen_col = "性別" if "性別" in sub_df.columns else None
-        skin_col = "肌悩み" if "肌悩み" in sub_df.columns else None
+        age_col = "年代" if "年代" in survey_query.columns else None
+        gen_col = "性別" if "性別" in survey_query.columns else None
+        skin_col = "肌悩み" if "肌悩み" in survey_query.columns else None
         
-        valid_scores = [s for s in conf["scores"] if s in sub_df.columns]
+        valid_scores = [s for s in conf["scores"] if s in survey_query.columns]
         item_col_name = conf["item_col"]
+        # サイドバーの条件での集計キューブ（キューブの軸にない条件があればその場で作る）
+        query_cube, query_filters = survey_query.cube(valid_scores)
 
         # --- 2. タブの定義 ---
         tabs = st.tabs(["🎯 推奨商品", "📈 スコア分析", "📉 相関分析", "📊 ボックスプロット", "🗣️ 生の声分析", "🔍 その他内訳"])
@@ -1260,29 +4125,26 @@ elif menu == "📈 アンケート分析":
             # ターゲット絞り込みUI
             c1, c2, c3 = st.columns(3)
             with c1:
-                f_age = st.multiselect("年代で絞り込む", sorted(sub_df[age_col].dropna().unique()), key="tab1_age_f") if age_col else []
+                f_age = st.multiselect("年代で絞り込む", survey_query.unique(age_col), key="tab1_age_f") if age_col else []
             with c2:
-                f_gender = st.multiselect("性別で絞り込む", sorted(sub_df[gen_col].dropna().unique()), key="tab1_gen_f") if gen_col else []
+                f_gender = st.multiselect("性別で絞り込む", survey_query.unique(gen_col), key="tab1_gen_f") if gen_col else []
             with c3:
-                f_skin = st.multiselect("肌悩みで絞り込む", sorted(sub_df[skin_col].dropna().unique()), key="tab1_skin_f") if skin_col else []
+                # 肌悩みは組み合わせではなく1つずつの悩みで選ぶ
+                f_skin = st.multiselect("肌悩みで絞り込む", survey_query.unique(skin_col), key="tab1_skin_f") if skin_col else []
 
-            # フィルタリング実行
-            rev_df = sub_df.copy()
-            if f_age and age_col: rev_df = rev_df[rev_df[age_col].isin(f_age)]
-            if f_gender and gen_col: rev_df = rev_df[rev_df[gen_col].isin(f_gender)]
-            if f_skin and skin_col: 
-                rev_df = rev_df[rev_df[skin_col].apply(lambda x: any(s in str(x) for s in f_skin))]
+            # フィルタリング実行（サイドバーのプランに条件を足し、おすすめ計算に要る列だけ取り出す）
+            rev_query = survey_query.where({age_col: f_age, gen_col: f_gender, skin_col: f_skin})
+            rev_df = rev_query.select(TROUBLE_COLS + [item_col_name] + valid_scores)
 
-            # ランキング表示
+            # ランキング表示（商品ごとの平均は集計キューブから読む）
+            rev_cube, rev_filters = rev_query.cube(valid_scores)
             if not rev_df.empty and valid_scores:
-                # 商品名とスコアの抽出
-                rev_melted = rev_df.melt(id_vars=valid_scores, value_vars=item_col_name, value_name="対象商品").dropna(subset=["対象商品"])
-                if not rev_melted.empty:
-                    product_ranking = rev_melted.groupby("対象商品")[valid_scores].mean()
+                product_ranking = rev_cube.means(filters=rev_filters, scores=valid_scores).dropna(how="all")
+                if not product_ranking.empty:
                     product_ranking["総合スコア"] = product_ranking.mean(axis=1)
                     product_ranking = product_ranking.sort_values("総合スコア", ascending=False)
 
-                    st.write(f"📊 **条件に合致する回答: {len(rev_df)}件**")
+                    st.write(f"📊 **条件に合致する回答: {rev_query.count}件**")
                     for i, (p_name, row) in enumerate(product_ranking.head(3).iterrows()):
                         with st.container(border=True):
                             cl_r, cl_t = st.columns([1, 4])
@@ -1302,24 +4164,27 @@ elif menu == "📈 アンケート分析":
             else:
                 st.info("条件に一致するデータがありません。")
 
+            # 悩み × 推奨成分からのおすすめ（成分マスタ・カルテと連携）
+            if not rev_df.empty:
+                try:
+                    display_recommendation_ranking(rev_df, load_master_df(), load_karte_df(), valid_scores)
+                except Exception as e:
+                    st.error(f"おすすめ商品の読み込みエラー: {e}")
+
         # --- Tab 2: 📈 スコア分析（レーダーチャート） ---
         with tab2:
             st.write("### 📈 商品間スコア比較")
             # 商品リスト取得
-            all_items = sorted(sub_df[item_col_name].stack().dropna().unique()) if isinstance(sub_df[item_col_name], pd.DataFrame) else sorted(sub_df[item_col_name].dropna().unique())
+            all_items = survey_query.unique(item_col_name)
             sel_items = st.multiselect("比較する商品を選択", all_items, key="sel_t2")
             
             if sel_items and valid_scores:
-                import plotly.graph_objects as go
+                go = lazy_import("plotly.graph_objects")
                 fig = go.Figure()
+                # 選択した商品の平均を集計キューブからまとめて読む
+                sel_means = query_cube.means(filters={**query_filters, "商品名": sel_items}, scores=valid_scores)
                 for i, item in enumerate(sel_items):
-                    # 各商品の平均を計算（複数列対応）
-                    if isinstance(sub_df[item_col_name], pd.DataFrame):
-                        mask = (sub_df[item_col_name] == item).any(axis=1)
-                    else:
-                        mask = (sub_df[item_col_name] == item)
-                    
-                    item_avg = sub_df[mask][valid_scores].mean()
+                    item_avg = sel_means.loc[item, valid_scores] if item in sel_means.index else pd.Series(float("nan"), index=valid_scores)
                     r_val = item_avg.values.tolist() + [item_avg.values[0]]
                     theta_val = valid_scores + [valid_scores[0]]
                     fig.add_trace(go.Scatterpolar(r=r_val, theta=theta_val, fill='toself', name=item))
@@ -1336,25 +4201,27 @@ elif menu == "📈 アンケート分析":
                 c1, c2 = st.columns(2)
                 x_ax = c1.selectbox("横軸", valid_scores, index=0)
                 y_ax = c2.selectbox("縦軸", valid_scores, index=1)
-                import plotly.express as px
-                fig_scatter = px.scatter(sub_df, x=x_ax, y=y_ax, color="年代" if "年代" in sub_df.columns else None, range_x=[0,5.5], range_y=[0,5.5], template="plotly_white")
+                px = lazy_import("plotly.express")
+                scatter_df = survey_query.select([x_ax, y_ax, "年代"])
+                fig_scatter = px.scatter(scatter_df, x=x_ax, y=y_ax, color="年代" if "年代" in scatter_df.columns else None, range_x=[0,5.5], range_y=[0,5.5], template="plotly_white")
                 st.plotly_chart(fig_scatter, use_container_width=True)
 
 
         # --- Tab 4: 📊 ボックスプロット（比較分析） ---
         with tab4:
             st.subheader("📊 項目別スコア分布比較")
-            all_items = sorted(sub_df[item_col_name].stack().dropna().unique()) if isinstance(sub_df[item_col_name], pd.DataFrame) else sorted(sub_df[item_col_name].dropna().unique())
+            all_items = survey_query.unique(item_col_name)
             
             col_a, col_b = st.columns(2)
             item_a = col_a.selectbox("商品A", all_items, index=0)
             item_b = col_b.selectbox("商品B", all_items, index=min(1, len(all_items)-1))
 
             if item_a and item_b:
-                # データの抽出
+                # データの抽出（商品ごとの行位置を1回のgroupbyで引く）
+                box_df = survey_query.select([item_col_name] + valid_scores)
+                item_positions = box_df.groupby(item_col_name, observed=True, sort=False).indices
                 def get_item_df(name):
-                    mask = (sub_df[item_col_name] == name).any(axis=1) if isinstance(sub_df[item_col_name], pd.DataFrame) else (sub_df[item_col_name] == name)
-                    res = sub_df[mask][valid_scores].copy()
+                    res = box_df.iloc[item_positions.get(name, [])][valid_scores].copy()
                     res["商品名"] = name
                     return res
 
@@ -1362,29 +4229,113 @@ elif menu == "📈 アンケート分析":
                 melted_compare = df_compare.melt(id_vars=["商品名"], var_name="項目", value_name="スコア")
                 melted_compare["スコア"] = pd.to_numeric(melted_compare["スコア"], errors='coerce')
 
-                import plotly.express as px
+                px = lazy_import("plotly.express")
                 fig_box = px.box(melted_compare, x="項目", y="スコア", color="商品名", points="all", title=f"{item_a} vs {item_b} の分布")
                 fig_box.update_layout(yaxis=dict(range=[0, 5.5]))
                 st.plotly_chart(fig_box, use_container_width=True)
 
+                # 平均と標準偏差は集計キューブから
+                box_stats = query_cube.stats(filters={**query_filters, "商品名": [item_a, item_b]}, scores=valid_scores)
+                if not box_stats.empty:
+                    summary = pd.concat(
+                        {"平均": box_stats["mean"], "標準偏差": box_stats["var"] ** 0.5}, axis=1
+                    ).round(2)
+                    st.dataframe(summary, use_container_width=True)
+
 
         # --- Tab 5: 🗣️ 生の声分析 ---
         with tab5:
             st.subheader("🗣️ 届いた感想（生の声）")
             fb_col = "感想"
-            if fb_col in sub_df.columns:
-                f_df = sub_df[sub_df[fb_col].notna() & (sub_df[fb_col] != "")]
-                for _, row in f_df.iterrows():
+            if fb_col in survey_query.columns:
+                # 検索・絞り込みはサーバー側でまとめて行い、描画は表示中のページだけ
+                v1, v2, v3 = st.columns([2, 2, 1])
+                fb_search = v1.text_input("🔎 感想を検索", key="fb_search")
+                fb_items = v2.multiselect("商品で絞り込む", survey_query.unique(item_col_name), key="fb_items")
+                fb_ages = v3.multiselect("年代", survey_query.unique(age_col), key="fb_ages") if age_col else []
+                v4, v5 = st.columns(2)
+                fb_order = v4.radio("並び順", ["関連度順", "新しい順", "古い順"] if fb_search.strip() else ["新しい順", "古い順"], horizontal=True, key="fb_sort")
+                fb_page_size = v5.selectbox("1ページの件数", FEEDBACK_PAGE_SIZES, key="fb_page_size")
+
+                fb_ranked = None
+                if fb_search.strip():
+                    # 全文検索インデックス（全回答で1つ）から、ヒットした行を関連度順に引く
+                    search_t0 = time.perf_counter()
+                    hits = text_index_for(survey_df=df, survey_version=survey_version).search(fb_search, source=SURVEY_SEARCH_FIELD, limit=None)
+                    fb_ranked = [doc_id[1] for doc_id, _ in hits]
+                    st.caption(f"全文検索： {len(hits)} 件ヒット / {(time.perf_counter() - search_t0) * 1000:.1f} ms")
+                voice_df = survey_query.where({age_col: fb_ages}).select([fb_col, item_col_name, "年代", SURVEY_TIMESTAMP_COL])
+                f_df = feedback_view(voice_df, fb_col, item_col_name, fb_ranked, fb_items, fb_order)
+
+                n_pages = max(1, -(-len(f_df) // fb_page_size))
+                if st.session_state.get("fb_page", 1) > n_pages:
+                    st.session_state["fb_page"] = 1
+                page = st.number_input(f"ページ（全 {n_pages} ページ / {len(f_df)} 件）", min_value=1, max_value=n_pages, step=1, key="fb_page")
+
+                render_t0 = time.perf_counter()
+                page_df = f_df.iloc[(page - 1) * fb_page_size: page * fb_page_size]
+                for row in page_df.to_dict("records"):
+                    row = {k: (v if pd.notna(v) else None) for k, v in row.items()}
                     with st.container(border=True):
-                        # 商品名（複数列対応）
-                        p_display = row[item_col_name].dropna().values[0] if isinstance(row[item_col_name], pd.Series) else row[item_col_name]
-                        st.markdown(f"**📍 {p_display}** ({row.get('年代', '不明')})")
-                        st.write(row[fb_col])
+                        st.markdown(f"**📍 {row.get(item_col_name) or '不明'}** ({row.get('年代') or '不明'})")
+                        if row.get(SURVEY_TIMESTAMP_COL):
+                            st.caption(str(row[SURVEY_TIMESTAMP_COL]))
+                        st.markdown(highlight_terms(row[fb_col], fb_search))
+                st.caption(f"このページの描画： {(time.perf_counter() - render_t0) * 1000:.0f} ms（{len(page_df)} 件）")
+
+                # --- 感想のAI分析（表示は保存済みの結果の集計だけ。Geminiはボタンを押した時だけ呼ぶ） ---
+                st.divider()
+                st.markdown("#### 🧠 感想の感情・不満の話題（AI分析）")
+                all_voice = survey_query.select([fb_col, item_col_name])
+                all_voice = all_voice[all_voice[fb_col].notna() & (all_voice[fb_col].astype(str).str.strip() != "")]
+                voice_ids = cached_survey_response_ids(survey_version, df).loc[all_voice.index]
+                insight_store = get_feedback_insight_store()
+                insights = load_feedback_insights(insight_store.revision)
+                pending = voice_ids[~voice_ids.isin(set(insights["response_id"]))].drop_duplicates()
+
+                if len(pending) and st.button(f"🧠 未分析の感想 {len(pending)} 件を分析する", key="fb_analyze"):
+                    model = get_gemini_model()
+                    if model is None:
+                        st.error("APIキーが設定されていません。")
+                    else:
+                        products = dict(zip(voice_ids, all_voice[item_col_name].astype("string").fillna("")))
+                        items = [(rid, products[rid], text) for rid, text in zip(pending, all_voice.loc[pending.index, fb_col])]
+                        progress = st.progress(0.0, text="分析中...")
+                        done, failed = 0, 0
+                        for result, err in analyze_feedback_batch(
+                            model, items, valid_scores,
+                            max_workers=int(st.secrets.get("GEMINI_MAX_WORKERS", 2)),
+                            per_minute=int(st.secrets.get("GEMINI_RPM", 15)),
+                        ):
+                            if err is not None:
+                                failed += 1
+                            else:
+                                insight_store.put_many(products, result, getattr(model, "model_name", ""))
+                                done += len(result)
+                            progress.progress(min(done / len(items), 1.0), text=f"分析中... {done}/{len(items)} 件")
+                        progress.empty()
+                        st.success(f"{done} 件を分析しました。" + (f"（{failed} 回のリクエストが失敗）" if failed else ""))
+                        insights = load_feedback_insights(insight_store.revision)
+
+                topic_table, sentiment_table, attribute_table = feedback_topic_counts(voice_ids, insights)
+                if sentiment_table.empty:
+                    st.caption("分析済みの感想はまだありません。")
+                else:
+                    st.caption(f"分析済み： {voice_ids.isin(set(insights['response_id'])).sum()} / {len(voice_ids)} 件")
+                    st.markdown("**商品ごとの感情の内訳**")
+                    st.dataframe(sentiment_table, use_container_width=True)
+                    if not topic_table.empty:
+                        st.markdown("**商品ごとの不満の話題（件数の多い順）**")
+                        st.dataframe(topic_table.iloc[:, :10], use_container_width=True)
+                    if not attribute_table.empty:
+                        st.markdown("**感想で触れられた評価項目（感情別の件数）**")
+                        st.dataframe(attribute_table, use_container_width=True)
 
         # --- Tab 6: 🔍 その他内訳 ---
         with tab6:
             st.subheader("🔍 その他自由回答")
             other_col = "商品のアイテムタイプにて『その他』を選んだ方は入力してください。"
-            if other_col in sub_df.columns:
-                others = sub_df[sub_df[other_col].notna() & (sub_df[other_col] != "")]
+            if other_col in survey_query.columns:
+                other_df = survey_query.select([other_col])
+                others = other_df[other_df[other_col].notna() & (other_df[other_col] != "")]
                 st.dataframe(others[[other_col]], use_container_width=True)
\ No newline at end of file
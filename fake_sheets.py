@@ -0,0 +1,327 @@
+"""
+ローカルのJSONファイルを Google スプレッドシートの代わりにする、動作確認用の偽バックエンド。
+secrets に SHEETS_BACKEND = "fake" を書くと、アプリは gspread の代わりにこのクライアントを使う。
+アプリが使う gspread のメソッドだけを、同じ呼び出し方・同じ戻り値の形でまねている
+"""
+import datetime
+import json
+import os
+import re
+import threading
+import time
+
+import requests
+from gspread.cell import Cell
+from gspread.exceptions import SpreadsheetNotFound, WorksheetNotFound
+from gspread.utils import a1_to_rowcol, fill_gaps, numericise_all, rowcol_to_a1
+
+
+def _split_range(range_name):
+    """"'シート'!A1:C3" → ("A1", "C3")。シート名は付いていなくてもよい"""
+    cells = range_name.split("!")[-1]
+    start, _, end = cells.partition(":")
+    return start, end or start
+
+
+class FakeWorksheet:
+    """1枚のシート。値は文字列の2次元リストで持ち、変更のたびにファイルへ書き出す"""
+
+    def __init__(self, spreadsheet, title):
+        self.spreadsheet = spreadsheet
+        self.title = title
+
+    @property
+    def _rows(self):
+        return self.spreadsheet._data["sheets"][self.title]
+
+    @property
+    def row_count(self):
+        return max(len(self._rows), self._size[0])
+
+    @property
+    def col_count(self):
+        return max([len(r) for r in self._rows] + [self._size[1]])
+
+    @property
+    def _size(self):
+        return self.spreadsheet._data["sizes"].setdefault(self.title, [1000, 26])
+
+    def add_cols(self, cols):
+        with self.spreadsheet._write():
+            self._size[1] = self.col_count + cols
+
+    def _set(self, row, col, value):
+        rows = self._rows
+        while len(rows) < row:
+            rows.append([])
+        cells = rows[row - 1]
+        while len(cells) < col:
+            cells.append("")
+        # Sheets API と同じく、読み出すと文字列になる
+        cells[col - 1] = "" if value is None else str(value)
+
+    def _write_block(self, start, values):
+        row0, col0 = a1_to_rowcol(start)
+        for r, row in enumerate(values):
+            for c, value in enumerate(row):
+                self._set(row0 + r, col0 + c, value)
+
+    def _read_block(self, range_name):
+        start, end = _split_range(range_name)
+        row0, col0 = a1_to_rowcol(start)
+        if re.search(r"\d", end):
+            row1, col1 = a1_to_rowcol(end)
+        else:
+            # "B2:B" のように行番号のない終端は、その列の最後の行まで
+            row1, col1 = len(self._rows), a1_to_rowcol(f"{end}1")[1]
+        block = [row[col0 - 1:col1] for row in self._rows[row0 - 1:row1]]
+        # 末尾の空セル・空行は返さない（Sheets API と同じ）
+        block = [self._trim(row) for row in block]
+        while block and not block[-1]:
+            block.pop()
+        return block
+
+    @staticmethod
+    def _trim(row):
+        row = list(row)
+        while row and row[-1] == "":
+            row.pop()
+        return row
+
+    def _last_row(self):
+        rows = self._rows
+        n = len(rows)
+        while n and not any(rows[n - 1]):
+            n -= 1
+        return n
+
+    def get_all_values(self):
+        with self.spreadsheet._read():
+            rows = [self._trim(r) for r in self._rows[:self._last_row()]]
+        return fill_gaps(rows) if rows else [[]]
+
+    def get_values(self, *args, **kwargs):
+        return self.get_all_values()
+
+    def get_all_records(self):
+        values = self.get_all_values()
+        if values == [[]]:
+            return []
+        keys = values[0]
+        return [dict(zip(keys, numericise_all(row))) for row in values[1:]]
+
+    def row_values(self, row):
+        with self.spreadsheet._read():
+            return self._trim(self._rows[row - 1]) if row <= len(self._rows) else []
+
+    def batch_get(self, ranges, **kwargs):
+        with self.spreadsheet._read():
+            return [self._read_block(r) for r in ranges]
+
+    def batch_update(self, data, **kwargs):
+        with self.spreadsheet._write():
+            for item in data:
+                self._write_block(_split_range(item["range"])[0], item["values"])
+        return {"totalUpdatedCells": sum(len(row) for item in data for row in item["values"])}
+
+    def update(self, values=None, range_name=None, **kwargs):
+        if isinstance(values, str) and isinstance(range_name, (list, tuple)):
+            # gspread と同じく、旧来の update("A1", values) の並びも受け付ける
+            values, range_name = range_name, values
+        with self.spreadsheet._write():
+            self._write_block(_split_range(range_name or "A1")[0], values)
+        return {"updatedRange": f"'{self.title}'!{range_name or 'A1'}"}
+
+    def append_rows(self, values, **kwargs):
+        with self.spreadsheet._write():
+            start = self._last_row() + 1
+            self._write_block(rowcol_to_a1(start, 1), values)
+            width = max([len(r) for r in values] + [1])
+            updated = f"'{self.title}'!A{start}:{rowcol_to_a1(start + len(values) - 1, width)}"
+        return {"updates": {"updatedRange": updated, "updatedRows": len(values)}}
+
+    def append_row(self, values, **kwargs):
+        return self.append_rows([values], **kwargs)
+
+    def find(self, query, in_row=None, in_column=None, case_sensitive=True):
+        with self.spreadsheet._read():
+            for r, row in enumerate(self._rows, start=1):
+                if in_row is not None and r != in_row:
+                    continue
+                for c, value in enumerate(row, start=1):
+                    if in_column is not None and c != in_column:
+                        continue
+                    matched = (
+                        query.search(value) if isinstance(query, re.Pattern)
+                        else (value == query if case_sensitive else value.lower() == str(query).lower())
+                    )
+                    if matched:
+                        return Cell(r, c, value)
+        return None
+
+    def delete_rows(self, start_index, end_index=None):
+        with self.spreadsheet._write():
+            del self._rows[start_index - 1:(end_index or start_index)]
+
+    def clear(self):
+        with self.spreadsheet._write():
+            self._rows.clear()
+
+
+class FakeSpreadsheet:
+    """JSONファイル1つ = スプレッドシート1つ。別のプロセスが書き換えても、読む時に読み直す"""
+
+    def __init__(self, client, title):
+        self.client = client
+        self.title = title
+        self.id = title
+        self._data = None
+        self._loaded_mtime = None
+
+    def _load(self):
+        path = self.client.path
+        mtime = os.path.getmtime(path) if os.path.exists(path) else None
+        if self._data is None or mtime != self._loaded_mtime:
+            if mtime is None:
+                self._data = {"modified": None, "sheets": {}, "sizes": {}}
+            else:
+                with open(path, encoding="utf-8") as f:
+                    self._data = json.load(f)
+            self._loaded_mtime = mtime
+
+    def _save(self):
+        path = self.client.path
+        self._data["modified"] = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self._data, f, ensure_ascii=False)
+        os.replace(tmp, path)
+        self._loaded_mtime = os.path.getmtime(path)
+
+    def _read(self):
+        return self.client._call(self, write=False)
+
+    def _write(self):
+        return self.client._call(self, write=True)
+
+    def get_lastUpdateTime(self):
+        with self._read():
+            return self._data["modified"] or ""
+
+    def worksheets(self):
+        with self._read():
+            return [FakeWorksheet(self, title) for title in self._data["sheets"]]
+
+    def worksheet(self, title):
+        with self._read():
+            if title not in self._data["sheets"]:
+                raise WorksheetNotFound(title)
+        return FakeWorksheet(self, title)
+
+    def add_worksheet(self, title, rows, cols, index=None):
+        with self._write():
+            self._data["sheets"].setdefault(title, [])
+            self._data["sizes"][title] = [int(rows), int(cols)]
+        return FakeWorksheet(self, title)
+
+    def values_batch_get(self, ranges, params=None):
+        value_ranges = []
+        for range_name in ranges:
+            title = range_name.split("!")[0].strip("'")
+            ws = self.worksheet(title)
+            values = ws.get_all_values() if "!" not in range_name else ws.batch_get([range_name])[0]
+            value_ranges.append({"range": range_name, "values": [] if values == [[]] else values})
+        return {"spreadsheetId": self.id, "valueRanges": value_ranges}
+
+
+class _Call:
+    """
+    1回のAPI呼び出し。遅延・接続断をまね、終わったら（書き込みなら）保存する。
+    クライアントに budget があれば、本物の BudgetedHTTPClient と同じく予算を取ってから呼び、所要時間を記録する
+    """
+
+    def __init__(self, client, spreadsheet, write):
+        self.client = client
+        self.spreadsheet = spreadsheet
+        self.write = write
+        self.kind = "書き込み" if write else "読み込み"
+        self.label = None
+        self.t0 = None
+
+    def _record(self, ok):
+        if self.client.budget is not None:
+            self.client.budget.record(self.label, self.kind, (time.perf_counter() - self.t0) * 1000, ok)
+
+    def __enter__(self):
+        client = self.client
+        if client.budget is not None:
+            self.label, priority = client.call_context()
+            client.budget.acquire(self.kind, priority)
+        self.t0 = time.perf_counter()
+        try:
+            if client.offline:
+                raise requests.exceptions.ConnectionError("fake_sheets: offline")
+            if client.latency_ms:
+                time.sleep(client.latency_ms / 1000)
+            client._lock.acquire()
+            try:
+                client.calls[self.kind] += 1
+                self.spreadsheet._load()
+            except BaseException:
+                # __exit__ は呼ばれないので、ここで放さないと以後の呼び出しがすべて止まる
+                client._lock.release()
+                raise
+        except BaseException:
+            self._record(False)
+            raise
+
+    def __exit__(self, exc_type, exc, tb):
+        ok = exc_type is None
+        try:
+            if self.write and ok:
+                self.spreadsheet._save()
+        except BaseException:
+            ok = False
+            raise
+        finally:
+            self.client._lock.release()
+            self._record(ok)
+        return False
+
+
+class FakeClient:
+    """
+    gspread.Client の代わり。path のJSONファイルに全シートを保存する。
+    latency_ms で1回ごとの遅延を、offline=True で接続できない状態をまねられる。
+    budget（SheetRequestBudget）と call_context（(ラベル, 優先度) を返す関数）を渡すと、呼び出しを予算に通して数える
+    """
+
+    def __init__(self, path, latency_ms=0, offline=False, budget=None, call_context=None):
+        self.path = path
+        self.latency_ms = latency_ms
+        self.offline = offline
+        self.budget = budget
+        self.call_context = call_context or (lambda: ("（その他）", "interactive"))
+        self.calls = {"読み込み": 0, "書き込み": 0}
+        self._lock = threading.RLock()
+        self._spreadsheets = {}
+
+    def _call(self, spreadsheet, write):
+        return _Call(self, spreadsheet, write)
+
+    def open(self, title):
+        if not title:
+            raise SpreadsheetNotFound(title)
+        return self._spreadsheets.setdefault(title, FakeSpreadsheet(self, title))
+
+    @classmethod
+    def seed(cls, path, sheets):
+        """{シート名: 2次元リスト} で偽のスプレッドシートを作る（既存の内容は置き換える）"""
+        spreadsheet = cls(path).open("seed")
+        with spreadsheet._write():
+            spreadsheet._data["sheets"] = {
+                title: [["" if v is None else str(v) for v in row] for row in rows] for title, rows in sheets.items()
+            }
+            spreadsheet._data["sizes"] = {title: [max(len(rows), 1000), 26] for title, rows in sheets.items()}
+        return spreadsheet
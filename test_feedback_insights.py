@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+
+
+def test_response_ids_tolerate_blank_answers(app):
+    frame = pd.DataFrame({
+        "タイムスタンプ": ["2024/01/01 10:00:00", "2024/01/01 10:00:00", None],
+        "商品名": ["A水", np.nan, "B液"],
+        "感想": [np.nan, "しっとり", np.nan],
+    })
+    ids = app.survey_response_ids(frame)
+    assert ids.notna().all()
+    assert ids.str.len().eq(16).all()
+    assert ids.nunique() == 3
+    # 同じ内容なら同じID（空欄の表し方が違っても変わらない）
+    blank = frame.copy()
+    blank.loc[0, "感想"] = None
+    assert ids.equals(app.survey_response_ids(blank))
+
+
+def test_response_ids_without_optional_columns(app):
+    ids = app.survey_response_ids(pd.DataFrame({"感想": ["良い", None]}, index=[5, 9]))
+    assert list(ids.index) == [5, 9]
+    assert ids.nunique() == 2
+
+
+def test_stub_output_parses_and_feeds_tables(app, tmp_path):
+    scores = ["保湿", "香り"]
+    items = [("r1", "A水", "保湿が良い"), ("r2", "A水", "べたつきが気になる、香りもきつい"), ("r3", "B液", "普通")]
+    text = app.stub_feedback_insights(app.build_feedback_prompt(items, scores))
+    results = app.parse_feedback_insights(text, ["r1", "r2", "r3"], scores)
+    assert results["r1"]["sentiment"] == "positive"
+    assert results["r2"]["sentiment"] == "negative"
+    assert "べたつき" in results["r2"]["topics"]
+    assert results["r1"]["attributes"] == ["保湿"]
+
+    store = app.FeedbackInsightStore(str(tmp_path / "insights.sqlite"))
+    store.put_many({"r1": "A水", "r2": "A水", "r3": "B液"}, results, "stub")
+    topic_table, sentiment_table, attribute_table = app.feedback_topic_counts(pd.Series(["r1", "r2"]), store.frame())
+    assert topic_table.loc["A水", "べたつき"] == 1
+    assert sentiment_table.loc["A水"].sum() == 2
+    assert attribute_table.loc["保湿", "ポジティブ"] == 1
+    assert attribute_table.loc["香り", "ネガティブ"] == 1
+
+
+def test_parse_drops_unknown_ids_and_attributes(app):
+    text = '説明 [{"id": "x", "sentiment": "angry", "attributes": ["保湿", "謎"], "topics": [" 量 ", ""]}, {"id": "zz"}]'
+    results = app.parse_feedback_insights(text, ["x"], ["保湿"])
+    assert results == {"x": {"sentiment": "neutral", "attributes": ["保湿"], "topics": ["量"]}}
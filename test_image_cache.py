@@ -0,0 +1,28 @@
+import os
+
+
+def test_writes_under_the_limit_do_not_scan_the_directory(app, tmp_path, monkeypatch):
+    cache = app.ImageCache(str(tmp_path), max_bytes=100)
+    scans = []
+    monkeypatch.setattr(cache, "_entries", lambda: scans.append(1) or app.ImageCache._entries(cache))
+    cache._write(cache._path("a", ".orig"), b"x" * 40)
+    cache._write(cache._path("a", ".orig"), b"x" * 50)  # 上書きは差分だけ数える
+    assert cache._total == 50 and scans == []
+    cache._write(cache._path("b", ".orig"), b"x" * 40)
+    assert cache._total == 90 and scans == []
+
+
+def test_least_recently_used_files_are_evicted_over_the_limit(app, tmp_path):
+    cache = app.ImageCache(str(tmp_path), max_bytes=100)
+    for i, name in enumerate("abc"):
+        path = cache._path(name, ".orig")
+        cache._write(path, b"x" * 40)
+        os.utime(path, (i, i))
+    assert not os.path.exists(cache._path("a", ".orig"))
+    assert os.path.exists(cache._path("c", ".orig"))
+    assert cache._total == 80 and cache.stats["evictions"] == 1
+
+
+def test_total_starts_from_files_already_on_disk(app, tmp_path):
+    (tmp_path / "old.orig").write_bytes(b"x" * 30)
+    assert app.ImageCache(str(tmp_path), max_bytes=100)._total == 30
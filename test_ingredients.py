@@ -0,0 +1,83 @@
+import threading
+
+import pandas as pd
+
+
+def make_index(app, rows, synonyms=()):
+    index = app.IngredientIndex(app.IngredientNormalizer(synonyms))
+    index.sync(pd.DataFrame(rows, columns=["商品名", "全成分"]))
+    return index
+
+
+def test_tokenize_folds_width_and_case(app):
+    assert app.tokenize_ingredients("水・ｸﾞﾘｾﾘﾝ、ＢＧ / ｾﾗﾐﾄﾞ NP") == ["水", "グリセリン", "bg", "セラミドnp"]
+    assert app.tokenize_ingredients(float("nan")) == []
+
+
+def test_normalize_folds_kana_variants(app):
+    assert app.normalize_ingredient("ひあるろん酸") == "ヒアルロン酸"
+    assert app.normalize_ingredient("ヴィタミン") == "ビタミン"
+    assert app.normalize_ingredient("グリセリン‐") == "グリセリンー"
+    # 英数字が続くハイフンは長音にしない
+    assert app.normalize_ingredient("セラミド-NP") == "セラミド-np"
+    assert app.normalize_ingredient("ｾﾗﾐﾄﾞ－ＮＰ") == "セラミド-np"
+
+
+def test_tokenize_keeps_commas_between_digits(app):
+    assert app.tokenize_ingredients("水、1,3-ブチレングリコール, グリセリン") == ["水", "1,3-ブチレングリコール", "グリセリン"]
+
+
+def test_lookup_is_exact_on_canonical_names(app):
+    index = make_index(app, [
+        ["化粧水A", "水・セラミドNP"],
+        ["化粧水B", "水添レシチン・ヒト型セラミド"],
+        ["乳液C", "水溶性コラーゲン・BG"],
+    ], synonyms=[("セラミド", "セラミドNP"), ("セラミド", "ヒト型セラミド"), ("コラーゲン", "水溶性コラーゲン")])
+    assert index.lookup("セラミド") == {"化粧水A", "化粧水B"}
+    assert index.lookup("セラミドnp") == index.lookup("セラミド")  # 別名は正規名として探す
+    assert index.lookup("コラーゲン") == {"乳液C"}
+    # 部分一致はしない（「水」で「水添レシチン」は拾わない）
+    assert index.lookup("水") == {"化粧水A"}
+
+
+def test_lookup_and_query(app):
+    index = make_index(app, [
+        ["化粧水A", "水・セラミドNP・グリセリン"],
+        ["乳液C", "水・BG"],
+        ["美容液D", "水・ナイアシンアミド"],
+    ])
+    assert index.lookup("グリセリン") == {"化粧水A"}
+    assert index.lookup("水・bg") == {"乳液C"}
+    assert index.lookup("レチノール") == set()
+    assert index.query(["水"], ["BG"]) == {"化粧水A", "美容液D"}
+
+
+def test_sync_reindexes_only_changed_products(app, monkeypatch):
+    frame = pd.DataFrame([["A", "水・グリセリン"], ["B", "水"]], columns=["商品名", "全成分"])
+    frame.attrs["fetched_at"] = "t1"
+    index = make_index(app, [])
+    index.sync(frame)
+    upserted = []
+    original = index.upsert
+    monkeypatch.setattr(index, "upsert", lambda name, text: (upserted.append(name), original(name, text)))
+    changed = frame.iloc[[1]].copy()
+    changed.attrs["fetched_at"] = "t2"
+    changed.loc[1, "全成分"] = "水・グリセリン"
+    index.sync(changed)
+    assert upserted == ["B"]
+    assert index.lookup("グリセリン") == {"B"}
+    assert "A" not in index.product_tokens
+
+
+def test_sync_waits_for_a_lookup_in_another_thread(app):
+    index = make_index(app, [["A", "水"]])
+    changed = pd.DataFrame([["B", "水"]], columns=["商品名", "全成分"])
+    with index.lock:
+        worker = threading.Thread(target=index.sync, args=(changed,))
+        worker.start()
+        worker.join(0.2)
+        # 検索中（ロックを持っている間）は索引が書き換わらない
+        assert worker.is_alive()
+        assert index.lookup("水") == {"A"}
+    worker.join(5)
+    assert index.lookup("水") == {"B"}
@@ -0,0 +1,117 @@
+import json
+
+import pandas as pd
+import pytest
+
+HEADER = ["新規", "更新", "作成者", "ジャンル", "アイテムタイプ", "商品名", "全成分", "公式情報", "ポップ案", "メモ", "画像URL"]
+ROWS = [
+    ["2024/01/01", "2024/01/02", "山田", "スキンケア", "化粧水", "A水", "水", "", "", "1行目", ""],
+    ["2024/01/01", "2024/01/03", "佐藤", "スキンケア", "美容液", "B液", "水", "", "", "", ""],
+    ["2024/01/05", "2024/01/06", "鈴木", "スキンケア", "化粧水", "A水", "水、BG", "", "", "重複", ""],
+]
+CONFIG = {"スキンケア": {"types": ["化粧水", "美容液"]}}
+
+
+def karte_df(rows, token=1.0):
+    frame = pd.DataFrame([dict(zip(HEADER, r)) for r in rows], columns=HEADER)
+    frame.attrs["fetched_at"] = token
+    return frame
+
+
+@pytest.fixture
+def sheet(fake_sheet_session):
+    fake_sheet_session.seed({"カルテ": [HEADER] + ROWS})
+    return fake_sheet_session.worksheet("カルテ")
+
+
+def test_form_row_and_index_agree_on_duplicates(app):
+    frame = karte_df(ROWS)
+    repo = app.KarteRepository()
+    repo.sync(frame)
+    primary = app.karte_primary_rows(frame)
+    shown = primary[primary["商品名"] == "A水"].iloc[0]
+    # 編集画面に出す行 = 索引が保存先にする行
+    assert repo.row_of["A水"] == primary.index[primary["商品名"] == "A水"][0] + 2 == 2
+    assert repo.updated_of["A水"] == shown["更新"] == "2024/01/02"
+    assert list(primary["商品名"]) == ["A水", "B液"]
+
+
+def test_save_from_form_writes_the_row_it_showed(app, sheet):
+    frame = karte_df(ROWS)
+    repo = app.KarteRepository()
+    repo.sync(frame)
+    shown = app.karte_primary_rows(frame).iloc[0]
+    record = {**shown.to_dict(), "メモ": "編集後", "更新": "2024/02/01"}
+    assert repo.upsert(sheet, record, expected_updated=shown["更新"]) == "updated"
+    values = sheet.get_all_values()
+    assert values[1][HEADER.index("メモ")] == "編集後"
+    assert values[3][HEADER.index("メモ")] == "重複"  # 重複している別の行は触らない
+    # ID列の追加：同名の行には同じIDを振る
+    assert values[0][-1] == app.KARTE_ID_COL
+    assert values[1][-1] == values[3][-1] != values[2][-1]
+
+
+def test_conflict_when_sheet_changed_since_form_opened(app, sheet):
+    repo = app.KarteRepository()
+    repo.sync(karte_df(ROWS))
+    sheet.update(range_name="B2", values=[["2024/01/09"]])
+    record = dict(zip(HEADER, ROWS[0]))
+    with pytest.raises(app.KarteConflictError) as err:
+        repo.upsert(sheet, record, expected_updated="2024/01/02")
+    assert err.value.current_updated == "2024/01/09"
+    assert repo.upsert(sheet, record, expected_updated="2024/01/02", force=True) == "updated"
+
+
+def test_second_editor_sharing_the_repository_gets_a_conflict(app, sheet):
+    # 索引はプロセス全体で1つ。各編集者はフォームを開いた時の「更新」を自分で持つ
+    repo = app.KarteRepository()
+    repo.sync(karte_df(ROWS))
+    opened_by_a = opened_by_b = repo.updated_of["B液"]
+    record = dict(zip(HEADER, ROWS[1]))
+    assert repo.upsert(sheet, {**record, "メモ": "Aさん", "更新": "2024/02/01"}, expected_updated=opened_by_a) == "updated"
+    with pytest.raises(app.KarteConflictError) as err:
+        repo.upsert(sheet, {**record, "メモ": "Bさん", "更新": "2024/02/02"}, expected_updated=opened_by_b)
+    assert err.value.current_updated == "2024/02/01"
+    assert sheet.get_all_values()[2][HEADER.index("メモ")] == "Aさん"
+
+
+def test_conflict_when_rows_shifted(app, sheet):
+    repo = app.KarteRepository()
+    repo.sync(karte_df(ROWS))
+    sheet.delete_rows(2)
+    with pytest.raises(app.KarteConflictError) as err:
+        repo.upsert(sheet, dict(zip(HEADER, ROWS[1])), expected_updated="2024/01/03")
+    assert err.value.current_updated is None
+    assert repo.synced_with is None
+    repo.sync_from_sheet(sheet)
+    assert repo.row_of == {"B液": 2, "A水": 3}
+
+
+def test_create_and_bulk_upsert(app, sheet):
+    repo = app.KarteRepository()
+    repo.sync(karte_df(ROWS))
+    assert repo.upsert(sheet, {"商品名": "C油", "ジャンル": "スキンケア"}) == "created"
+    assert repo.row_of["C油"] == 5
+    result = repo.bulk_upsert(sheet, [{"商品名": "B液", "メモ": "一括"}, {"商品名": "D乳"}, {"商品名": "E泡"}], chunk_size=1)
+    assert result == {"updated": 1, "created": 2, "requests": 3}
+    names = [r[HEADER.index("商品名")] for r in sheet.get_all_values()[1:]]
+    assert names == ["A水", "B液", "A水", "C油", "D乳", "E泡"]
+    assert repo.row_of["E泡"] == 7
+
+
+
+def test_import_reads_json_arrays_and_jsonl(app):
+    records = [{"ジャンル": "スキンケア", "アイテムタイプ": "化粧水", "商品名": "C油"}, {"ジャンル": "スキンケア", "商品名": "D乳"}]
+    as_json = app.read_karte_import(json.dumps(records, ensure_ascii=False).encode("utf-8"), "karte.json")
+    as_jsonl = app.read_karte_import("\n".join(json.dumps(r, ensure_ascii=False) for r in records).encode("utf-8"), "karte.jsonl")
+    assert list(as_json["商品名"]) == list(as_jsonl["商品名"]) == ["C油", "D乳"]
+    assert as_json.loc[1, "アイテムタイプ"] == ""
+
+
+def test_import_requires_the_genre_column(app):
+    frame = app.read_karte_import("商品名,全成分\nC油,水\n".encode("utf-8"), "karte.csv")
+    accepted, errors, _ = app.validate_karte_import(frame, CONFIG)
+    assert accepted.empty and errors == [(0, "「ジャンル」列がありません")]
+    frame = app.read_karte_import("商品名,ジャンル,アイテムタイプ\nC油,,化粧水\nD乳,スキンケア,美容液\n".encode("utf-8"), "karte.csv")
+    accepted, errors, _ = app.validate_karte_import(frame, CONFIG)
+    assert list(accepted["商品名"]) == ["D乳"] and errors == [(2, "ジャンルが空です")]
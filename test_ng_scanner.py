@@ -0,0 +1,29 @@
+import random
+
+
+def brute_force(words, text):
+    return sorted((i, i + len(w), w) for w in words for i in range(len(text)) if text.startswith(w, i))
+
+
+def test_scan_finds_overlapping_and_nested_words(app):
+    scanner = app.NGWordScanner([("治る", "医薬品的な効能"), ("完治", "医薬品的な効能"), ("シミが消える", "効果の保証"), ("消える", "効果の保証")])
+    hits = scanner.scan("完治する！シミが消える")
+    assert sorted(h[:3] for h in hits) == [(0, 2, "完治"), (5, 11, "シミが消える"), (8, 11, "消える")]
+    assert {h[3] for h in hits} == {"医薬品的な効能", "効果の保証"}
+    assert scanner.scan("") == [] and scanner.scan(None) == []
+
+
+def test_scan_matches_brute_force_on_random_text(app):
+    rng = random.Random(0)
+    alphabet = "あいうアイ"
+    words = sorted({"".join(rng.choice(alphabet) for _ in range(rng.randint(1, 4))) for _ in range(30)})
+    scanner = app.NGWordScanner([(w, "理由") for w in words] + [("  ", "空白だけの語は無視")])
+    for _ in range(50):
+        text = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 40)))
+        assert sorted(h[:3] for h in scanner.scan(text)) == brute_force(words, text)
+
+
+def test_highlight_prefers_the_longest_match_from_the_left(app):
+    scanner = app.NGWordScanner([("シミ", "r"), ("シミが消える", "r"), ("消える", "r")])
+    assert scanner.highlight("あのシミが消える") == "あの:red[**シミが消える**]"
+    assert scanner.highlight("問題なし") == "問題なし"
@@ -0,0 +1,44 @@
+import threading
+
+import pandas as pd
+
+
+def make_index(app, rows):
+    index = app.IngredientIndex()
+    index.sync(pd.DataFrame(rows, columns=["商品名", "全成分"]))
+    return index
+
+
+def master(rows):
+    return pd.DataFrame(rows, columns=["キーワード", "推奨成分", "理由・ポップ用フレーズ"])
+
+
+def test_recommend_ranks_by_coverage(app):
+    index = make_index(app, [["化粧水A", "水・セラミド"], ["美容液B", "水・ビタミンC"]])
+    table = app.trouble_product_table(master([["乾燥", "セラミド", "うるおす"], ["毛穴", "ビタミンC", "引き締める"]]), index)
+    target = pd.DataFrame({"肌悩み": ["乾燥, 毛穴", "乾燥", "乾燥"]})
+    recs = app.recommend_products(target, table)
+    assert list(recs["商品名"]) == ["化粧水A", "美容液B"]
+    assert recs.loc[0, "きっかけ"] == "乾燥" and recs.loc[0, "アドバイス"] == "うるおす"
+
+
+def test_no_matching_trouble_returns_the_empty_schema(app):
+    index = make_index(app, [["化粧水A", "水・セラミド"]])
+    table = app.trouble_product_table(master([["乾燥", "セラミド", "うるおす"]]), index)
+    recs = app.recommend_products(pd.DataFrame({"肌悩み": ["毛穴"]}), table)
+    assert recs.empty
+    assert list(recs.columns) == app.RECOMMEND_COLUMNS
+    assert list(app.recommend_products(pd.DataFrame({"年齢": ["20代"]}), table).columns) == app.RECOMMEND_COLUMNS
+
+
+def test_trouble_table_is_built_under_the_holder_lock(app):
+    index = make_index(app, [["化粧水A", "水・セラミド"]])
+    holder = app._trouble_table_holder()
+    result = []
+    with holder["lock"]:
+        worker = threading.Thread(target=lambda: result.append(app.trouble_product_table(master([["乾燥", "セラミド", ""]]), index)))
+        worker.start()
+        worker.join(0.2)
+        assert worker.is_alive() and not result
+    worker.join(5)
+    assert list(result[0]["商品名"]) == ["化粧水A"]
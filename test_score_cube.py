@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+
+@pytest.fixture
+def responses():
+    rng = np.random.default_rng(0)
+    n = 200
+    frame = pd.DataFrame({
+        "ジャンル": rng.choice(["化粧水", "乳液"], n),
+        "商品名": rng.choice(["A", "B", "C"], n),
+        "年代": rng.choice(["20代", "30代", None], n),
+        "性別": rng.choice(["女性", "男性"], n),
+        "肌悩み": rng.choice(["乾燥", "乾燥, ニキビ", "くすみ"], n),
+        "保湿": rng.integers(1, 6, n).astype(float),
+        "香り": rng.integers(1, 6, n).astype(float),
+    })
+    frame.loc[frame.index[::7], "香り"] = np.nan
+    return frame
+
+
+def test_stats_match_pandas(app, responses):
+    cube = app.ScoreCube(responses, ["保湿", "香り"])
+    stats = cube.stats()
+    grouped = responses.groupby("商品名")[["保湿", "香り"]]
+    pd.testing.assert_frame_equal(stats["mean"].sort_index(), grouped.mean().sort_index(), check_names=False)
+    # 標準偏差の表示に使う分散は pandas の std（ddof=1）と一致する
+    pd.testing.assert_frame_equal(stats["var"].sort_index() ** 0.5, grouped.std().sort_index(), check_names=False)
+    assert stats["回答数"].sum() == len(responses)
+
+
+def test_filters_match_boolean_masks(app, responses):
+    cube = app.ScoreCube(responses, ["保湿", "香り"])
+    filters = {"ジャンル": "化粧水", "年代": ["20代"], "肌悩み": lambda v: "乾燥" in v}
+    mask = (responses["ジャンル"] == "化粧水") & (responses["年代"] == "20代") & responses["肌悩み"].str.contains("乾燥")
+    assert cube.count(filters) == mask.sum()
+    means = cube.means(filters=filters)
+    expected = responses[mask].groupby("商品名")[["保湿", "香り"]].mean()
+    pd.testing.assert_frame_equal(means.sort_index(), expected.sort_index(), check_names=False)
+
+
+def test_single_answer_has_no_variance(app):
+    frame = pd.DataFrame({"商品名": ["A", "A", "B"], "保湿": [3.0, 5.0, 4.0]})
+    stats = app.ScoreCube(frame, ["保湿"]).stats()
+    assert stats.loc["A", ("var", "保湿")] == pytest.approx(2.0)
+    assert pd.isna(stats.loc["B", ("var", "保湿")])
+
+
+def test_unanswered_dimension_is_dropped_from_group_by(app, responses):
+    stats = app.ScoreCube(responses, ["保湿"]).stats(by="年代")
+    assert app.ScoreCube.UNANSWERED not in stats.index
+    assert set(stats.index) == {"20代", "30代"}
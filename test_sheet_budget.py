@@ -0,0 +1,41 @@
+import pytest
+
+import fake_sheets
+
+
+def test_background_calls_leave_the_reserve_to_the_screen(app):
+    budget = app.SheetRequestBudget(per_minute=600, background_reserve=0.2)  # 10回/秒、予約120回分
+    budget._tokens["読み込み"] = 120.5
+    assert budget.acquire("読み込み", "interactive") < 0.05
+    # 残りが予約分を切っているので、裏の処理は貯まるまで待つ
+    assert budget.acquire("読み込み", "background") > 0.1
+    assert budget.stats["throttled"] == 1
+
+
+def test_penalize_empties_the_bucket(app):
+    budget = app.SheetRequestBudget(per_minute=600)
+    budget.penalize("書き込み")
+    assert budget._tokens["書き込み"] <= 0
+    assert budget.acquire("書き込み") > 0.05
+    assert budget.stats["rate_limited"] == 1
+
+
+def test_fake_backend_calls_go_through_the_budget(app, tmp_path):
+    budget = app.SheetRequestBudget(per_minute=600)
+    path = str(tmp_path / "fake_sheets.json")
+    fake_sheets.FakeClient.seed(path, {"カルテ": [["商品名"], ["A水"]]})
+    client = fake_sheets.FakeClient(path, budget=budget, call_context=app.current_sheet_call_context)
+
+    with app.sheet_call_context("カルテ編集", "interactive"):
+        sheet = client.open("Cosme Data").worksheet("カルテ")
+        sheet.get_all_values()
+        sheet.update([["B液"]], "A2")
+    client.offline = True
+    with app.sheet_call_context("ミラー同期", "background"), pytest.raises(app.requests.exceptions.ConnectionError):
+        sheet.get_all_values()
+
+    assert budget.stats["calls"] == 4
+    assert budget.stats["errors"] == 1
+    assert budget.calls_by_label == {("カルテ編集", "読み込み"): 2, ("カルテ編集", "書き込み"): 1, ("ミラー同期", "読み込み"): 1}
+    assert sum(budget.histograms["読み込み"]) == 3
+    assert budget.used_last_minute() == {"読み込み": 3, "書き込み": 1}
@@ -0,0 +1,103 @@
+import json
+import threading
+import time
+
+import pytest
+
+CONFIG = [["ジャンル名", "アイテムタイプ", "フォームID", "評価項目リスト"], ["スキンケア", "化粧水", "F1", "保湿, 香り"]]
+
+
+def wait_until(predicate, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+@pytest.fixture
+def mirror(app, tmp_path, fake_sheet_session):
+    fake_sheet_session.seed({"商品構成": CONFIG})
+    mirror = app.SheetMirror(str(tmp_path / "mirror.sqlite"), fake_sheet_session, interval=60, read_wait=5)
+    fake_sheet_session.mirror = mirror
+    return mirror
+
+
+def test_records_are_read_from_the_mirror(mirror, fake_sheet_session):
+    assert mirror.records("商品構成") == [{"ジャンル名": "スキンケア", "アイテムタイプ": "化粧水", "フォームID": "F1", "評価項目リスト": "保湿, 香り"}]
+    assert not mirror.has_sheet("存在しないシート")
+    # 一度写したシートは、シートに接続できなくてもミラーから読める
+    fake_sheet_session.client.offline = True
+    assert len(mirror.records("商品構成")) == 1
+    assert mirror.has_sheet("商品構成")
+
+
+def test_written_sheet_is_synced_before_the_next_read(mirror, fake_sheet_session):
+    mirror.records("商品構成")
+    fake_sheet_session.worksheet("商品構成").append_rows([["スキンケア", "乳液", "F1", "保湿"]])
+    fake_sheet_session.bump_revision("商品構成")
+    assert [r["アイテムタイプ"] for r in mirror.records("商品構成")] == ["化粧水", "乳液"]
+    assert fake_sheet_session.revisions["商品構成"] >= 2
+
+
+def test_write_during_a_sync_is_not_lost(mirror, fake_sheet_session):
+    mirror.records("商品構成")
+    spreadsheet = fake_sheet_session.spreadsheet()
+    original = spreadsheet.values_batch_get
+
+    def read_then_write(ranges, params=None):
+        # 同期が読み終えた直後に、別の操作がシートへ書き込む
+        result = original(ranges, params)
+        spreadsheet.values_batch_get = original
+        fake_sheet_session.worksheet("商品構成").append_rows([["スキンケア", "乳液", "F1", "保湿"]])
+        fake_sheet_session.bump_revision("商品構成")
+        return result
+
+    # 裏のスレッドは古いイベントを待たせたままにし、この同期だけを見る
+    mirror._wake = threading.Event()
+    spreadsheet.values_batch_get = read_then_write
+    mirror.sync(["商品構成"])
+    # 読んだ後の書き込みなので、取り直し待ちのまま残る
+    assert "商品構成" in mirror._dirty
+    mirror.sync(["商品構成"])
+    assert "商品構成" not in mirror._dirty
+    assert [r["アイテムタイプ"] for r in mirror.records("商品構成")] == ["化粧水", "乳液"]
+
+
+def test_offline_start_returns_empty_sheet_until_reconnected(mirror, fake_sheet_session):
+    fake_sheet_session.client.offline = True
+    assert mirror.records("商品構成") == []
+    assert not mirror.has_sheet("商品構成")
+    assert mirror.offline and mirror.unsynced == {"商品構成"}
+
+    fake_sheet_session.client.offline = False
+    mirror._wake.set()
+    assert wait_until(lambda: not mirror.unsynced)
+    assert not mirror.offline
+    assert len(mirror.records("商品構成")) == 1
+
+
+def test_ensure_sheet_refuses_to_create_sheets_offline(app, mirror, fake_sheet_session, monkeypatch):
+    monkeypatch.setattr(app, "get_sheet_mirror", lambda: mirror)
+    fake_sheet_session.client.offline = True
+    with pytest.raises(app.SheetsOfflineError):
+        app.ensure_sheet(app.INGREDIENT_SYNONYM_SHEET, [app.INGREDIENT_SYNONYM_HEADER], rows=10, cols=2)
+    fake_sheet_session.client.offline = False
+    assert app.INGREDIENT_SYNONYM_SHEET not in {ws.title for ws in fake_sheet_session.spreadsheet().worksheets()}
+
+
+def test_fake_client_releases_lock_when_load_fails(fake_sheet_session):
+    fake_sheet_session.seed({"商品構成": CONFIG})
+    sheet = fake_sheet_session.worksheet("商品構成")
+    path = fake_sheet_session.client.path
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("{broken")
+    with pytest.raises(json.JSONDecodeError):
+        sheet.get_all_values()
+
+    acquired = []
+    thread = threading.Thread(target=lambda: acquired.append(fake_sheet_session.client._lock.acquire(timeout=1)))
+    thread.start()
+    thread.join()
+    assert acquired == [True]
@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+
+@pytest.fixture
+def survey():
+    rng = np.random.default_rng(1)
+    n = 301  # 8の倍数でない行数（packbits の端数を確かめる）
+    return pd.DataFrame({
+        "ジャンル": rng.choice(["スキンケア", "ヘアケア"], n),
+        "アイテムタイプ": rng.choice(["化粧水", "乳液", "シャンプー"], n),
+        "年代": rng.choice(["20代", "30代", "40代"], n),
+        "性別": rng.choice(["女性", "男性", None], n),
+        "肌悩み": rng.choice(["乾燥", "乾燥, ニキビ", "ニキビ、毛穴", None], n),
+        "ライフスタイル": rng.choice(["なし", "睡眠不足", "睡眠不足, ストレス", None], n),
+        "商品名": rng.choice(["A", "B"], n),
+        "保湿": rng.integers(1, 6, n).astype(float),
+    })
+
+
+def has_any(series, wanted):
+    return series.fillna("").str.split(r",|、").apply(lambda vs: any(v.strip() in wanted for v in vs))
+
+
+def test_mask_matches_pandas_filters(app, survey):
+    index = app.SurveyFilterIndex(survey)
+    bits = index.mask({"ジャンル": "スキンケア", "年代": ["20代", "40代"], "肌悩み": ["ニキビ"]})
+    expected = (survey["ジャンル"] == "スキンケア") & survey["年代"].isin(["20代", "40代"]) & has_any(survey["肌悩み"], {"ニキビ"})
+    assert index.positions(bits).tolist() == np.flatnonzero(expected).tolist()
+    assert index.count(bits) == expected.sum()
+
+
+def test_all_options_selected_does_not_filter(app, survey):
+    index = app.SurveyFilterIndex(survey)
+    assert index.active_filters({"年代": ["20代", "30代", "40代"], "性別": [], "ジャンル": None}) == {}
+    assert index.count(index.mask()) == len(survey)
+    assert set(index.options("肌悩み")) == {"乾燥", "ニキビ", "毛穴"}
+
+
+def test_lifestyle_levels_count_concerns(app, survey):
+    index = app.SurveyFilterIndex(survey)
+    levels = app.SurveyFilterIndex.lifestyle_levels(survey["ライフスタイル"])
+    expected = survey["ライフスタイル"].map({"なし": 0, "睡眠不足": 1, "睡眠不足, ストレス": 2}).fillna(0)
+    assert levels.tolist() == expected.tolist()
+    assert index.count(index.mask(life_min=2)) == (expected >= 2).sum()
+
+
+def test_query_plan_where_reuses_parent_rows(app, survey):
+    index = app.SurveyFilterIndex(survey)
+    query = app.SurveyQuery(survey, index, "v1", [{"ジャンル": "スキンケア"}])
+    assert query.count == (survey["ジャンル"] == "スキンケア").sum()
+    narrowed = query.where({"性別": "女性"})
+    assert narrowed._base_bits is query.bits
+    expected = survey[(survey["ジャンル"] == "スキンケア") & (survey["性別"] == "女性")]
+    pd.testing.assert_frame_equal(narrowed.select(["商品名", "保湿", "存在しない列"]), expected[["商品名", "保湿"]])
+    assert narrowed.unique("アイテムタイプ") == sorted(expected["アイテムタイプ"].unique())
+
+
+def test_query_cube_uses_shared_cube_only_for_cube_dimensions(app, survey, monkeypatch):
+    monkeypatch.setattr(app, "ALL_SCORE_COLS", ("保湿",), raising=False)
+    monkeypatch.setattr(app, "get_score_cube", lambda version, frame, cols: app.ScoreCube(frame, cols))
+    monkeypatch.setattr(app, "get_adhoc_score_cube", lambda version, digest, frame, cols: app.ScoreCube(frame, cols))
+    index = app.SurveyFilterIndex(survey)
+
+    on_axes = app.SurveyQuery(survey, index, "v1", [{"ジャンル": "スキンケア", "肌悩み": ["ニキビ"]}])
+    cube, filters = on_axes.cube(["保湿"])
+    assert set(filters) == {"ジャンル", "肌悩み"}
+    expected = survey[(survey["ジャンル"] == "スキンケア") & has_any(survey["肌悩み"], {"ニキビ"})]
+    assert cube.count(filters) == len(expected)
+
+    off_axes = app.SurveyQuery(survey, index, "v1", [{"アイテムタイプ": "化粧水"}])
+    cube, filters = off_axes.cube(["保湿"])
+    assert filters == {}
+    assert cube.count() == (survey["アイテムタイプ"] == "化粧水").sum()
@@ -0,0 +1,65 @@
+import pytest
+
+HEADER = "タイムスタンプ,今回ご使用の商品名を入力してください。,保湿"
+
+
+@pytest.fixture
+def ingest(app, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "LOCAL_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(app, "SURVEY_DB_PATH", str(tmp_path / "survey.sqlite"))
+
+    def run(*rows):
+        return app.ingest_survey_incremental("\n".join([HEADER, *rows]).encode("utf-8"))
+    return run
+
+
+def test_appends_rows_that_share_the_last_timestamp(ingest):
+    data, mode, delta = ingest("2024/01/01 10:00:00,A,3", "2024/01/02 09:00:00,B,4")
+    assert (mode, delta) == ("全件取込", 2)
+    # 前回の最終行と同じ時刻に届いた回答も追記される
+    data, mode, delta = ingest("2024/01/01 10:00:00,A,3", "2024/01/02 09:00:00,B,4", "2024/01/02 09:00:00,C,5")
+    assert (mode, delta) == ("差分取込", 1)
+    assert list(data["商品名"]) == ["A", "B", "C"]
+
+
+def test_identical_responses_are_counted_separately(ingest):
+    ingest("2024/01/01 10:00:00,A,3")
+    data, mode, delta = ingest("2024/01/01 10:00:00,A,3", "2024/01/01 10:00:00,A,3")
+    assert (mode, delta) == ("差分取込", 1)
+    assert len(data) == 2
+
+
+def test_unchanged_csv_is_not_parsed_again(ingest):
+    ingest("2024/01/01 10:00:00,A,3")
+    data, mode, delta = ingest("2024/01/01 10:00:00,A,3")
+    assert (mode, delta) == ("変更なし", 0)
+    assert list(data["商品名"]) == ["A"]
+
+
+def test_deleted_response_triggers_full_rebuild(ingest):
+    ingest("2024/01/01 10:00:00,A,3", "2024/01/02 09:00:00,B,4", "2024/01/03 09:00:00,C,5")
+    data, mode, _ = ingest("2024/01/01 10:00:00,A,3", "2024/01/03 09:00:00,C,5")
+    assert mode.startswith("全件取込")
+    assert list(data["商品名"]) == ["A", "C"]
+
+
+def test_edited_response_triggers_full_rebuild(ingest):
+    ingest("2024/01/01 10:00:00,A,3", "2024/01/02 09:00:00,B,4")
+    rows = ("2024/01/01 10:00:00,A,5", "2024/01/02 09:00:00,B,4", "2024/01/03 09:00:00,C,1")
+    data, mode, _ = ingest(*rows)
+    assert mode.startswith("全件取込")
+    assert list(data["保湿"]) == [5, 4, 1]
+    # 保存し直した内容が次回の取込でもそのまま返る
+    stored, mode, _ = ingest(*rows)
+    assert mode == "変更なし" and list(stored["保湿"]) == [5, 4, 1]
+
+
+def test_version_changes_when_a_response_is_edited(ingest, app):
+    before, _, _ = ingest("2024/01/01 10:00:00,A,3", "2024/01/02 09:00:00,B,4")
+    after, _, _ = ingest("2024/01/01 10:00:00,A,5", "2024/01/02 09:00:00,B,4")
+    assert app.survey_data_version(before) != app.survey_data_version(after)
+
+
+def test_version_of_missing_data_is_empty(app):
+    # 読み込みに失敗した時も、世代は1回の呼び出しでそのまま求められる
+    assert app.survey_data_version(None) == ""
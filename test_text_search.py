@@ -0,0 +1,58 @@
+import random
+
+VOICES = {
+    1: "しっとりして乾燥が気にならなくなった",
+    2: "香りが強くて乾燥肌には刺激があった",
+    3: "ベタつかず、さっぱり。リピートしたい",
+    4: "乾燥 乾燥 乾燥の季節でも大丈夫",
+    5: "ＵＶカットもできて便利",
+}
+
+
+def make_index(app):
+    index = app.TextSearchIndex()
+    index.sync("感想", "v1", ((k, {"感想": v}) for k, v in VOICES.items()))
+    return index
+
+
+def keys(hits):
+    return {key for (_, key), _ in hits}
+
+
+def test_search_requires_every_term(app):
+    index = make_index(app)
+    assert keys(index.search("乾燥")) == {1, 2, 4}
+    assert keys(index.search("乾燥 香り")) == {2}
+    assert keys(index.search("燥乾")) == set()  # bigram はあっても語順が違う
+    assert keys(index.search("uvカット")) == {5}  # 全角・大文字も同じに扱う
+    assert keys(index.search("香")) == {2}  # 1文字の検索語
+    assert index.search("   ") == []
+
+
+def test_more_occurrences_rank_higher(app):
+    hits = make_index(app).search("乾燥", source="感想")
+    assert hits[0][0] == ("感想", 4)
+
+
+def test_search_matches_substring_scan(app):
+    rng = random.Random(0)
+    alphabet = "あいうえお"
+    docs = {i: "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 30))) for i in range(60)}
+    index = app.TextSearchIndex()
+    index.sync("感想", "v1", ((k, {"感想": v}) for k, v in docs.items()))
+    for _ in range(40):
+        term = "".join(rng.choice(alphabet) for _ in range(rng.randint(1, 4)))
+        assert keys(index.search(term, limit=0)) == {k for k, v in docs.items() if term in v}
+
+
+def test_sync_applies_only_changes(app):
+    index = make_index(app)
+    index.sync("感想", "v1", [])  # 同じ世代なら何もしない
+    assert keys(index.search("乾燥")) == {1, 2, 4}
+    changed = dict(VOICES)
+    del changed[4]
+    changed[1] = "しっとりした"
+    index.sync("感想", "v2", ((k, {"感想": v}) for k, v in changed.items()))
+    assert keys(index.search("乾燥")) == {2}
+    assert index.doc_counts["感想"] == 4
+    assert index.fields(("感想", 1)) == {"感想": "しっとりした"}
@@ -0,0 +1,153 @@
+import time
+
+import pytest
+
+KARTE = [
+    ["新規", "更新", "作成者", "ジャンル", "アイテムタイプ", "商品名", "全成分", "公式情報", "ポップ案", "メモ", "画像URL", "商品ID"],
+    ["2024/01/01", "2024/01/02 10:00", "山田", "スキンケア", "化粧水", "A水", "水、BG", "", "", "", "", "P1"],
+    ["2024/01/01", "2024/01/03 10:00", "山田", "スキンケア", "美容液", "B液", "水", "", "", "", "", "P2"],
+]
+
+
+class Unreachable:
+    """再起動前のプロセス：書き込みを積むだけで、シートには届かない"""
+
+    revisions = {}
+
+    def worksheet(self, title):
+        raise RuntimeError("unreachable")
+
+    def bump_revision(self, title, mirror_stale=True):
+        pass
+
+
+def wait_until(predicate, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def make_queue(app, path, session, repo=None, **kwargs):
+    return app.SheetWriteQueue(str(path), session, app.sheet_write_handlers(repo or app.KarteRepository()), **kwargs)
+
+
+def test_replay_after_restart_resolves_rows_from_sheet(app, tmp_path, fake_sheet_session):
+    fake_sheet_session.seed({"カルテ": KARTE})
+    db = tmp_path / "queue.sqlite"
+    before = make_queue(app, db, Unreachable())
+    record = dict(zip(KARTE[0], KARTE[1]), **{"全成分": "水、BG、グリセリン", "更新": "2024/02/01 09:00"})
+    before.submit("カルテ", "karte_upsert", {"record": record, "expected_updated": "2024/01/02 10:00", "force": False})
+    before.submit("カルテ", "karte_fields", {"name": "B液", "fields": {"ポップ案": "しっとり"}})
+    assert wait_until(lambda: before.depth() == (0, 2))
+
+    # 再起動：索引が空のリポジトリで、画面を開く前にワーカーが積み残しを流す
+    after = make_queue(app, db, fake_sheet_session)
+    after.retry_failed()
+    assert wait_until(lambda: after.depth() == (0, 0))
+
+    rows = fake_sheet_session.worksheet("カルテ").get_all_values()
+    assert [r[5] for r in rows[1:]] == ["A水", "B液"]  # 重複行を追加していない
+    assert rows[1][6] == "水、BG、グリセリン"
+    assert rows[2][8] == "しっとり"
+    assert fake_sheet_session.revisions["カルテ"] == 2
+
+
+def test_replay_after_restart_still_detects_conflicts(app, tmp_path, fake_sheet_session):
+    fake_sheet_session.seed({"カルテ": KARTE})
+    q = make_queue(app, tmp_path / "queue.sqlite", fake_sheet_session)
+    record = dict(zip(KARTE[0], KARTE[1]), **{"メモ": "古い画面から"})
+    op = q.submit("カルテ", "karte_upsert", {"record": record, "expected_updated": "2023/12/31 00:00", "force": False}, wait=True)
+    with pytest.raises(app.KarteConflictError):
+        q.wait(op, 5)
+    assert fake_sheet_session.worksheet("カルテ").get_all_values()[1][9] == ""
+
+
+def test_unknown_product_is_retried_then_left_failed(app, tmp_path, fake_sheet_session):
+    fake_sheet_session.seed({"カルテ": KARTE})
+    q = make_queue(app, tmp_path / "queue.sqlite", fake_sheet_session, base_delay=0.01, max_attempts=3)
+    q.submit("カルテ", "karte_fields", {"name": "C油", "fields": {"ポップ案": "x"}})
+    assert wait_until(lambda: q.depth() == (0, 1))
+    assert q.stats["retries"] == 2
+
+
+def test_merge_keeps_latest_value_per_range_and_appends_in_order(app):
+    Q = app.SheetWriteQueue
+    merged = Q.merge("batch_update",
+                     {"updates": [{"range": "A1", "values": [[1]]}, {"range": "B1", "values": [[2]]}]},
+                     {"updates": [{"range": "A1", "values": [[3]]}]})
+    assert {u["range"]: u["values"] for u in merged["updates"]} == {"A1": [[3]], "B1": [[2]]}
+    assert Q.merge("append_rows", {"rows": [["a"]]}, {"rows": [["b"]]}) == {"rows": [["a"], ["b"]]}
+    assert Q.merge("karte_fields", {"name": "A水", "fields": {"ポップ案": "x", "メモ": "m"}},
+                   {"name": "A水", "fields": {"ポップ案": "y"}})["fields"] == {"ポップ案": "y", "メモ": "m"}
+    assert Q.coalesce_key("karte_fields", {"name": "A水"}) != Q.coalesce_key("karte_fields", {"name": "B液"})
+    assert Q.coalesce_key("karte_upsert", {}) is None
+
+
+def test_retryable_errors_back_off_and_succeed(app, tmp_path):
+    class Flaky:
+        def __init__(self):
+            self.revisions, self.calls = {}, 0
+
+        def worksheet(self, title):
+            return self
+
+        def batch_update(self, updates):
+            self.calls += 1
+            if self.calls < 3:
+                raise app.requests.exceptions.ConnectionError("reset")
+            return len(updates)
+
+        def bump_revision(self, title, mirror_stale=True):
+            self.revisions[title] = self.revisions.get(title, 0) + 1
+
+    session = Flaky()
+    q = make_queue(app, tmp_path / "queue.sqlite", session, base_delay=0.01)
+    op = q.submit("X", "batch_update", {"updates": [{"range": "A1", "values": [[1]]}]}, wait=True)
+    assert q.wait(op, 5) == (True, 1)
+    assert q.stats["retries"] == 2
+    assert session.revisions == {"X": 1}
+
+
+def test_batch_fields_resolve_rows_when_written(app, tmp_path, fake_sheet_session):
+    import pandas as pd
+
+    # 画面が持っている索引は古い並び（A水=2行目、B液=3行目）
+    repo = app.KarteRepository()
+    stale = pd.DataFrame([dict(zip(KARTE[0], r)) for r in KARTE[1:]])
+    stale.attrs["fetched_at"] = 1.0
+    repo.sync(stale)
+    # その後シートでは先頭に1行増えて、行がずれている
+    shifted = [KARTE[0], ["", "", "", "", "", "Z乳", "", "", "", "", "", "P9"]] + KARTE[1:]
+    fake_sheet_session.seed({"カルテ": shifted})
+
+    q = make_queue(app, tmp_path / "queue.sqlite", fake_sheet_session, repo=repo)
+    op = q.submit("カルテ", "karte_fields_many",
+                  {"fields_by_name": {"A水": {"ポップ案": "うるおう"}, "B液": {"ポップ案": "ぷるぷる"}, "C油": {"ポップ案": "x"}}},
+                  wait=True)
+    done, result = q.wait(op, 5)
+    assert done and result == {"updated": 2, "missing": ["C油"]}
+    pops = {r[5]: r[8] for r in fake_sheet_session.worksheet("カルテ").get_all_values()[1:]}
+    assert pops == {"Z乳": "", "A水": "うるおう", "B液": "ぷるぷる"}
+
+
+def test_ensure_sheet_seeds_new_sheet_through_queue(app, tmp_path, fake_sheet_session, monkeypatch):
+    fake_sheet_session.seed({"カルテ": KARTE})
+    session = fake_sheet_session
+    session.add_worksheet = lambda title, rows, cols: session.spreadsheet().add_worksheet(title, rows, cols)
+    mirror = app.SheetMirror(str(tmp_path / "mirror.sqlite"), session, interval=60)
+    session.mirror = mirror
+    queue = make_queue(app, tmp_path / "queue.sqlite", session)
+    monkeypatch.setattr(app, "get_sheet_mirror", lambda: mirror)
+    monkeypatch.setattr(app, "get_sheet_session", lambda: session)
+    monkeypatch.setattr(app, "get_write_queue", lambda: queue)
+
+    app.ensure_sheet(app.INGREDIENT_SYNONYM_SHEET, [app.INGREDIENT_SYNONYM_HEADER] + app.DEFAULT_INGREDIENT_SYNONYMS, rows=200, cols=2)
+    values = session.worksheet(app.INGREDIENT_SYNONYM_SHEET).get_all_values()
+    assert values[0] == app.INGREDIENT_SYNONYM_HEADER
+    assert len(values) == len(app.DEFAULT_INGREDIENT_SYNONYMS) + 1
+    assert mirror.has_sheet(app.INGREDIENT_SYNONYM_SHEET)
+    app.ensure_sheet(app.INGREDIENT_SYNONYM_SHEET, [app.INGREDIENT_SYNONYM_HEADER], rows=200, cols=2)
+    assert len(session.worksheet(app.INGREDIENT_SYNONYM_SHEET).get_all_values()) == len(values)